@@ -4,7 +4,7 @@ from datetime import datetime
 # PIPELINE STEPS
 # ===================================================
 
-# possible pipeline steps: preparing, tab_to_tab_sdg, text_to_tab_sdg_shuffle, text_to_tab_sdg
+# possible pipeline steps: preparing, tab_to_tab_sdg, text_to_tab_sdg_shuffle, text_to_tab_sdg, text_to_tab_sdg_batch
 # evaluate_fidelity, evaluate_privacy, evaluate_utility, evaluate, evaluate_agg, describe_data
 PIPELINE_STEPS_TO_PERFORM = [
     "preparing",
@@ -21,6 +21,52 @@ SDG_MODEL = "gpt-4-turbo" #"gpt-4-turbo" # gpt-4-turbo, ctgan, tvae, copula, mis
 RANDOM_STATE = 1
 N_ROWS = 10
 N_SAMPLE = 1000
+# adapt the number of rows requested per query to maximise valid rows per second,
+# exploring the following sizes (N_ROWS is then the initial size)
+N_ROWS_ADAPTIVE = False # True to adapt the size (not part of the baseline protocol)
+N_ROWS_CANDIDATES = [5, 10, 15, 20, 30]
+# maximum number of LLM queries in flight at the same time during text to tab generation
+MAX_CONCURRENCY = 8
+# a query failing (provider error, retries exhausted) is replaced by a new one, the generation
+# being aborted after MAX_CONSECUTIVE_FAILURES successive failed queries
+MAX_CONSECUTIVE_FAILURES = 10
+# remove generated rows duplicating rows already generated (patient identifier excluded),
+# exactly or once numeric values are rounded to DUPLICATE_SIGNIFICANT_DIGITS digits
+DUPLICATE_DETECTION = False # True to drop duplicates (not part of the baseline protocol)
+DUPLICATE_SIGNIFICANT_DIGITS = 3
+# distribute the queries across a pool of models (model: prior weight), re-weighted by their
+# valid rows per second, rejection rate and cost per valid row (see model_router), the
+# generated rows being tagged with their model in COL_SOURCE_MODEL. None to only query SDG_MODEL
+ROUTER_MODELS = None # {"gpt-4-turbo": 1.0, "mistral-large-latest": 1.0}
+# penalty of the cost per valid row ($): the score of a model is divided by 1 + ROUTER_COST_WEIGHT x cost
+ROUTER_COST_WEIGHT = 100
+ROUTER_MIN_SHARE = 0.05
+ROUTER_MIN_REQUESTS = 3
+ROUTER_DECAY = 0.9
+COL_SOURCE_MODEL = "source_model"
+# hybrid generation: HYBRID_SEED_FRACTION of the N_SAMPLE rows (at least HYBRID_MIN_SEED_ROWS)
+# generated by the LLM, the other rows sampled from a gaussian copula fit on them. Rows are
+# tagged with their origin (llm or copula) in COL_SYNTH_ORIGIN
+HYBRID_ENABLED = False
+HYBRID_SEED_FRACTION = 0.1
+HYBRID_MIN_SEED_ROWS = 100
+COL_SYNTH_ORIGIN = "synth_origin"
+# steering of the generation towards target marginal distributions (see steering): a share
+# STEERING_RATE of the queries are conditioned on the under-filled strata of the columns
+# whose accepted rows are the most distant from their target, once STEERING_MIN_ROWS rows
+# are accepted. Targets by column: {"weights": {category: weight}}, {"bins": [edges],
+# "weights": [...]}, {"mean": m, "std": s} or {"uniform": True} (categories or bounds of the referential)
+STEERING_ENABLED = False
+STEERING_TARGETS = {
+    "PTGENDER": {"uniform": True},
+    "AGE": {"mean": 75, "std": 8},
+}
+STEERING_N_BINS = 5
+STEERING_RATE = 0.5
+STEERING_MIN_ROWS = 50
+STEERING_MAX_CONDITIONS = 2
+STEERING_MIN_DISTANCE = 0.05
+STEERING_PROMPT = "\nGenerate only patients with {conditions}.\n"
 # name of prompt if GPT model OR name of database if standard SDG model
 PROMPT_ID = "adni_prompt" #"ppmi_prompt
 DATE = (
@@ -71,6 +117,10 @@ if PROMPT_ID:
     PATH_SYNTH_DATA += f"/{PROMPT_ID}"
 FILE_SYNTHESIZED_DATA = f"{DATE}_{DATABASE}_synthesized_data.csv"
 
+# checkpoints of text to tab generation (local folder or s3://bucket/folder)
+# one checkpoint per synthetic dataset, removed once the dataset is saved
+PATH_CHECKPOINT = "checkpoints/"
+
 # evaluation
 PATH_EVALUATE = f"output_data/{SDG_MODEL}/evaluate/train_test_splits"
 if PROMPT_ID:
@@ -99,6 +149,9 @@ REFERENTIAL_VAR_CLASS = "variable_class"
 REFERENTIAL_VAR_NATURE = "variable_nature"
 REFERENTIAL_VAR_TYPE = "variable_type"
 REFERENTIAL_VAR_CAT_MAPPING = "variable_category_map"
+# optional columns of plausible minimum and maximum values, checked on generated rows
+REFERENTIAL_VAR_MIN = "variable_min"
+REFERENTIAL_VAR_MAX = "variable_max"
 
 ## Variable use sheet
 REFERENTIAL_USAGE_SHEETNAME = "variable_use"
@@ -165,7 +218,7 @@ ROW_EXAMPLE = {
     "PATNO": "022_S_0004",
     "AGE": 74,
     "PTGENDER": 1,
-    "PTEDUCAT": 15.5 ,
+    "PTEDUCAT": 16,
     "APOE4": 1,
     "CDRSB": 4.3,
     "ADAS11": 18.6,
@@ -204,12 +257,17 @@ ROW_EXAMPLE = {
 # 'prompt': prompt text to use
 # 'is_template': whether the prompt is a template on which to apply a .format()
 # 'template_items': if the prompt is a template, list the variable names to be substituted using .format()
+#   among n_rows (number of rows requested), variables_description and row_example
+#   (row_example_columnar or row_example_csv for the other output formats)
+# 'output_format': format of the table returned by the model: json (dictionary of rows keyed by index),
+#   json_columnar (list of columns and list of rows as lists of values) or csv. Compact formats
+#   do not repeat column names in each row. csv cannot be used with mistral models (JSON mode).
 # 'enrichment_strategy': strategy of prompt enrichment to use. Default to None.
 # }
 
 TEXT2TAB_PROMPT_DICT = { 
     "ppmi_prompt": {
-        "prompt": f"""Give an example table of {N_ROWS} rows of from the {DATABASE_DESCRIPTION} Only consider untreated PD patients. 
+        "prompt": f"""Give an example table of {{n_rows}} rows of from the {DATABASE_DESCRIPTION} Only consider untreated PD patients. 
         The table must have one row by patient, no missing values and include all the following columns: 
 {COL_PTID}: patient unique identifier, integer""" + """ 
 {variables_description}
@@ -221,13 +279,14 @@ Here is an example for one patient with the associated key of the dictionary to
 {row_example}
 """,
         "is_template": True,
-        "template_items": ["variables_description", "row_example"], 
+        "template_items": ["n_rows", "variables_description", "row_example"], 
+        "output_format": "json",
         "enrichment_strategy": None,
         "text2stats_prompt_id": None,
         "input_stats_prompt_id": None,
     }, 
     "adni_prompt": {
-        "prompt": f"""Give an example table of {N_ROWS} rows from {DATABASE_DESCRIPTION} Only consider patients with Alzheimer's Disease diagnosis. 
+        "prompt": f"""Give an example table of {{n_rows}} rows from {DATABASE_DESCRIPTION} Only consider patients with Alzheimer's Disease diagnosis. 
         The table must have one row by patient, no missing values and include all the following columns: 
 {COL_PTID}: patient unique identifier, integer""" + """ 
 {variables_description}
@@ -239,13 +298,174 @@ Here is an example for one patient with the associated key of the dictionary to
 {row_example}
 """,
         "is_template": True,
-        "template_items": ["variables_description", "row_example"], 
+        "template_items": ["n_rows", "variables_description", "row_example"], 
+        "output_format": "json",
+        "enrichment_strategy": None,
+        "text2stats_prompt_id": None,
+        "input_stats_prompt_id": None,
+    }, 
+    "adni_prompt_columnar": {
+        "prompt": f"""Give an example table of {{n_rows}} rows from {DATABASE_DESCRIPTION} Only consider patients with Alzheimer's Disease diagnosis. 
+        The table must have one row by patient, no missing values and include all the following columns: 
+{COL_PTID}: patient unique identifier, integer""" + """ 
+{variables_description}
+Return the table as a dictionary in JSON format with two keys: "columns", the list of the column names, and "rows", the list of the rows, each row being the list of its values in the order of the columns. JSON format strictly requires double quotes for strings. The column names need to be the same than those provided.
+Only return the dictionary, do not repeat the question, introduce your answer or comment on it. Do not truncate the table, provide all the rows.
+
+Here is an example for one patient of the dictionary to output: 
+
+{row_example_columnar}
+""",
+        "is_template": True,
+        "template_items": ["n_rows", "variables_description", "row_example_columnar"], 
+        "output_format": "json_columnar",
+        "enrichment_strategy": None,
+        "text2stats_prompt_id": None,
+        "input_stats_prompt_id": None,
+    }, 
+    "adni_prompt_csv": {
+        "prompt": f"""Give an example table of {{n_rows}} rows from {DATABASE_DESCRIPTION} Only consider patients with Alzheimer's Disease diagnosis. 
+        The table must have one row by patient, no missing values and include all the following columns: 
+{COL_PTID}: patient unique identifier, integer""" + """ 
+{variables_description}
+Return the table in CSV format: a first line with the column names, then one line per patient, with values separated by commas. The column names need to be the same than those provided.
+Only return the CSV table, do not repeat the question, introduce your answer or comment on it. Do not truncate the table, provide all the rows.
+
+Here is an example for one patient of the table to output: 
+
+{row_example_csv}
+""",
+        "is_template": True,
+        "template_items": ["n_rows", "variables_description", "row_example_csv"], 
+        "output_format": "csv",
         "enrichment_strategy": None,
         "text2stats_prompt_id": None,
         "input_stats_prompt_id": None,
     }, 
 }
 
+# LLM clients: one keep-alive connection pool per provider and api key
+# pool size should be at least MAX_CONCURRENCY so that concurrent queries reuse connections
+LLM_CLIENT_POOL_SIZE = 32
+LLM_CLIENT_KEEPALIVE_EXPIRY = 60 # seconds
+LLM_CLIENT_TIMEOUT = 120 # seconds
+LLM_CLIENT_CONNECT_TIMEOUT = 10 # seconds
+# retries of throttled or failed requests are handled by the request scheduler
+LLM_CLIENT_MAX_RETRIES = 0
+
+# rate limits of each model (requests and tokens per minute), to adapt to the account tier
+# models not listed are not rate limited by the scheduler
+LLM_RATE_LIMITS = {
+    "gpt-4-turbo": {"requests_per_minute": 500, "tokens_per_minute": 300000},
+    "gpt-3.5-turbo": {"requests_per_minute": 3500, "tokens_per_minute": 200000},
+    "mistral-large-latest": {"requests_per_minute": 300, "tokens_per_minute": 500000},
+}
+# prices of each model ($ per million prompt and completion tokens), to adapt to the
+# provider pricing. Queries to models not listed are not costed
+LLM_TOKEN_PRICES = {
+    "gpt-4-turbo": {"prompt": 10.0, "completion": 30.0},
+    "gpt-3.5-turbo": {"prompt": 0.5, "completion": 1.5},
+    "mistral-large-latest": {"prompt": 4.0, "completion": 12.0},
+}
+# local models run on CPU with transformers (see local_llm), by alias usable as SDG_MODEL
+LOCAL_LLM_MODELS = {
+    "local-qwen2.5-0.5b": "Qwen/Qwen2.5-0.5B-Instruct",
+    "local-qwen2.5-1.5b": "Qwen/Qwen2.5-1.5B-Instruct",
+}
+LOCAL_LLM_MAX_NEW_TOKENS = 2048
+# prompts generated per forward pass, and padded prompt tokens per forward pass
+LOCAL_LLM_MAX_BATCH_SIZE = 8
+LOCAL_LLM_MAX_BATCH_TOKENS = 16384
+# seconds waited for concurrent queries to fill a batch
+LOCAL_LLM_BATCH_WAIT = 0.05
+# threads of torch, None for its default (number of cores)
+LOCAL_LLM_NUM_THREADS = None
+# estimated number of completion tokens per generated row, used for the tokens budget
+LLM_COMPLETION_TOKENS_PER_ROW = 80
+LLM_MAX_RETRIES = 10
+LLM_BACKOFF_BASE = 1 # seconds
+LLM_BACKOFF_MAX = 60 # seconds
+
+# stream responses and parse rows as they are received (complete rows of truncated
+# or malformed responses are kept in both modes)
+LLM_STREAMING = True
+
+# sampling parameters sent with every request, e.g. {"temperature": 1.0, "top_p": 1.0}
+LLM_SAMPLING_PARAMS = dict()
+
+# table schema derived from the referential (columns, types, categories): json responses
+# of the models of LLM_STRUCTURED_OUTPUT_MODELS are constrained to it (structured outputs),
+# rows of all responses not matching it are dropped before process_chunk
+LLM_STRUCTURED_OUTPUT = False # True to constrain and validate rows (not part of the baseline protocol)
+# models accepting json_schema response formats (other models, e.g. gpt-4-turbo, answer 400)
+LLM_STRUCTURED_OUTPUT_MODELS = ["gpt-4o", "gpt-4o-mini", "gpt-4o-2024-08-06", "gpt-4o-2024-11-20",
+                                "gpt-4o-mini-2024-07-18", "gpt-4.1", "gpt-4.1-mini", "gpt-4.1-nano"]
+
+# rows of a response missing at most REPAIR_MAX_MISSING_FIELDS values are completed by a
+# follow-up prompt asking only for their missing values, instead of being dropped
+REPAIR_ENABLED = False # True to repair rows (not part of the baseline protocol)
+REPAIR_MAX_MISSING_FIELDS = 3
+REPAIR_PROMPT = """Some values of the following rows of synthetic patients are missing (null).
+Fill in each missing value with a realistic value, consistent with the other values of its row.
+Variables of the missing values:
+{variables_description}
+Rows:
+{rows}
+Answer only with a JSON dictionary whose keys are the keys of the rows and whose values are dictionaries of the filled values."""
+
+# mock of the providers (see mock_llm) answering with tables sampled from the referential,
+# to measure the generation offline (latency, throughput, robustness to faults).
+# Run with --mock-llm to enable it for a run
+LLM_MOCK_ENABLED = False
+LLM_MOCK_PARAMS = {
+    "time_to_first_token": 0.5, # seconds
+    "seconds_per_token": 0.01,
+    "latency_sigma": 0.3, # sigma of the lognormal noise of the latency
+    "truncation_rate": 0.02,
+    "malformed_rate": 0.02,
+    "rate_limit_rate": 0.02,
+    "retry_after": 1, # seconds
+    # prompt caching: prefixes of at least prompt_cache_min_tokens tokens cached by blocks of
+    # prompt_cache_block_tokens tokens, the time to first token being reduced by up to prompt_cache_speedup
+    "prompt_cache_min_tokens": 1024,
+    "prompt_cache_block_tokens": 128,
+    "prompt_cache_speedup": 0.5,
+    "seed": RANDOM_STATE,
+}
+
+# hedged queries: a query to SDG_MODEL not returned after the HEDGE_PERCENTILE percentile
+# of the latencies of its last HEDGE_WINDOW queries is duplicated to HEDGE_MODEL, the
+# first table returned wins. None to disable hedging
+HEDGE_MODEL = None
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 10
+HEDGE_WINDOW = 100
+
+# LLM responses cache: identical requests (model, role, prompt, sampling parameters,
+# run seed and request index) are served from disk. Each new run of a dataset path gets a new
+# nonce in its seed and draws new responses; runs with --replay (requests only served from
+# the cache) or --resume reuse the nonce of the last recorded run of the dataset path.
+# The cache therefore only serves --replay and --resume: a normal rerun never hits it.
+# The plan of each query (model, number of rows, prompt) is recorded with the responses
+# and read back by the replay, which sends the recorded queries in the recorded order.
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = "cache/llm_responses.sqlite"
+LLM_CACHE_MAX_SIZE = 1024 ** 3 # bytes
+
+# telemetry of LLM queries (tokens, latency, finish reason, parsing): one event per query
+# written to LLM_TELEMETRY_PATH (.csv or .parquet) and logged to mlflow with --log-mlflow
+LLM_TELEMETRY_ENABLED = True
+LLM_TELEMETRY_PATH = "telemetry/"
+LLM_TELEMETRY_FORMAT = "csv" # csv, parquet
+
+# batch generation (pipeline step text_to_tab_sdg_batch): all requests are submitted at once
+# as a batch job of the provider ("provider") or of a local file-based stand-in ("local")
+LLM_BATCH_BACKEND = "provider" # provider, local
+LLM_BATCH_PATH = "batches/"
+LLM_BATCH_OVERSAMPLING = 1.2 # rows requested / N_SAMPLE, to make up for invalid responses
+LLM_BATCH_POLL_INTERVAL = 60 # s
+LLM_BATCH_TIMEOUT = 24 * 3600 # s
+
 VAR_DESC_PROMPT_DICT = { 
     "template": "{var_name}: {var_desc}|{var_class}|{var_mapping}| {var_stats}",
     'mapping': {
@@ -257,6 +477,32 @@ VAR_DESC_PROMPT_DICT = {
     }
 }
 
+# prompt token budget: huggingface tokenizers approximating the tokenizer of each provider,
+# and maximum number of tokens of the prompt (None for no limit). Above the budget, the
+# variable descriptions are shortened down to PROMPT_BUDGET_DESC_WORDS words, then removed.
+PROMPT_BUDGET_TOKENIZERS = {"openai": "Xenova/gpt-4",
+                            "mistral": "mistralai/Mistral-7B-Instruct-v0.2"}
+PROMPT_TOKEN_BUDGET = None
+PROMPT_BUDGET_DESC_WORDS = 5
+
+# layout of the prompts for the prompt caching of the providers, which discounts and speeds
+# up the prompt prefixes shared with recent requests:
+# "inline": items in place in the template, the shuffled variables splitting the prompt
+# "prefix": invariant content first, the shuffled variables and the number of rows
+# appended at the end of the prompt (see PROMPT_PREFIX_LAYOUT)
+PROMPT_LAYOUT = "inline"
+PROMPT_PREFIX_LAYOUT = {
+    # text replacing the item in the template
+    "references": {"variables_description": "(the other columns are listed at the end of this message)",
+                   "n_rows": "N"},
+    # text appended to the template for the item, in this order
+    "suffix": {"variables_description": "\nColumns:\n{variables_description}\n",
+               "n_rows": "\nN = {n_rows}\n"},
+}
+# order of the shuffled variables drawn from a pool of PROMPT_PERMUTATION_POOL_SIZE fixed
+# permutations, so that prompts repeat (None for a new permutation per prompt)
+PROMPT_PERMUTATION_POOL_SIZE = None
+
 # =================================================
 # Evaluation
 # =================================================
@@ -0,0 +1,65 @@
+import sys
+import os
+import time
+import random
+import logging
+import pandas as pd
+import torch
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+import config as conf
+from src.logger import init_logger
+from src.prompt_engineering.local_llm import get_local_llm
+from src.prompt_engineering.prompt_text_to_tab import parse_table_response
+from src.prompt_engineering.utils_prompt import CompiledPrompt
+
+# local model, numbers of threads of torch and of prompts per forward pass compared
+MODEL = "local-qwen2.5-0.5b"
+LIST_NUM_THREADS = [1, 2, 4, os.cpu_count()]
+LIST_BATCH_SIZE = [1, 4, 8]
+N_PROMPTS = 8
+
+
+def benchmark(model: str, prompts: list, num_threads: int, batch_size: int) -> dict:
+    """Throughput of the local model generating the responses of the prompts"""
+    torch.set_num_threads(num_threads)
+    conf.LOCAL_LLM_MAX_BATCH_SIZE = batch_size
+    llm = get_local_llm(model)
+    start_time = time.monotonic()
+    responses = llm.generate(prompts)
+    elapsed = time.monotonic() - start_time
+    completion_tokens = sum(usage["completion_tokens"] for _, usage in responses)
+    n_valid_rows = 0
+    for msg, _ in responses:
+        df = parse_table_response(msg)
+        n_valid_rows += 0 if df is None else len(df)
+    return {"num_threads": num_threads,
+            "batch_size": batch_size,
+            "seconds": elapsed,
+            "completion_tokens_per_second": completion_tokens / elapsed,
+            "valid_rows_per_second": n_valid_rows / elapsed}
+
+
+def main():
+    init_logger(level="INFO", file=False)
+    random.seed(conf.RANDOM_STATE)
+    compiled_prompt = CompiledPrompt(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
+                                     prompt_example=conf.ROW_EXAMPLE,
+                                     var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                     ref_key=conf.REFERENTIAL_VAR_NAME)
+    prompts = [compiled_prompt.render(n_rows=conf.N_ROWS, shuffle=True) for _ in range(N_PROMPTS)]
+    # model loaded before timing
+    get_local_llm(MODEL)
+    df_benchmark = pd.DataFrame([benchmark(model=MODEL,
+                                           prompts=prompts,
+                                           num_threads=num_threads,
+                                           batch_size=batch_size)
+                                 for num_threads in sorted(set(LIST_NUM_THREADS))
+                                 for batch_size in LIST_BATCH_SIZE])
+    logging.info(f"Local model {MODEL}, {N_PROMPTS} prompts of {conf.N_ROWS} rows:\n{df_benchmark.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import sys
+import os
+import time
+import random
+import logging
+import pandas as pd
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+import config as conf
+from src.logger import init_logger
+from src.prompt_engineering.prompt_text_to_tab import prompt_synth_tab
+from src.prompt_engineering.prompt_text_to_tab import parse_table_response
+from src.prompt_engineering.utils_prompt import CompiledPrompt, format_row_example
+from src.prompt_engineering.scheduler import estimate_n_tokens
+from src.prompt_engineering.telemetry import TelemetryCollector, set_telemetry_collector
+
+# prompts asking for the same table in each output format
+PROMPT_IDS = ["adni_prompt", "adni_prompt_columnar", "adni_prompt_csv"]
+N_SAMPLE = 100
+
+
+def compare_offline(n_rows: int) -> pd.DataFrame:
+    """Size of the same table of n_rows rows written in each output format"""
+    row = next(iter(conf.ROW_EXAMPLE.values()))
+    table = {str(i): row for i in range(n_rows)}
+    texts = {"json": pd.Series(table).to_json(),
+             "json_columnar": format_row_example(table, output_format="json_columnar"),
+             "csv": format_row_example(table, output_format="csv")}
+    comparison = []
+    for output_format, text in texts.items():
+        df = parse_table_response(text, output_format=output_format)
+        comparison.append({"output_format": output_format,
+                           "n_valid_rows": len(df),
+                           "estimated_tokens_per_row": estimate_n_tokens(text) / len(df)})
+    return pd.DataFrame(comparison)
+
+
+def compare_online(model: str, n_rows: int, n_sample: int) -> pd.DataFrame:
+    """Tokens and seconds per valid row of the model for each output format"""
+    comparison = []
+    for prompt_id in PROMPT_IDS:
+        prompt_dict = conf.TEXT2TAB_PROMPT_DICT[prompt_id]
+        if prompt_dict["output_format"] == "csv" and "mistral" in model:
+            # mistral models are queried in JSON mode
+            continue
+        compiled_prompt = CompiledPrompt(prompt_dict=prompt_dict,
+                                         prompt_example=conf.ROW_EXAMPLE,
+                                         var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                         ref_key=conf.REFERENTIAL_VAR_NAME)
+        telemetry = TelemetryCollector()
+        set_telemetry_collector(telemetry)
+        start_time = time.monotonic()
+        prompt_synth_tab(prompt=lambda n: compiled_prompt.render(n_rows=n, shuffle=True),
+                         model=model,
+                         n_rows=n_rows,
+                         n_sample=n_sample,
+                         max_concurrency=conf.MAX_CONCURRENCY,
+                         output_format=prompt_dict["output_format"])
+        elapsed = time.monotonic() - start_time
+        summary = telemetry.get_summary(elapsed=elapsed)
+        comparison.append({"output_format": prompt_dict["output_format"],
+                           "n_valid_rows": summary["n_valid_rows"],
+                           "parse_rate": summary["parse_rate"],
+                           "completion_tokens_per_valid_row": summary["completion_tokens"] / max(summary["n_valid_rows"], 1),
+                           "tokens_per_valid_row": summary["tokens_per_valid_row"],
+                           "seconds_per_valid_row": elapsed / max(summary["n_valid_rows"], 1)})
+    set_telemetry_collector(None)
+    return pd.DataFrame(comparison)
+
+
+def main():
+    init_logger(level="INFO", file=False)
+    random.seed(conf.RANDOM_STATE)
+    logging.info(f"Output formats, size of the row example:\n{compare_offline(conf.N_ROWS).to_string(index=False)}")
+    df_comparison = compare_online(model=conf.SDG_MODEL, n_rows=conf.N_ROWS, n_sample=N_SAMPLE)
+    logging.info(f"Output formats, {conf.SDG_MODEL}:\n{df_comparison.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
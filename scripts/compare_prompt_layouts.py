@@ -0,0 +1,96 @@
+import sys
+import os
+import time
+import random
+import logging
+import pandas as pd
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+import config as conf
+from src.logger import init_logger
+from src.loading import load_variables_referential_dict
+from src.prompt_engineering.prompt_text_to_tab import prompt_synth_tab
+from src.prompt_engineering.utils_prompt import CompiledPrompt
+from src.prompt_engineering.scheduler import estimate_n_tokens
+from src.prompt_engineering.telemetry import TelemetryCollector, set_telemetry_collector
+from src.prompt_engineering.table_schema import get_row_schema
+from src.prompt_engineering.mock_llm import MockLLM, set_mock_llm
+
+# layouts of the prompts compared: layout and size of the pool of permutations of the variables
+LAYOUTS = [("inline", None), ("inline", 4), ("prefix", None), ("prefix", 4)]
+N_SAMPLE = 200
+N_PROMPTS = 50
+
+
+def compile_prompt(layout: str, n_permutations: int) -> CompiledPrompt:
+    return CompiledPrompt(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
+                          prompt_example=conf.ROW_EXAMPLE,
+                          var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                          ref_key=conf.REFERENTIAL_VAR_NAME,
+                          layout=layout,
+                          n_permutations=n_permutations)
+
+
+def compare_offline(n_rows: int, n_prompts: int) -> pd.DataFrame:
+    """Tokens of the prompts shared with the longest matching prefix of the previous prompts"""
+    comparison = []
+    for layout, n_permutations in LAYOUTS:
+        compiled_prompt = compile_prompt(layout=layout, n_permutations=n_permutations)
+        prompts = compiled_prompt.render_batch(n_prompts=n_prompts, n_rows=n_rows, shuffle=True)
+        shared_tokens = [max(estimate_n_tokens(os.path.commonprefix([prompt, previous])) - 1 for previous in prompts[:i])
+                         for i, prompt in enumerate(prompts) if i > 0]
+        comparison.append({"layout": layout,
+                           "n_permutations": n_permutations,
+                           "prompt_tokens": estimate_n_tokens(prompts[0]),
+                           "mean_shared_prefix_tokens": sum(shared_tokens) / len(shared_tokens)})
+    return pd.DataFrame(comparison)
+
+
+def compare_online(model: str, n_rows: int, n_sample: int) -> pd.DataFrame:
+    """Share of the prompt tokens served from the prompt cache of the provider and latency
+    of the queries of the model for each layout"""
+    comparison = []
+    for layout, n_permutations in LAYOUTS:
+        compiled_prompt = compile_prompt(layout=layout, n_permutations=n_permutations)
+        telemetry = TelemetryCollector()
+        set_telemetry_collector(telemetry)
+        start_time = time.monotonic()
+        prompt_synth_tab(prompt=lambda n: compiled_prompt.render(n_rows=n, shuffle=True),
+                         model=model,
+                         n_rows=n_rows,
+                         n_sample=n_sample,
+                         max_concurrency=conf.MAX_CONCURRENCY,
+                         show_progress=False,
+                         output_format=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID].get("output_format", "json"))
+        elapsed = time.monotonic() - start_time
+        summary = telemetry.get_summary(elapsed=elapsed)
+        comparison.append({"layout": layout,
+                           "n_permutations": n_permutations,
+                           "n_queries": summary["n_queries"],
+                           "cached_prompt_token_ratio": summary["cached_prompt_token_ratio"],
+                           "mean_latency": summary["mean_latency"],
+                           "rows_per_second": summary["rows_per_second"]})
+    set_telemetry_collector(None)
+    df_comparison = pd.DataFrame(comparison)
+    # latency relative to the inline layout with a new permutation per prompt
+    df_comparison["latency_change"] = df_comparison["mean_latency"] / df_comparison["mean_latency"].iloc[0] - 1
+    return df_comparison
+
+
+def main():
+    init_logger(level="INFO", file=False)
+    random.seed(conf.RANDOM_STATE)
+    logging.info(f"Prompt layouts, shared prefixes:\n{compare_offline(conf.N_ROWS, N_PROMPTS).to_string(index=False)}")
+    if conf.LLM_MOCK_ENABLED:
+        list_cols = [col for col in conf.LIST_FTR if col not in conf.LIST_FTR_RM]
+        set_mock_llm(MockLLM(row_schema=get_row_schema(list_cols=list_cols, ref_var=load_variables_referential_dict()),
+                             row_example=next(iter(conf.ROW_EXAMPLE.values())),
+                             output_format=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID].get("output_format", "json")))
+    df_comparison = compare_online(model=conf.SDG_MODEL, n_rows=conf.N_ROWS, n_sample=N_SAMPLE)
+    logging.info(f"Prompt layouts, {conf.SDG_MODEL}:\n{df_comparison.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
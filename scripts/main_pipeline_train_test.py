@@ -74,7 +74,7 @@ def main():
                         # update pbar only when synthetic data is generated (longest step)
                         pbar.update(1)    
                         
-                    elif step == "text_to_tab_sdg_shuffle":
+                    elif step == "text_to_tab_sdg_shuffle" or step == "text_to_tab_sdg_batch":
                         # update pbar only when synthetic data is generated (longest step)
                         pbar.update(1)  
                         
@@ -0,0 +1,61 @@
+import sys
+import os
+import logging
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+import config as conf
+from src.parsers.pipeline_parser import pipeline_parser
+from src.logger import init_logger
+from src.prompt_engineering.utils_prompt import CompiledPrompt
+from src.prompt_engineering.prompt_budget import get_tokenizer, get_prompt_budget
+from src.prompt_engineering.prompt_budget import compile_prompt_under_budget
+
+
+def main():
+
+    # Initiate parser
+    parser = pipeline_parser()
+    args = parser.parse_args()
+
+    # Initiate logger
+    init_logger(level=args.log_level, file=True, file_path="logs/logs.txt")
+    logging.info("-----Prompt token budget-----")
+    logging.info(f"Model: {conf.SDG_MODEL}")
+    logging.info(f"Prompt ID: {conf.PROMPT_ID}")
+
+    prompt_dict = conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID]
+    tokenizer = get_tokenizer(conf.SDG_MODEL)
+    compiled_prompt = CompiledPrompt(prompt_dict=prompt_dict,
+                                     prompt_example=conf.ROW_EXAMPLE,
+                                     var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                     ref_key=conf.REFERENTIAL_VAR_NAME)
+    df_budget = get_prompt_budget(compiled_prompt=compiled_prompt,
+                                  prompt_dict=prompt_dict,
+                                  prompt_example=conf.ROW_EXAMPLE,
+                                  n_rows=conf.N_ROWS,
+                                  tokenizer=tokenizer)
+    logging.info(f"Tokens of prompt {conf.PROMPT_ID} for {conf.N_ROWS} rows:\n{df_budget.to_string(index=False)}")
+
+    # compacted prompt under the token budget
+    if conf.PROMPT_TOKEN_BUDGET is not None:
+        compiled_prompt = compile_prompt_under_budget(prompt_dict=prompt_dict,
+                                                      prompt_example=conf.ROW_EXAMPLE,
+                                                      var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                                      ref_key=conf.REFERENTIAL_VAR_NAME,
+                                                      n_rows=conf.N_ROWS,
+                                                      token_budget=conf.PROMPT_TOKEN_BUDGET,
+                                                      tokenizer=tokenizer)
+        df_budget = get_prompt_budget(compiled_prompt=compiled_prompt,
+                                      prompt_dict=prompt_dict,
+                                      prompt_example=conf.ROW_EXAMPLE,
+                                      n_rows=conf.N_ROWS,
+                                      tokenizer=tokenizer)
+        logging.info(f"Tokens of compacted prompt:\n{df_budget.to_string(index=False)}")
+        logging.info(f"Compacted prompt:\n{compiled_prompt.render(n_rows=conf.N_ROWS)}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -30,13 +30,14 @@ def main():
                             prompt_example=conf.ROW_EXAMPLE,
                             var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
                             ref_key=conf.REFERENTIAL_VAR_NAME,
-                            shuffle=True)
+                            shuffle=True,
+                            n_rows=conf.N_ROWS)
 
-    df_synth = prompt_synth_tab(api_key=conf.OPENAPI_KEY,
-                     prompt=prompt,
+    df_synth = prompt_synth_tab(prompt=prompt,
                      model=conf.SDG_MODEL,
                      n_rows=conf.N_ROWS,
-                     n_sample=conf.N_SAMPLE,)
+                     n_sample=conf.N_SAMPLE,
+                     max_concurrency=conf.MAX_CONCURRENCY)
     if args.save:
         # saving data
         save_csv(df_synth,
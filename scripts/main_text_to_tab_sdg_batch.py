@@ -0,0 +1,142 @@
+import sys
+import os
+import random
+import logging
+import pandas as pd
+from datetime import datetime
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+import config as conf
+from src.parsers.pipeline_parser import pipeline_parser
+from src.logger import init_logger
+from src.loading import save_csv, save_text, load_variables_referential_dict
+from src.prompt_engineering.batch_text_to_tab import batch_synth_tab
+from src.prompt_engineering.batch_text_to_tab import LocalBatchBackend, get_example_responder
+from src.prompt_engineering.utils_prompt import CompiledPrompt
+from src.prompt_engineering.duplicate_index import DuplicateRowIndex
+from src.prompt_engineering.table_schema import get_row_schema
+from src.utils import utils_df
+
+
+def main():
+
+    # Initiate parser
+    parser = pipeline_parser()
+    args = parser.parse_args()
+
+    # Initiate logger
+    init_logger(level=args.log_level, file=True, file_path="logs/logs.txt")
+    logging.info("-----Text to tabular SDG with a batch job-----")
+    logging.info(f"Model: {conf.SDG_MODEL}")
+    logging.info(f"Size of synthetic database: {conf.N_SAMPLE}")
+    logging.info(f"Prompt ID: {conf.PROMPT_ID}")
+    logging.info(f"Batch backend: {conf.LLM_BATCH_BACKEND}")
+
+    # path of the synthetic dataset, also identifying the run
+    if args.synth_dataset and args.synth_dataset != 'None':
+        path_file = args.synth_dataset
+    else:
+        path_file = os.path.join(conf.PATH_SYNTH_DATA, conf.FILE_SYNTHESIZED_DATA)
+
+    # seed of the run: shuffled prompts are reproducible
+    seed = f"{conf.RANDOM_STATE}_{path_file}"
+    random.seed(seed)
+
+    start_time = datetime.now()
+    list_cols = conf.LIST_FTR
+
+    # remove columns from original data not synthetisize
+    for col in conf.LIST_FTR_RM:
+        list_cols.remove(col)
+
+    # variable descriptions are rendered once, each query only shuffles their order
+    compiled_prompt = CompiledPrompt(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
+                                     prompt_example=conf.ROW_EXAMPLE,
+                                     var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                     ref_key=conf.REFERENTIAL_VAR_NAME,
+                                     layout=conf.PROMPT_LAYOUT,
+                                     n_permutations=conf.PROMPT_PERMUTATION_POOL_SIZE)
+    
+    # generator of the shuffling only, so that the prompts of the run do not depend on
+    # other draws
+    prompt_rng = random.Random(seed)
+    
+    def parse_shuffled_prompt(n_rows: int=conf.N_ROWS):
+        # parse prompt by shuffling order of variables
+        return compiled_prompt.render(n_rows=n_rows, shuffle=True, rng=prompt_rng)
+
+    def process_chunk(df_synth_int: pd.DataFrame):
+        # verify that the dataframe contains all expected columns
+        all_cols_in_list_bool = all(col in df_synth_int.columns for col in list_cols)
+        if not all_cols_in_list_bool:
+            return None
+
+        # remove missing values if any
+        df_synth_int = utils_df.rm_null_rows(df=df_synth_int)
+
+        # reorder columns of synthetic dataframe
+        return df_synth_int[list_cols]
+
+    # duplicated patients are not counted in the sample
+    duplicate_index = None
+    if conf.DUPLICATE_DETECTION:
+        duplicate_index = DuplicateRowIndex(ignore_columns=[conf.COL_PTID, conf.COL_SOURCE_MODEL],
+                                            significant_digits=conf.DUPLICATE_SIGNIFICANT_DIGITS)
+
+    # schema of the rows validated, typed from the referential
+    row_schema = None
+    if conf.LLM_STRUCTURED_OUTPUT:
+        row_schema = get_row_schema(list_cols=list_cols,
+                                    ref_var=load_variables_referential_dict())
+
+    output_format = conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID].get("output_format", "json")
+
+    # batch files of the run
+    path_batch = os.path.join(conf.LLM_BATCH_PATH, os.path.splitext(path_file)[0])
+    backend = None
+    if conf.LLM_BATCH_BACKEND == "local":
+        backend = LocalBatchBackend(path=os.path.join(conf.LLM_BATCH_PATH, "local_jobs"),
+                                    respond=get_example_responder(conf.ROW_EXAMPLE,
+                                                                  conf.N_ROWS,
+                                                                  output_format=output_format))
+
+    # prompt all synthetic datasets of n_rows in one batch job, with shuffled prompts
+    df_synth = batch_synth_tab(prompt=parse_shuffled_prompt,
+                               model=conf.SDG_MODEL,
+                               n_rows=conf.N_ROWS,
+                               n_sample=conf.N_SAMPLE,
+                               path=path_batch,
+                               process_chunk=process_chunk,
+                               backend=backend,
+                               output_format=output_format,
+                               oversampling=conf.LLM_BATCH_OVERSAMPLING,
+                               poll_interval=conf.LLM_BATCH_POLL_INTERVAL,
+                               timeout=conf.LLM_BATCH_TIMEOUT,
+                               row_schema=row_schema,
+                               duplicate_index=duplicate_index)
+
+    prompt = parse_shuffled_prompt()
+    time = datetime.now() - start_time
+    text_time = f"Execution time: {time}"
+    logging.info(text_time)
+
+    # saving data
+    if args.save:
+        save_csv(df_synth,
+                         conf.BUCKET_NAME,
+                         path_file=path_file)
+        save_text(prompt,
+                conf.BUCKET_NAME,
+                conf.PATH_SYNTH_DATA,
+                conf.FILE_SYNTHESIZED_DATA_PROMPT,
+                )
+        save_text(text_time,
+                conf.BUCKET_NAME,
+                conf.PATH_SYNTH_DATA,
+                conf.FILE_SYNTHESIZED_DATA_TIME,
+                )
+if __name__ == "__main__":
+
+    main()
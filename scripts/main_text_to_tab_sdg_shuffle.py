@@ -1,8 +1,9 @@
 import sys
 import os
+import random
 import logging
+import mlflow
 import pandas as pd
-from tqdm import tqdm
 from datetime import datetime
 
 script_dir = os.path.dirname(os.path.abspath("src/"))
@@ -11,10 +12,24 @@ sys.path.append(script_dir)
 import config as conf
 from src.parsers.pipeline_parser import pipeline_parser
 from src.logger import init_logger
-from src.loading import save_csv, save_text
-from src.prompt_engineering.prompt_text_to_tab import prompt_synth_tab
-from src.prompt_engineering.utils_prompt import parse_prompt
+from src.loading import save_csv, save_text, read_dict, load_variables_referential_dict
+from src.prompt_engineering.prompt_text_to_tab import prompt_synth_tab, GenerationOptions
+from src.prompt_engineering.utils_prompt import CompiledPrompt
+from src.prompt_engineering.prompt_budget import compile_prompt_under_budget, get_tokenizer
+from src.prompt_engineering.llm_cache import LLMResponseCache, set_response_cache
+from src.prompt_engineering.checkpoint import GenerationCheckpoint
+from src.prompt_engineering.batch_size_controller import BatchSizeController
+from src.prompt_engineering.duplicate_index import DuplicateRowIndex
+from src.prompt_engineering.telemetry import TelemetryCollector, set_telemetry_collector
+from src.prompt_engineering.table_schema import get_row_schema
+from src.prompt_engineering.repair import RowRepairer
+from src.prompt_engineering.mock_llm import MockLLM, set_mock_llm
+from src.prompt_engineering.hedging import RequestHedger
+from src.prompt_engineering.model_router import ModelRouter
+from src.modelling.hybrid_copula import get_hybrid_split, amplify_with_copula
+from src.prompt_engineering.steering import DistributionSteerer, get_steering_targets
 from src.utils import utils_df
+from src.utils.utils_sdv import get_metadata_from_dict
 
 
 def main():
@@ -30,62 +45,201 @@ def main():
     logging.info(f"Size of synthetic database: {conf.N_SAMPLE}")
     logging.info(f"Prompt ID: {conf.PROMPT_ID}")
     
+    # path of the synthetic dataset, also identifying the run
+    if args.synth_dataset and args.synth_dataset != 'None':
+        path_file = args.synth_dataset
+    else:
+        path_file = os.path.join(conf.PATH_SYNTH_DATA, conf.FILE_SYNTHESIZED_DATA)
+    
+    # seed of the run: shuffled prompts are reproducible and responses can be served
+    # from the cache when the run is replayed
+    seed = f"{conf.RANDOM_STATE}_{path_file}"
+    # mock responses are not cached
+    use_mock = conf.LLM_MOCK_ENABLED or args.mock_llm
+    cache = None
+    if (conf.LLM_CACHE_ENABLED or args.replay) and not use_mock:
+        cache = LLMResponseCache(path=conf.LLM_CACHE_PATH,
+                                 max_size=conf.LLM_CACHE_MAX_SIZE,
+                                 replay=args.replay)
+        set_response_cache(cache)
+        # each new run of the dataset path draws new responses (e.g. the runs of a train/test
+        # split), replayed and resumed runs reuse the nonce of its last recorded run
+        seed = f"{seed}_{cache.get_run_nonce(run=seed, new=not (args.replay or args.resume))}"
+        logging.info(f"LLM responses cache: {conf.LLM_CACHE_PATH} (replay: {args.replay}, seed: {seed})")
+    random.seed(seed)
+    
+    # one telemetry event recorded per LLM query
+    telemetry = None
+    if conf.LLM_TELEMETRY_ENABLED:
+        telemetry = TelemetryCollector()
+        set_telemetry_collector(telemetry)
+    
+    # accepted chunks are checkpointed as they arrive
+    checkpoint = GenerationCheckpoint(path=os.path.join(conf.PATH_CHECKPOINT,
+                                                        os.path.splitext(path_file)[0]))
+    if not args.resume and checkpoint.n_rows:
+        logging.info(f"Checkpoint {checkpoint.path} discarded, run with --resume to resume from it")
+        checkpoint.clear()
+    
     start_time = datetime.now()
-    synth_data = []
     list_cols = conf.LIST_FTR
     
     # remove columns from original data not synthetisize
     for col in conf.LIST_FTR_RM:
         list_cols.remove(col)
-    pbar = tqdm(total=conf.N_SAMPLE, desc="Synth data queries")
     
-    # number of total rows in synthetic dataframe
-    n_synth = 0
-    while n_synth < conf.N_SAMPLE:
+    # variable descriptions are rendered once, each query only shuffles their order
+    if conf.PROMPT_TOKEN_BUDGET is None:
+        compiled_prompt = CompiledPrompt(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
+                                         prompt_example=conf.ROW_EXAMPLE,
+                                         var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                         ref_key=conf.REFERENTIAL_VAR_NAME,
+                                         layout=conf.PROMPT_LAYOUT,
+                                         n_permutations=conf.PROMPT_PERMUTATION_POOL_SIZE)
+    else:
+        compiled_prompt = compile_prompt_under_budget(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
+                                                      prompt_example=conf.ROW_EXAMPLE,
+                                                      var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
+                                                      ref_key=conf.REFERENTIAL_VAR_NAME,
+                                                      n_rows=conf.N_ROWS,
+                                                      token_budget=conf.PROMPT_TOKEN_BUDGET,
+                                                      tokenizer=get_tokenizer(conf.SDG_MODEL),
+                                                      layout=conf.PROMPT_LAYOUT,
+                                                      n_permutations=conf.PROMPT_PERMUTATION_POOL_SIZE)
+    
+    # generator of the shuffling only, so that the prompts of the run do not depend on
+    # other draws (e.g. the jitter of the retries)
+    prompt_rng = random.Random(seed)
+    
+    def parse_shuffled_prompt(n_rows: int=conf.N_ROWS):
         # parse prompt by shuffling order of variables
-        prompt = parse_prompt(prompt_dict=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID],
-                            prompt_example=conf.ROW_EXAMPLE,
-                            var_desc_prompt_dict=conf.VAR_DESC_PROMPT_DICT,
-                            ref_key=conf.REFERENTIAL_VAR_NAME,
-                            shuffle=True)   
-             
-        # prompt a synthetic dataset of n_rows
-        df_synth_int = prompt_synth_tab(prompt=prompt,
-                        model=conf.SDG_MODEL,
-                        n_rows=conf.N_ROWS,
-                        n_sample=conf.N_ROWS,
-                        show_progress=False)
-        
+        return compiled_prompt.render(n_rows=n_rows, shuffle=True, rng=prompt_rng)
+    
+    # number of rows per query adapted to the model (in replay, the model, rows and prompt
+    # of each query are read from the plan of the recorded run, see aprompt_synth_tab)
+    controller = None
+    if conf.N_ROWS_ADAPTIVE:
+        controller = BatchSizeController(candidates=conf.N_ROWS_CANDIDATES,
+                                         initial=conf.N_ROWS,
+                                         seed=seed)
+    
+    # duplicated patients are not counted in the sample
+    duplicate_index = None
+    if conf.DUPLICATE_DETECTION:
+        duplicate_index = DuplicateRowIndex(ignore_columns=[conf.COL_PTID, conf.COL_SOURCE_MODEL],
+                                            significant_digits=conf.DUPLICATE_SIGNIFICANT_DIGITS)
+    
+    # schema of the rows requested, typed from the referential
+    row_schema = None
+    if conf.LLM_STRUCTURED_OUTPUT:
+        row_schema = get_row_schema(list_cols=list_cols,
+                                    ref_var=load_variables_referential_dict())
+    
+    # requests served by a mock of the providers, answering with rows of the schema
+    mock = None
+    if use_mock:
+        mock = MockLLM(row_schema=row_schema or get_row_schema(list_cols=list_cols,
+                                                               ref_var=load_variables_referential_dict()),
+                       row_example=next(iter(conf.ROW_EXAMPLE.values())),
+                       output_format=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID].get("output_format", "json"))
+        set_mock_llm(mock)
+    
+    # rows with a few missing values are completed instead of dropped
+    repairer = None
+    if conf.REPAIR_ENABLED:
+        repairer = RowRepairer(columns=list_cols,
+                               variable_lines=dict(zip(compiled_prompt.variable_names,
+                                                       compiled_prompt.variable_lines)))
+    
+    # slow queries duplicated to a secondary model
+    hedger = None
+    if conf.HEDGE_MODEL is not None:
+        hedger = RequestHedger(secondary_model=conf.HEDGE_MODEL,
+                               max_concurrency=conf.MAX_CONCURRENCY)
+    
+    # queries distributed across a pool of models
+    router = None
+    if conf.ROUTER_MODELS is not None:
+        router = ModelRouter(models=conf.ROUTER_MODELS, seed=seed)
+    
+    # queries conditioned on the under-filled strata of the target distributions
+    steerer = None
+    if conf.STEERING_ENABLED:
+        steerer = DistributionSteerer(targets=get_steering_targets(targets=conf.STEERING_TARGETS,
+                                                                   ref_var=load_variables_referential_dict()),
+                                      seed=seed)
+    
+    def process_chunk(df_synth_int: pd.DataFrame):
         # verify that the dataframe contains all expected columns 
         all_cols_in_list_bool = all(col in df_synth_int.columns for col in list_cols)
-        if all_cols_in_list_bool:
-
-            # remove missing values if any 
-            df_synth_int = utils_df.rm_null_rows(df=df_synth_int)
-            
-            # reorder columns of synthetic dataframe
-            df_synth_int = df_synth_int[list_cols]
-            synth_data.append(df_synth_int)
-            n_synth += len(df_synth_int)
-            pbar.update(n_synth)
-    pbar.close()
-   
-    df_synth = pd.concat(synth_data, axis=0)
+        if not all_cols_in_list_bool:
+            return None
+        
+        # remove missing values if any 
+        df_synth_int = utils_df.rm_null_rows(df=df_synth_int)
+        
+        # reorder columns of synthetic dataframe
+        return df_synth_int[list_cols]
+    
+    # in hybrid mode, the LLM only generates the seed rows of a copula sampling the others
+    n_llm_rows, n_copula_rows = conf.N_SAMPLE, 0
+    if conf.HYBRID_ENABLED:
+        n_llm_rows, n_copula_rows = get_hybrid_split(n_sample=conf.N_SAMPLE)
+        logging.info(f"Hybrid generation: {n_llm_rows} LLM rows, {n_copula_rows} copula rows")
+    
+    # prompt synthetic datasets of n_rows with a new shuffled prompt for each query
+    df_synth = prompt_synth_tab(prompt=parse_shuffled_prompt,
+                                model=conf.SDG_MODEL,
+                                n_rows=conf.N_ROWS,
+                                n_sample=n_llm_rows,
+                                max_concurrency=conf.MAX_CONCURRENCY,
+                                process_chunk=process_chunk,
+                                seed=seed,
+                                stream=conf.LLM_STREAMING,
+                                output_format=conf.TEXT2TAB_PROMPT_DICT[conf.PROMPT_ID].get("output_format", "json"),
+                                row_schema=row_schema,
+                                options=GenerationOptions(checkpoint=checkpoint,
+                                                          controller=controller,
+                                                          duplicate_index=duplicate_index,
+                                                          repairer=repairer,
+                                                          hedger=hedger,
+                                                          router=router,
+                                                          steerer=steerer,
+                                                          telemetry=telemetry))
+    if cache is not None:
+        logging.info(f"LLM responses cache stats: {cache.stats}")
+    if mock is not None:
+        logging.info(f"LLM mock stats: {mock.stats}")
+    if telemetry is not None:
+        os.makedirs(conf.LLM_TELEMETRY_PATH, exist_ok=True)
+        file_telemetry = f"{os.path.splitext(os.path.basename(path_file))[0]}.{conf.LLM_TELEMETRY_FORMAT}"
+        telemetry.flush(os.path.join(conf.LLM_TELEMETRY_PATH, file_telemetry))
+        if args.log_mlflow:
+            mlflow.set_tracking_uri(uri=conf.MLFLOW_URI)
+            mlflow.set_experiment(experiment_name="llm_telemetry")
+            with mlflow.start_run(run_name=f"{conf.SDG_MODEL}"):
+                mlflow.log_param("synth_dataset", path_file)
+                mlflow.log_params({"n_llm_rows": n_llm_rows, "n_copula_rows": n_copula_rows})
+                telemetry.log_mlflow()
+    
+    llm_time = datetime.now() - start_time
+    if conf.HYBRID_ENABLED:
+        # copula fit with the metadata of the dataset, as the evaluation
+        dict_metadata = read_dict(conf.BUCKET_NAME, os.path.join(conf.PATH_METADATA, conf.FILE_METADATA))
+        df_synth = amplify_with_copula(df_seed=df_synth,
+                                       n_rows=n_copula_rows,
+                                       sdv_metadata=get_metadata_from_dict(dict_metadata=dict_metadata),
+                                       ignore_columns=[conf.COL_SOURCE_MODEL])
     
-    # resample the desired size of sample if more
-    df_synth = df_synth[:conf.N_SAMPLE]
+    prompt = parse_shuffled_prompt()
     time = datetime.now() - start_time
     text_time = f"Execution time: {time}"
+    if conf.HYBRID_ENABLED:
+        text_time += f"\nLLM time: {llm_time}\nRows: {n_llm_rows} LLM, {n_copula_rows} copula"
     logging.info(text_time)
     
     # saving data
     if args.save:
-        if args.synth_dataset:
-                
-                if args.synth_dataset != 'None':
-                    path_file = args.synth_dataset
-                else:
-                    path_file = os.path.join(conf.PATH_SYNTH_DATA, conf.FILE_SYNTHESIZED_DATA)
         save_csv(df_synth,
                          conf.BUCKET_NAME,
                          path_file=path_file)
@@ -99,6 +253,7 @@ def main():
                 conf.PATH_SYNTH_DATA, 
                 conf.FILE_SYNTHESIZED_DATA_TIME,
                 )
+        checkpoint.clear()
 if __name__ == "__main__":
     
     main()
\ No newline at end of file
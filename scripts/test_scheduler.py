@@ -0,0 +1,56 @@
+import sys
+import os
+import time
+import random
+import asyncio
+
+script_dir = os.path.dirname(os.path.abspath("src/"))
+sys.path.append(script_dir)
+
+from src.prompt_engineering.scheduler import RequestScheduler, RateLimitError
+
+
+class StubProvider:
+    """Local stand-in of a provider accepting at most capacity requests at once:
+    requests above capacity are answered by a 429 with a Retry-After delay"""
+
+    def __init__(self, capacity: int, latency: float, retry_after: float):
+        self.capacity = capacity
+        self.latency = latency
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.n_throttled = 0
+
+    async def call(self):
+        if self.in_flight >= self.capacity:
+            self.n_throttled += 1
+            raise RateLimitError("Too many requests", retry_after=self.retry_after)
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        finally:
+            self.in_flight -= 1
+        return "ok"
+
+
+async def run(n_requests: int, max_concurrency: int):
+    provider = StubProvider(capacity=4, latency=0.2, retry_after=0.1)
+    scheduler = RequestScheduler(max_concurrency=max_concurrency,
+                                 requests_per_minute=6000,
+                                 backoff_base=0.05)
+    start_time = time.monotonic()
+    results = await asyncio.gather(*[scheduler.submit(provider.call) for _ in range(n_requests)])
+    elapsed = time.monotonic() - start_time
+
+    print(f"{len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.1f} req/s)")
+    print(f"429 emitted by stub: {provider.n_throttled}")
+    print(f"Final concurrency: {scheduler.concurrency:.1f}")
+    print(f"Scheduler stats: {scheduler.stats}")
+
+
+def main():
+    asyncio.run(run(n_requests=200, max_concurrency=16))
+
+
+if __name__ == "__main__":
+    main()
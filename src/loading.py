@@ -4,11 +4,13 @@ import logging
 import pickle
 import boto3
 import os
+import threading
 import matplotlib
 import plotly
 import pickle
 import pandas as pd
 from io import BytesIO
+from types import MappingProxyType
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 from typing import Optional
 
@@ -232,16 +234,48 @@ def save_model(model,
 
 # Referentials # 
 
+# process-wide cache of the referential sheets: {(path, sheet_name): (mtime, df, dict view)}
+# so that the excel file is parsed once, and again only when it is modified
+_REFERENTIAL_CACHE = dict()
+_REFERENTIAL_CACHE_LOCK = threading.Lock()
+
+
+def _freeze_referential_dict(ref_dict: dict) -> MappingProxyType:
+    """Read-only view of a referential dictionary and of its rows"""
+    return MappingProxyType({k: MappingProxyType(v) for k, v in ref_dict.items()})
+
+
+def _load_referential_sheet(sheet_name: str) -> tuple:
+    """Loads a sheet of the feature referential from the cache, parsing the excel file
+    only if the sheet is not cached or the file was modified since
+
+    Returns:
+        pd.DataFrame: sheet of the referential (cached, must not be modified)
+        MappingProxyType: read-only view of the sheet as {variable name: row}
+    """
+    path = os.path.join(conf.PATH_CONF, conf.FILENAME_FEATURE_REFERENTIAL)
+    mtime = os.path.getmtime(path)
+    with _REFERENTIAL_CACHE_LOCK:
+        cached = _REFERENTIAL_CACHE.get((path, sheet_name))
+        if cached is None or cached[0] != mtime:
+            logging.info(f"Loading sheet {sheet_name} of referential {path}")
+            df_ref = pd.read_excel(io=path, sheet_name=sheet_name)
+            ref_dict = _freeze_referential_dict(df_ref.set_index(conf.REFERENTIAL_VAR_NAME).to_dict("index"))
+            cached = (mtime, df_ref, ref_dict)
+            _REFERENTIAL_CACHE[(path, sheet_name)] = cached
+    return cached[1], cached[2]
+
+
 def load_variables_referential():
-    return pd.read_excel(
-        io=os.path.join(conf.PATH_CONF, conf.FILENAME_FEATURE_REFERENTIAL),
-        sheet_name=conf.REFERENTIAL_INFORMATION_SHEETNAME,
-    )
+    df_ref_variables, _ = _load_referential_sheet(conf.REFERENTIAL_INFORMATION_SHEETNAME)
+    return df_ref_variables.copy()
 
 
 def load_variables_referential_dict(df_ref_variables: Optional[pd.DataFrame] = None):
     if df_ref_variables is None:
-        df_ref_variables = load_variables_referential()
+        # read-only view of the cached referential
+        _, ref_variables_dict = _load_referential_sheet(conf.REFERENTIAL_INFORMATION_SHEETNAME)
+        return ref_variables_dict
 
     # Convert variable referential to dict
     ref_variables_dict = df_ref_variables.set_index(
@@ -252,17 +286,17 @@ def load_variables_referential_dict(df_ref_variables: Optional[pd.DataFrame] = N
 
 
 def load_variable_usage_referential():
-    return pd.read_excel(
-        io=os.path.join(conf.PATH_CONF, conf.FILENAME_FEATURE_REFERENTIAL),
-        sheet_name=conf.REFERENTIAL_USAGE_SHEETNAME,
-    )
+    df_ref_var_usage, _ = _load_referential_sheet(conf.REFERENTIAL_USAGE_SHEETNAME)
+    return df_ref_var_usage.copy()
 
 
 def load_variable_usage_referential_dict(
     df_ref_var_usage: Optional[pd.DataFrame] = None,
 ):
     if df_ref_var_usage is None:
-        df_ref_var_usage = load_variable_usage_referential()
+        # read-only view of the cached referential
+        _, ref_var_usage_dict = _load_referential_sheet(conf.REFERENTIAL_USAGE_SHEETNAME)
+        return ref_var_usage_dict
 
     # Convert variable referential to dict
     ref_var_usage_dict = df_ref_var_usage.set_index(
@@ -270,4 +304,3 @@ def load_variable_usage_referential_dict(
     ).to_dict("index")
 
     return ref_var_usage_dict
-
@@ -0,0 +1,68 @@
+import math
+import logging
+import pandas as pd
+from typing import Optional, Tuple
+
+import config as conf
+from src.modelling.sdv_copula import fit_copula
+from src.utils.utils_sdv import get_metadata_from_df, custom_validate_data
+
+
+def get_hybrid_split(n_sample: int,
+                     seed_fraction: Optional[float]=None,
+                     min_seed_rows: Optional[int]=None) -> Tuple[int, int]:
+    """Number of rows generated by the LLM (seed) and sampled from the copula in hybrid mode
+
+    Args:
+        n_sample (int): number of rows to generate
+        seed_fraction (float, optional): fraction of the rows generated by the LLM.
+            Defaults to conf.HYBRID_SEED_FRACTION.
+        min_seed_rows (int, optional): minimum number of rows generated by the LLM, for the
+            copula to be fit on enough rows. Defaults to conf.HYBRID_MIN_SEED_ROWS.
+
+    Returns:
+        int: number of rows generated by the LLM
+        int: number of rows sampled from the copula
+    """
+    seed_fraction = seed_fraction if seed_fraction is not None else conf.HYBRID_SEED_FRACTION
+    min_seed_rows = min_seed_rows if min_seed_rows is not None else conf.HYBRID_MIN_SEED_ROWS
+    n_seed = min(n_sample, max(min_seed_rows, math.ceil(seed_fraction * n_sample)))
+    return n_seed, n_sample - n_seed
+
+
+def amplify_with_copula(df_seed: pd.DataFrame,
+                        n_rows: int,
+                        sdv_metadata=None,
+                        ignore_columns: Optional[list]=None) -> pd.DataFrame:
+    """Adds to the seed rows generated by the LLM n_rows rows sampled from a gaussian copula
+    fit on them. Rows are tagged with their origin (llm or copula) in conf.COL_SYNTH_ORIGIN.
+
+    Args:
+        df_seed (pd.DataFrame): rows generated by the LLM
+        n_rows (int): number of rows to sample from the copula
+        sdv_metadata (SingleTableMetadata, optional): sdv metadata of the dataset (e.g.
+            conf.FILE_METADATA), the seed rows being validated against it as in the
+            evaluation. Defaults to the metadata detected from the seed rows.
+        ignore_columns (list, optional): columns not modelled (e.g. tags of the LLM
+            generation), left empty in the sampled rows. Defaults to None.
+
+    Returns:
+        pd.DataFrame: seed rows followed by the sampled rows
+    """
+    df_seed = df_seed.assign(**{conf.COL_SYNTH_ORIGIN: "llm"})
+    if n_rows <= 0:
+        return df_seed
+    df_train = df_seed.drop(columns=[col for col in (ignore_columns or []) + [conf.COL_SYNTH_ORIGIN]
+                                     if col in df_seed.columns])
+    if sdv_metadata is None:
+        sdv_metadata = get_metadata_from_df(df=df_train)
+    else:
+        # columns, primary key and types of the seed rows aligned on the metadata
+        df_train = custom_validate_data(df=df_train, metadata=sdv_metadata)
+    synthesizer = fit_copula(df=df_train, sdv_metadata=sdv_metadata)
+    df_sampled = synthesizer.sample(num_rows=n_rows)
+    # sampled rows laid out as the seed rows
+    df_sampled = df_sampled[[col for col in df_seed.columns if col in df_sampled.columns]]
+    df_sampled = df_sampled.assign(**{conf.COL_SYNTH_ORIGIN: "copula"})
+    logging.info(f"{n_rows} rows sampled from a gaussian copula fit on {len(df_seed)} LLM rows")
+    return pd.concat([df_seed, df_sampled], axis=0, ignore_index=True)
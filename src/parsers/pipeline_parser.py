@@ -1,5 +1,5 @@
 import config as conf
-from src.parsers.simple_parser import simple_parser
+from src.parsers.simple_parser import simple_parser, str_to_bool
 
 def pipeline_parser():
     parser = simple_parser() 
@@ -49,6 +49,33 @@ def pipeline_parser():
         help="Number of patient's to sample"
     )
 
+    parser.add_argument(
+        "--replay",
+        type=str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Serve LLM requests only from the responses cache (no call to the API)"
+    )
+
+    parser.add_argument(
+        "--resume",
+        type=str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Resume text to tab generation from its checkpoint"
+    )
+
+    parser.add_argument(
+        "--mock-llm",
+        type=str_to_bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Serve LLM requests with a local mock of the providers (see conf.LLM_MOCK_PARAMS)"
+    )
+
     ### TAB TO TAB ###
     parser.add_argument(
         "--real-dataset",
@@ -1,6 +1,13 @@
 import argparse
 
 
+def str_to_bool(value) -> bool:
+    """Converts an argument to bool: flags are passed as '--flag=True' by run_script"""
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("true", "1", "yes")
+
+
 def simple_parser():
     parser = argparse.ArgumentParser(
         description="LLM SDG PROJECT", epilog="Developped by Quinten"
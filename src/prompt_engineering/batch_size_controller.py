@@ -0,0 +1,130 @@
+""" Adaptive number of rows requested per query"""
+import random
+import logging
+from typing import Optional, Union
+import pandas as pd
+
+
+class BatchSizeController:
+    """Chooses the number of rows requested per query from a list of candidates, for each model.
+    Each candidate is first tried min_requests times, queries in flight included (see
+    release) so that concurrent queries warm up different candidates, then the candidate
+    with the highest throughput (valid rows per second of query) is chosen, except for a
+    fraction exploration of the queries where a random candidate is tried to keep the
+    statistics up to date.
+    Large tables are cheaper per row but are more often truncated or malformed by the model,
+    so the best size depends on the model and on the prompt.
+
+    Args:
+        candidates (list): numbers of rows that can be requested
+        initial (int, optional): number of rows tried first. Defaults to the smallest candidate.
+        exploration (float, optional): fraction of queries trying a random candidate. Defaults to 0.1.
+        min_requests (int, optional): number of queries tried with each candidate before
+            choosing the best one. Defaults to 2.
+        seed (int or str, optional): seed of the exploration. Defaults to None.
+    """
+
+    def __init__(self,
+                 candidates: list,
+                 initial: Optional[int]=None,
+                 exploration: float=0.1,
+                 min_requests: int=2,
+                 seed: Optional[Union[int, str]]=None):
+        self.candidates = sorted(set(candidates))
+        if initial is not None and initial in self.candidates:
+            # warm up the initial candidate first
+            self.candidates.remove(initial)
+            self.candidates.insert(0, initial)
+        self.exploration = exploration
+        self.min_requests = min_requests
+        # own generator so that exploration does not change the shuffling of the prompts
+        self._random = random.Random(seed)
+        self.stats = dict()
+
+    def choose(self, model: str) -> int:
+        """Number of rows to request in the next query to the model, counted as in flight
+        until the query is released"""
+        n_rows = self._choose(model)
+        self._get_stats(model, n_rows)["n_pending"] += 1
+        return n_rows
+
+    def release(self, model: str, n_rows: int):
+        """Releases a query chosen by choose once completed, whether recorded or not
+        (e.g. failed queries or queries resized to the rows remaining)
+
+        Args:
+            model (str): LLM model queried
+            n_rows (int): number of rows chosen
+        """
+        stats = self._get_stats(model, n_rows)
+        stats["n_pending"] = max(0, stats["n_pending"] - 1)
+
+    def record(self,
+               model: str,
+               n_rows: int,
+               latency: float,
+               n_valid_rows: int,
+               n_output_tokens: int,
+               parsed: bool):
+        """Records the outcome of a query
+
+        Args:
+            model (str): LLM model queried
+            n_rows (int): number of rows requested
+            latency (float): duration of the query (seconds)
+            n_valid_rows (int): number of rows accepted
+            n_output_tokens (int): number of tokens of the response
+            parsed (bool): whether the response was parsed as a table
+        """
+        stats = self._get_stats(model, n_rows)
+        stats["n_requests"] += 1
+        stats["n_parsed"] += int(parsed)
+        stats["n_valid_rows"] += n_valid_rows
+        stats["n_output_tokens"] += n_output_tokens
+        stats["latency"] += latency
+
+    def get_report(self) -> pd.DataFrame:
+        """Statistics of the queries for each model and number of rows requested"""
+        report = []
+        for (model, n_rows), stats in sorted(self.stats.items()):
+            report.append({"model": model,
+                           "n_rows": n_rows,
+                           "n_requests": stats["n_requests"],
+                           "parse_rate": stats["n_parsed"] / max(stats["n_requests"], 1),
+                           "mean_latency": stats["latency"] / max(stats["n_requests"], 1),
+                           "output_tokens_per_valid_row": stats["n_output_tokens"] / max(stats["n_valid_rows"], 1),
+                           "valid_rows_per_second": self._get_throughput(model, n_rows)})
+        return pd.DataFrame(report)
+
+    def log_report(self):
+        """Logs the statistics and the number of rows chosen for each model"""
+        report = self.get_report()
+        if report.empty:
+            return
+        logging.info(f"Rows per query statistics:\n{report.to_string(index=False)}")
+        for model in report["model"].unique():
+            best = max(self.candidates, key=lambda n_rows: self._get_throughput(model, n_rows))
+            logging.info(f"Rows per query chosen for {model}: {best}")
+
+    def _choose(self, model: str) -> int:
+        for n_rows in self.candidates:
+            stats = self._get_stats(model, n_rows)
+            if stats["n_requests"] + stats["n_pending"] < self.min_requests:
+                return n_rows
+        if self._random.random() < self.exploration:
+            return self._random.choice(self.candidates)
+        return max(self.candidates, key=lambda n_rows: self._get_throughput(model, n_rows))
+
+    def _get_stats(self, model: str, n_rows: int) -> dict:
+        return self.stats.setdefault((model, n_rows), {"n_requests": 0,
+                                                       "n_pending": 0,
+                                                       "n_parsed": 0,
+                                                       "n_valid_rows": 0,
+                                                       "n_output_tokens": 0,
+                                                       "latency": 0.0})
+
+    def _get_throughput(self, model: str, n_rows: int) -> float:
+        stats = self._get_stats(model, n_rows)
+        if stats["n_requests"] == 0:
+            return 0.0
+        return stats["n_valid_rows"] / max(stats["latency"], 1e-9)
@@ -0,0 +1,356 @@
+""" Offline text to tabular generation with batch jobs of the provider"""
+import os
+import json
+import math
+import time
+import uuid
+import shutil
+import logging
+import pandas as pd
+from typing import Callable, Optional, Union
+
+from src.prompt_engineering.prompt_llm import get_provider, get_api_key, get_llm_client
+from src.prompt_engineering.prompt_text_to_tab import parse_table_response
+from src.prompt_engineering.table_validator import TableValidator
+from src.prompt_engineering.duplicate_index import DuplicateRowIndex
+from src.prompt_engineering.quota import GenerationQuota
+from src.prompt_engineering.utils_prompt import format_row_example
+import config as conf
+
+
+# statuses of a batch job once it is over
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_request_id(request_index: int) -> str:
+    """Identifier (custom_id) of a request in a batch file"""
+    return f"request-{request_index:06d}"
+
+
+def get_request_index(request_id: str) -> int:
+    """Index of a request from its identifier (custom_id) in a batch file"""
+    return int(request_id.rsplit("-", 1)[-1])
+
+
+def render_batch_requests(prompt: Union[str, Callable[[int], str]],
+                          model: str,
+                          n_rows: int,
+                          n_sample: int,
+                          role: str="user",
+                          oversampling: float=1.0) -> list:
+    """Renders all the requests of a run in the batch format of the provider
+    (one chat completion request per line with its custom_id).
+
+    Args:
+        prompt (str or callable): text to generate the synthetic dataset, or function
+            returning a new prompt of n_rows rows for each request (e.g. shuffled prompts)
+        model (str): LLM model to use
+        n_rows (int): number of rows to generate for each request
+        n_sample (int): number of samples to generate
+        role (str): role of the user
+        oversampling (float): ratio of rows requested over n_sample, to make up for the
+            responses that are not valid tables. Defaults to 1.0.
+
+    Returns:
+        list: requests of the batch
+    """
+    n_requests = math.ceil(n_sample * oversampling / n_rows)
+    requests = []
+    for k in range(n_requests):
+        prompt_k = prompt(n_rows) if callable(prompt) else prompt
+        requests.append({"custom_id": get_request_id(k),
+                         "method": "POST",
+                         "url": "/v1/chat/completions",
+                         "body": {"model": model,
+                                  "messages": [{"role": role, "content": prompt_k}],
+                                  **conf.LLM_SAMPLING_PARAMS}})
+    logging.info(f"{n_requests} requests of {n_rows} rows rendered for batch")
+    return requests
+
+
+def write_batch_file(requests: list, path: str):
+    """Writes the requests of a batch as a JSONL file"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+
+def read_batch_results(path: str) -> dict:
+    """Reads the output JSONL file of a batch
+
+    Args:
+        path (str): path of the output file
+
+    Returns:
+        dict: response text of each request index, None for failed requests
+    """
+    responses = dict()
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            request_index = get_request_index(result["custom_id"])
+            response = result.get("response") or dict()
+            if result.get("error") or response.get("status_code") != 200:
+                logging.info(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+                responses[request_index] = None
+                continue
+            choice = response["body"]["choices"][0]
+            responses[request_index] = choice["message"]["content"]
+    return responses
+
+
+class OpenAIBatchBackend:
+    """Batch jobs run by the OpenAI batch API"""
+
+    def __init__(self):
+        self.client = get_llm_client("openai", get_api_key("openai"))
+
+    def submit(self, path_input: str) -> str:
+        """Uploads the batch file and creates the batch job, returns its id"""
+        with open(path_input, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id,
+                                           endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def get_status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str, path_output: str):
+        """Downloads the output file of a batch job over (completed requests only if it
+        expired or was cancelled)"""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.output_file_id is None:
+            raise RuntimeError(f"Batch {batch_id} has no output file (status: {batch.status})")
+        content = self.client.files.content(batch.output_file_id)
+        with open(path_output, "wb") as f:
+            f.write(content.read())
+
+
+class LocalBatchBackend:
+    """File-based stand-in of a batch API, to run batch generation without network access.
+    Each job is a folder holding the input file and its status. A job is completed once
+    latency seconds have passed: each request is then answered by respond (function of
+    the body of the request returning the text of the response).
+
+    Args:
+        path (str): folder of the jobs
+        respond (callable): function answering a request
+        latency (float, optional): duration (seconds) of a job. Defaults to 0.
+    """
+
+    def __init__(self,
+                 path: str,
+                 respond: Callable[[dict], str],
+                 latency: float=0):
+        self.path = path
+        self.respond = respond
+        self.latency = latency
+
+    def submit(self, path_input: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self._get_job_path(batch_id))
+        shutil.copy(path_input, os.path.join(self._get_job_path(batch_id), "input.jsonl"))
+        self._write_status(batch_id, {"status": "in_progress", "created_at": time.time()})
+        return batch_id
+
+    def get_status(self, batch_id: str) -> str:
+        status = self._read_status(batch_id)
+        if status["status"] == "in_progress" and time.time() - status["created_at"] >= self.latency:
+            self._run(batch_id)
+            status["status"] = "completed"
+            self._write_status(batch_id, status)
+        return status["status"]
+
+    def download(self, batch_id: str, path_output: str):
+        shutil.copy(os.path.join(self._get_job_path(batch_id), "output.jsonl"), path_output)
+
+    def _run(self, batch_id: str):
+        path_job = self._get_job_path(batch_id)
+        with open(os.path.join(path_job, "input.jsonl"), "r") as f_in, \
+                open(os.path.join(path_job, "output.jsonl"), "w") as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                try:
+                    content = self.respond(request["body"])
+                    result = {"custom_id": request["custom_id"],
+                              "response": {"status_code": 200,
+                                           "body": {"model": request["body"]["model"],
+                                                    "choices": [{"index": 0,
+                                                                 "message": {"role": "assistant",
+                                                                             "content": content},
+                                                                 "finish_reason": "stop"}]}},
+                              "error": None}
+                except Exception as e:
+                    result = {"custom_id": request["custom_id"],
+                              "response": None,
+                              "error": {"message": str(e)}}
+                f_out.write(json.dumps(result) + "\n")
+
+    def _get_job_path(self, batch_id: str) -> str:
+        return os.path.join(self.path, batch_id)
+
+    def _read_status(self, batch_id: str) -> dict:
+        with open(os.path.join(self._get_job_path(batch_id), "status.json"), "r") as f:
+            return json.load(f)
+
+    def _write_status(self, batch_id: str, status: dict):
+        with open(os.path.join(self._get_job_path(batch_id), "status.json"), "w") as f:
+            json.dump(status, f)
+
+
+def get_batch_backend(model: str):
+    """Batch backend of the provider of the model"""
+    provider = get_provider(model)
+    if provider == "openai":
+        return OpenAIBatchBackend()
+    raise ValueError(f"Batch jobs not implemented for provider {provider}")
+
+
+def batch_synth_tab(prompt: Union[str, Callable[[int], str]],
+                    model: str,
+                    n_rows: int,
+                    n_sample: int,
+                    path: str,
+                    role: str="user",
+                    process_chunk: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None,
+                    backend=None,
+                    output_format: str="json",
+                    oversampling: float=1.0,
+                    poll_interval: float=60,
+                    timeout: float=24 * 3600,
+                    row_schema: Optional[dict]=None,
+                    duplicate_index: Optional[DuplicateRowIndex]=None) -> pd.DataFrame:
+    """
+    Generates a synthetic tabular dataframe with one batch job instead of interactive queries.
+    All prompts are rendered up front and written as a JSONL batch file which is submitted
+    to the provider, then the job is polled until it is over and its responses are parsed,
+    validated, deduplicated and accepted in the order of the requests as in prompt_synth_tab,
+    until exactly n_sample rows have been accepted (see GenerationQuota).
+    Args:
+        prompt (str or callable): text to generate the synthetic dataset, or function
+            returning a new prompt of n_rows rows for each request (e.g. shuffled prompts)
+        model (str): LLM model to use
+        n_rows (int): number of rows to generate for each request
+        n_sample (int): number of samples to generate
+        path (str): folder where the input and output files of the batch are written
+        role (str): role of the user
+        process_chunk (callable, optional): function applied to each parsed chunk,
+            returning the cleaned chunk or None if the chunk is rejected
+        backend (optional): backend running the batch job (OpenAIBatchBackend or
+            LocalBatchBackend). Defaults to the batch API of the provider of the model.
+        output_format (str): format of the tables returned by the model: json, json_columnar
+            or csv (see TEXT2TAB_PROMPT_DICT). Defaults to json.
+        oversampling (float): ratio of rows requested over n_sample. Defaults to 1.0.
+        poll_interval (float): time (seconds) between two polls of the job status
+        timeout (float): maximum time (seconds) to wait for the job
+        row_schema (dict, optional): JSON schema of a row (see table_schema.get_row_schema),
+            rows of the responses not matching it being dropped (see TableValidator)
+        duplicate_index (DuplicateRowIndex, optional): index of the rows accepted, rows
+            duplicating them being dropped
+
+    Returns:
+        pd.DataFrame: synthetic dataframe, with less than n_sample rows if not enough
+            valid rows were returned (e.g. batch expired before all its requests completed)
+
+    Raises:
+        RuntimeError: if the batch failed or returned no valid rows
+    """
+    if backend is None:
+        backend = get_batch_backend(model)
+
+    requests = render_batch_requests(prompt=prompt,
+                                     model=model,
+                                     n_rows=n_rows,
+                                     n_sample=n_sample,
+                                     role=role,
+                                     oversampling=oversampling)
+    path_input = os.path.join(path, "batch_input.jsonl")
+    path_output = os.path.join(path, "batch_output.jsonl")
+    write_batch_file(requests, path_input)
+
+    batch_id = backend.submit(path_input)
+    logging.info(f"Batch {batch_id} submitted ({len(requests)} requests)")
+    start_time = time.monotonic()
+    status = backend.get_status(batch_id)
+    while status not in BATCH_FINAL_STATUSES:
+        if time.monotonic() - start_time > timeout:
+            raise TimeoutError(f"Batch {batch_id} not over after {timeout}s (status: {status})")
+        time.sleep(poll_interval)
+        status = backend.get_status(batch_id)
+    logging.info(f"Batch {batch_id} {status} in {time.monotonic() - start_time:.0f}s")
+    if status == "failed":
+        raise RuntimeError(f"Batch {batch_id} {status}")
+    if status != "completed":
+        # the requests completed before a batch expires or is cancelled are kept
+        logging.info(f"Batch {batch_id} {status}, responses of its completed requests kept")
+
+    backend.download(batch_id, path_output)
+    responses = read_batch_results(path_output)
+
+    validator = TableValidator(row_schema) if row_schema is not None else None
+    quota = GenerationQuota(n_sample=n_sample)
+    synth_data = []
+    for request in requests:
+        if quota.is_met:
+            break
+        msg = responses.get(get_request_index(request["custom_id"]))
+        if msg is None:
+            continue
+        df = parse_table_response(msg, output_format=output_format)
+        if df is not None and validator is not None:
+            df, _ = validator.validate(df)
+        if df is not None and process_chunk is not None:
+            df = process_chunk(df)
+        if df is not None and duplicate_index is not None:
+            df = duplicate_index.filter(df, model=model)
+        df = quota.accept(df)
+        if df is None:
+            logging.info("No dictionary")
+            continue
+        synth_data.append(df)
+
+    logging.info(f"Quota: {quota.get_report()}")
+    if validator is not None:
+        logging.info(f"Rows rejected by validation:\n{validator.get_report().to_string(index=False)}")
+    if duplicate_index is not None:
+        logging.info(f"Duplicated rows:\n{duplicate_index.get_report().to_string(index=False)}")
+    if not synth_data:
+        raise RuntimeError(f"No valid rows returned by batch {batch_id} ({status}), "
+                           f"responses written to {path_output}")
+    if not quota.is_met:
+        logging.info(f"Only {quota.n_accepted} valid rows out of {n_sample} returned by the batch")
+    df_synth = pd.concat(synth_data, axis=0)
+    logging.info(f"Shape of synthetic dataframe: {df_synth.shape}")
+
+    return df_synth
+
+
+def get_example_responder(row_example: dict,
+                          n_rows: int,
+                          output_format: str="json") -> Callable[[dict], str]:
+    """Function answering any request of a LocalBatchBackend with a table of n_rows
+    copies of the row example, to test batch generation end to end
+
+    Args:
+        row_example (dict): row example of the prompt ({key: row})
+        n_rows (int): number of rows of the tables
+        output_format (str): format of the tables (see TEXT2TAB_PROMPT_DICT). Defaults to json.
+
+    Returns:
+        callable: function of the body of a request returning the response text
+    """
+    row = next(iter(row_example.values()))
+    table = {str(i): row for i in range(n_rows)}
+
+    def respond(body: dict) -> str:
+        if output_format == "json":
+            return json.dumps(table)
+        return format_row_example(table, output_format=output_format)
+
+    return respond
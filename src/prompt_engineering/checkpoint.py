@@ -0,0 +1,103 @@
+""" Durable checkpoint of text to tabular generation"""
+import json
+import logging
+import threading
+import posixpath
+import fsspec
+import pandas as pd
+
+
+class GenerationCheckpoint:
+    """Checkpoint of a synthetic data generation, stored locally or on s3 (path starting with s3://).
+    Each accepted chunk is written to its own csv file and a manifest records the index of
+    completed requests with their number of rows, so that a generation can be resumed
+    without redoing the requests already paid for. The dtypes of the columns and of the
+    index of each chunk are recorded too, so that loaded chunks are typed as generated.
+
+    Args:
+        path (str): folder of the checkpoint
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fs, self.root = fsspec.core.url_to_fs(path)
+        self._lock = threading.Lock()
+        self.manifest = self._read_manifest()
+
+    @property
+    def n_rows(self) -> int:
+        """Number of rows checkpointed"""
+        return sum(self.manifest["chunks"].values())
+
+    @property
+    def next_request_index(self) -> int:
+        """Index following the last checkpointed request"""
+        return max((int(k) for k in self.manifest["chunks"]), default=-1) + 1
+
+    def add_chunk(self, request_index: int, df: pd.DataFrame):
+        """Writes an accepted chunk then records it in the manifest
+
+        Args:
+            request_index (int): index of the request that generated the chunk
+            df (pd.DataFrame): accepted chunk
+        """
+        self.fs.makedirs(self.root, exist_ok=True)
+        with self.fs.open(self._get_chunk_path(request_index), "w") as f:
+            df.to_csv(f, index=True)
+        with self._lock:
+            self.manifest["chunks"][str(request_index)] = len(df)
+            self.manifest["dtypes"][str(request_index)] = {
+                "columns": {col: str(dtype) for col, dtype in df.dtypes.items()},
+                "index": str(df.index.dtype),
+                "index_name": df.index.name}
+            self._write_manifest()
+
+    def load(self) -> pd.DataFrame:
+        """Loads checkpointed chunks in the order of the requests, with their dtypes and index
+        (empty dataframe if no chunk is checkpointed)"""
+        request_indexes = sorted(int(k) for k in self.manifest["chunks"])
+        list_df = []
+        for request_index in request_indexes:
+            dtypes = self.manifest["dtypes"][str(request_index)]
+            with self.fs.open(self._get_chunk_path(request_index), "r") as f:
+                list_df.append(self._read_chunk(f, dtypes=dtypes))
+        logging.info(f"{len(list_df)} chunks loaded from checkpoint {self.path}")
+        if not list_df:
+            return pd.DataFrame()
+        return pd.concat(list_df, axis=0)
+
+    def clear(self):
+        """Removes the checkpoint"""
+        if self.fs.exists(self.root):
+            self.fs.rm(self.root, recursive=True)
+        self.manifest = {"chunks": dict(), "dtypes": dict()}
+
+    @staticmethod
+    def _read_chunk(f, dtypes: dict) -> pd.DataFrame:
+        # text columns are read as text, not parsed as numbers
+        df = pd.read_csv(f,
+                         index_col=0,
+                         dtype={col: object for col, dtype in dtypes["columns"].items() if dtype == "object"})
+        df = df.astype(dtypes["columns"])
+        df.index = df.index.astype(dtypes["index"])
+        df.index.name = dtypes["index_name"]
+        return df
+
+    def _get_chunk_path(self, request_index: int) -> str:
+        return posixpath.join(self.root, f"chunk_{request_index:06d}.csv")
+
+    def _get_manifest_path(self) -> str:
+        return posixpath.join(self.root, "manifest.json")
+
+    def _read_manifest(self) -> dict:
+        if not self.fs.exists(self._get_manifest_path()):
+            return {"chunks": dict(), "dtypes": dict()}
+        with self.fs.open(self._get_manifest_path(), "r") as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        # write then move so that a crash never leaves a truncated manifest
+        path_tmp = self._get_manifest_path() + ".tmp"
+        with self.fs.open(path_tmp, "w") as f:
+            json.dump(self.manifest, f)
+        self.fs.mv(path_tmp, self._get_manifest_path())
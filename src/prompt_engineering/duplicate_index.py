@@ -0,0 +1,108 @@
+""" Index of the rows generated, to detect duplicated patients across queries"""
+import logging
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+
+class DuplicateRowIndex:
+    """Hash index of the rows accepted during a generation.
+    A row is an exact duplicate if all its values are equal to those of a row already
+    accepted, and a near duplicate if they are equal once numeric values are rounded to
+    significant_digits significant digits (e.g. 73.1 and 73.14 with 3 digits).
+    Each row is hashed once (vectorised on the chunk) and looked up in a set, so that
+    the index does not slow down the generation.
+
+    Args:
+        ignore_columns (list, optional): columns not compared, e.g. the patient identifier
+            which the model increments for every patient. Defaults to None.
+        significant_digits (int, optional): significant digits of numeric values to detect
+            near duplicates. Defaults to 3.
+        drop_near_duplicates (bool, optional): whether near duplicates are removed as well
+            as exact duplicates. Defaults to True.
+    """
+
+    def __init__(self,
+                 ignore_columns: Optional[list]=None,
+                 significant_digits: int=3,
+                 drop_near_duplicates: bool=True):
+        self.ignore_columns = ignore_columns or []
+        self.significant_digits = significant_digits
+        self.drop_near_duplicates = drop_near_duplicates
+        self._exact_hashes = set()
+        self._near_hashes = set()
+        self.stats = dict()
+
+    def filter(self, df: pd.DataFrame, model: Optional[str]=None) -> pd.DataFrame:
+        """Removes the duplicates of a chunk (with the rows already indexed and within the
+        chunk) and indexes its remaining rows
+
+        Args:
+            df (pd.DataFrame): chunk of rows
+            model (str, optional): model which generated the chunk, for the statistics
+
+        Returns:
+            pd.DataFrame: chunk without duplicates
+        """
+        exact_hashes, near_hashes = self._hash(df)
+        is_kept = np.ones(len(df), dtype=bool)
+        n_exact, n_near = 0, 0
+        for i, (exact_hash, near_hash) in enumerate(zip(exact_hashes, near_hashes)):
+            if exact_hash in self._exact_hashes:
+                n_exact += 1
+                is_kept[i] = False
+                continue
+            if near_hash in self._near_hashes:
+                n_near += 1
+                if self.drop_near_duplicates:
+                    is_kept[i] = False
+                    continue
+            self._exact_hashes.add(exact_hash)
+            self._near_hashes.add(near_hash)
+
+        stats = self.stats.setdefault(model, {"n_rows": 0, "n_exact_duplicates": 0, "n_near_duplicates": 0})
+        stats["n_rows"] += len(df)
+        stats["n_exact_duplicates"] += n_exact
+        stats["n_near_duplicates"] += n_near
+        if n_exact or n_near:
+            logging.info(f"Duplicated rows: {n_exact} exact, {n_near} near out of {len(df)}")
+        return df[is_kept]
+
+    def add(self, df: pd.DataFrame):
+        """Indexes rows already accepted (e.g. loaded from a checkpoint)"""
+        exact_hashes, near_hashes = self._hash(df)
+        self._exact_hashes.update(exact_hashes)
+        self._near_hashes.update(near_hashes)
+
+    def get_report(self) -> pd.DataFrame:
+        """Duplicate rates of the rows generated by each model"""
+        report = []
+        for model, stats in self.stats.items():
+            n_rows = max(stats["n_rows"], 1)
+            report.append({"model": model,
+                           **stats,
+                           "exact_duplicate_rate": stats["n_exact_duplicates"] / n_rows,
+                           "near_duplicate_rate": stats["n_near_duplicates"] / n_rows})
+        return pd.DataFrame(report)
+
+    def _hash(self, df: pd.DataFrame) -> tuple:
+        # hashes of the exact and of the rounded values of each row
+        df_compared = df.drop(columns=[col for col in self.ignore_columns if col in df.columns])
+        exact_hashes = pd.util.hash_pandas_object(df_compared.astype(str), index=False).to_numpy()
+        near_hashes = pd.util.hash_pandas_object(self._round(df_compared), index=False).to_numpy()
+        return exact_hashes, near_hashes
+
+    def _round(self, df: pd.DataFrame) -> pd.DataFrame:
+        # numeric values rounded to significant digits, other values compared as text
+        df_rounded = pd.DataFrame(index=df.index)
+        for col in df.columns:
+            values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float)
+            if np.isnan(values).any():
+                df_rounded[col] = df[col].astype(str).str.strip().str.lower()
+                continue
+            with np.errstate(divide="ignore"):
+                magnitude = np.floor(np.log10(np.abs(values)))
+            magnitude[~np.isfinite(magnitude)] = 0
+            scale = 10 ** (magnitude - self.significant_digits + 1)
+            df_rounded[col] = np.round(values / scale) * scale
+        return df_rounded
@@ -0,0 +1,158 @@
+""" Hedged queries: slow queries are duplicated to a secondary model"""
+import time
+import asyncio
+import logging
+import numpy as np
+from collections import deque
+from typing import Awaitable, Callable, Optional, Tuple
+
+import pandas as pd
+
+import config as conf
+from src.prompt_engineering.scheduler import RequestScheduler, get_scheduler
+from src.prompt_engineering.telemetry import get_query_cost
+
+
+class RequestHedger:
+    """Hedging of the queries to a primary model: when a query has not returned after a
+    percentile of the latencies of the last queries to the primary model, a duplicate is
+    sent to a secondary model (possibly of another provider). The first response parsed as
+    a non-empty table wins and the other query is cancelled, so that the tail latency of
+    the primary model does not stall the generation.
+    Hedges are only fired once min_samples latencies have been observed. The extra cost of
+    hedging is the cost of the losing queries: the tokens of the completed ones, and the
+    prompt tokens only of the cancelled ones.
+
+    Args:
+        secondary_model (str): LLM model of the duplicated queries
+        max_concurrency (int): maximum number of queries in flight to the secondary model
+        percentile (float, optional): percentile (0-100) of the latencies of the primary
+            model after which a query is duplicated. Defaults to conf.HEDGE_PERCENTILE.
+        min_samples (int, optional): number of latencies observed before hedging.
+            Defaults to conf.HEDGE_MIN_SAMPLES.
+        window (int, optional): number of last latencies the percentile is computed on.
+            Defaults to conf.HEDGE_WINDOW.
+        scheduler (RequestScheduler, optional): scheduler of the queries to the secondary
+            model. Defaults to a scheduler with the rate limits of the model set in config.
+    """
+
+    def __init__(self,
+                 secondary_model: str,
+                 max_concurrency: int,
+                 percentile: Optional[float]=None,
+                 min_samples: Optional[int]=None,
+                 window: Optional[int]=None,
+                 scheduler: Optional[RequestScheduler]=None):
+        self.secondary_model = secondary_model
+        self.percentile = percentile if percentile is not None else conf.HEDGE_PERCENTILE
+        self.min_samples = min_samples if min_samples is not None else conf.HEDGE_MIN_SAMPLES
+        self.latencies = deque(maxlen=window if window is not None else conf.HEDGE_WINDOW)
+        self.scheduler = scheduler or get_scheduler(model=secondary_model, max_concurrency=max_concurrency)
+        self.stats = {"n_queries": 0,
+                      "n_hedges": 0,
+                      "n_secondary_wins": 0,
+                      "n_primary_wins": 0,
+                      "extra_prompt_tokens": 0,
+                      "extra_completion_tokens": 0,
+                      "extra_cost": 0.0}
+
+    def get_delay(self) -> Optional[float]:
+        """Seconds after which a query is duplicated, None while too few latencies are observed"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return float(np.percentile(self.latencies, self.percentile))
+
+    async def run(self,
+                  query: Callable[..., Awaitable[Tuple[Optional[pd.DataFrame], dict]]],
+                  model: str,
+                  scheduler: RequestScheduler,
+                  n_prompt_tokens: int=0) -> Tuple[Optional[pd.DataFrame], dict]:
+        """Sends a query to the primary model, duplicated to the secondary model if slow
+
+        Args:
+            query (callable): coroutine function sending the query to a model through a
+                scheduler (model and scheduler keyword arguments) and returning the parsed chunk and the query info (see _aquery_chunk)
+            model (str): primary LLM model
+            scheduler (RequestScheduler): scheduler of the queries to the primary model
+            n_prompt_tokens (int, optional): number of prompt tokens of the query, counted
+                as extra cost of a cancelled query. Defaults to 0.
+
+        Returns:
+            pd.DataFrame: chunk of the winning query, None if no query returned a table
+            dict: query info of the winning query, with the model that answered (model),
+                whether the query was hedged (hedged) and its latency since it was sent
+        """
+        self.stats["n_queries"] += 1
+        start_time = time.monotonic()
+        primary = asyncio.create_task(query(model=model, scheduler=scheduler))
+        models = {primary: model}
+        results, errors = dict(), dict()
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.get_delay())
+            if not done:
+                self.stats["n_hedges"] += 1
+                logging.info(f"Query to {model} hedged to {self.secondary_model} "
+                             f"after {time.monotonic() - start_time:.1f}s")
+                models[asyncio.create_task(query(model=self.secondary_model, scheduler=self.scheduler))] = self.secondary_model
+            pending = set(models)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # the primary query wins ties
+                for task in sorted(done, key=lambda task: task is not primary):
+                    if task.exception() is not None:
+                        errors[task] = task.exception()
+                        continue
+                    results[task] = task.result()
+                    df, _ = results[task]
+                    if winner is None and df is not None and len(df):
+                        winner = task
+        finally:
+            # the losing query is not needed
+            losers = [task for task in models if not task.done()]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+
+        # queries cancelled before returning are slower than the latency observed
+        self.latencies.append(results[primary][1]["latency"] if primary in results
+                              else time.monotonic() - start_time)
+        is_hedged = len(models) > 1
+        if is_hedged and winner is not None:
+            self.stats["n_primary_wins" if winner is primary else "n_secondary_wins"] += 1
+        if winner is None:
+            # no table returned: the response of the primary query is kept if any
+            winner = primary if primary in results else next(iter(results), None)
+        if is_hedged:
+            self._record_extra_cost(models=models, results=results, winner=winner, n_prompt_tokens=n_prompt_tokens)
+        if winner is None:
+            raise errors.get(primary, next(iter(errors.values())))
+        df, query_info = results[winner]
+        query_info = {**query_info,
+                      "model": models[winner],
+                      "hedged": is_hedged,
+                      "latency": time.monotonic() - start_time}
+        return df, query_info
+
+    def _record_extra_cost(self, models: dict, results: dict, winner: Optional[asyncio.Task], n_prompt_tokens: int):
+        for task, model in models.items():
+            if task is winner:
+                continue
+            if task in results:
+                query_info = results[task][1]
+                prompt_tokens = query_info.get("prompt_tokens") or n_prompt_tokens
+                completion_tokens = query_info.get("completion_tokens") or query_info.get("n_output_tokens", 0)
+            else:
+                prompt_tokens, completion_tokens = n_prompt_tokens, 0
+            self.stats["extra_prompt_tokens"] += prompt_tokens
+            self.stats["extra_completion_tokens"] += completion_tokens
+            self.stats["extra_cost"] += get_query_cost(model=model,
+                                                       prompt_tokens=prompt_tokens,
+                                                       completion_tokens=completion_tokens)
+
+    def get_report(self) -> dict:
+        """Number of queries, of hedges fired and won by each model, and extra cost of hedging"""
+        return {**self.stats,
+                "secondary_model": self.secondary_model,
+                "hedge_rate": self.stats["n_hedges"] / max(self.stats["n_queries"], 1),
+                "delay": self.get_delay()}
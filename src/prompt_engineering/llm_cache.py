@@ -0,0 +1,190 @@
+""" Content-addressed on-disk cache of LLM responses"""
+import os
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Optional, Union
+
+
+class CacheMissError(KeyError):
+    """Raised in replay mode when a request is not found in the cache"""
+
+
+def get_cache_key(model: str,
+                  role: str,
+                  prompt: str,
+                  sampling_params: Optional[dict]=None,
+                  request_index: Optional[int]=None,
+                  seed: Optional[Union[int, str]]=None) -> str:
+    """Hash of a request: identical requests of a run (same seed and request index) share a key
+
+    Args:
+        model (str): LLM model
+        role (str): user role used in prompting
+        prompt (str): rendered prompt
+        sampling_params (dict, optional): sampling parameters sent to the model. Defaults to None.
+        request_index (int, optional): index of the request in the run. Defaults to None.
+        seed (int or str, optional): seed identifying the run. Defaults to None.
+
+    Returns:
+        str: sha256 hex digest of the request
+    """
+    request = json.dumps({"model": model,
+                          "role": role,
+                          "prompt": prompt,
+                          "sampling_params": sampling_params or dict(),
+                          "request_index": request_index,
+                          "seed": seed},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Cache of LLM responses stored compressed in a SQLite file, safe to share across threads.
+    When the stored size exceeds max_size bytes, least recently used responses are evicted.
+    In replay mode, requests are only served from the cache.
+    The nonce of the last recorded run of each run key is also stored (see get_run_nonce),
+    as well as the plan of each query of a run (see put_plan), read back to replay it.
+
+    Args:
+        path (str): path of the SQLite file
+        max_size (int): maximum size (bytes) of the stored responses
+        replay (bool, optional): whether to serve requests only from cache. Defaults to False.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_size: int,
+                 replay: bool=False):
+        self.path = path
+        self.max_size = max_size
+        self.replay = replay
+        self.stats = {"n_hits": 0, "n_misses": 0, "n_evicted": 0}
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                model TEXT,
+                                response BLOB,
+                                size INTEGER,
+                                accessed_at REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses(accessed_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, nonce TEXT)")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS plans (
+                                run TEXT,
+                                request_index INTEGER,
+                                plan BLOB,
+                                PRIMARY KEY (run, request_index))""")
+        self._conn.commit()
+        self.size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the response of a request, None if not cached"""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["n_misses"] += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        self.stats["n_hits"] += 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, model: str, response: str):
+        """Store the response of a request, evicting old responses if the cache is full"""
+        blob = zlib.compress(response.encode("utf-8"))
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               (key, model, blob, len(blob), time.time()))
+            self.size += len(blob) - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self._evict()
+            self._conn.commit()
+
+    def get_run_nonce(self, run: str, new: bool=True) -> str:
+        """Nonce of a run, part of its seed so that runs sharing a run key (e.g. the runs of
+        a train/test split writing the same dataset path) do not serve each other's responses
+
+        Args:
+            run (str): key of the run
+            new (bool, optional): whether to draw a new nonce for the run, recorded as its
+                last nonce. Otherwise the last nonce recorded is returned (e.g. to replay
+                or resume the run), a new one being drawn if none is recorded, except in
+                replay mode. Defaults to True.
+
+        Returns:
+            str: nonce of the run
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT nonce FROM runs WHERE run = ?", (run,)).fetchone()
+            if row is not None and not new:
+                return row[0]
+            if self.replay:
+                raise CacheMissError(f"No recorded run {run} in cache {self.path}")
+            nonce = uuid.uuid4().hex[:12]
+            self._conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)", (run, nonce))
+            self._conn.commit()
+        return nonce
+
+    def put_plan(self, run: str, request_index: int, plan: dict):
+        """Store the plan of a query of a run (model, number of rows, prompt...), so that
+        a replay sends the recorded queries instead of recomputing them
+
+        Args:
+            run (str): seed identifying the run
+            request_index (int): index of the query in the run
+            plan (dict): plan of the query, serializable as JSON
+        """
+        blob = zlib.compress(json.dumps(plan, default=str).encode("utf-8"))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO plans VALUES (?, ?, ?)", (run, request_index, blob))
+            self._conn.commit()
+
+    def get_plans(self, run: str) -> dict:
+        """Plans of the queries of a run recorded by put_plan, by request index"""
+        with self._lock:
+            rows = self._conn.execute("SELECT request_index, plan FROM plans WHERE run = ?", (run,)).fetchall()
+        return {request_index: json.loads(zlib.decompress(plan).decode("utf-8")) for request_index, plan in rows}
+
+    def _evict(self):
+        # remove least recently used responses until 90% of max size
+        size_to_free = self.size - 0.9 * self.max_size
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if size_to_free <= 0:
+                break
+            keys.append((key,))
+            size_to_free -= size
+            self.size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.stats["n_evicted"] += len(keys)
+        logging.info(f"LLM cache full: {len(keys)} responses evicted")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# cache used by prompt_model, None when responses are not cached
+_RESPONSE_CACHE = None
+
+
+def set_response_cache(cache: Optional[LLMResponseCache]):
+    """Set the cache used by prompt_model (None to disable caching)"""
+    global _RESPONSE_CACHE
+    _RESPONSE_CACHE = cache
+
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """Get the cache used by prompt_model, None if responses are not cached"""
+    return _RESPONSE_CACHE
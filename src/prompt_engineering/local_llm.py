@@ -0,0 +1,188 @@
+""" Local instruct models run on CPU with transformers.
+Requires torch, locked as a dependency of sdv (see poetry.lock). The module is only
+imported for local models."""
+import time
+import asyncio
+import logging
+import threading
+import weakref
+import torch
+from typing import List, Tuple
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import config as conf
+
+# models are loaded once per process and shared by all calls
+_LOCAL_MODELS = dict()
+_LOCAL_MODELS_LOCK = threading.Lock()
+# batchers gather the prompts of the queries of an event loop
+_BATCHERS = weakref.WeakKeyDictionary()
+
+
+class LocalLLM:
+    """Instruct model loaded once on CPU, generating the responses of many prompts per
+    forward pass.
+    Prompts are sorted by length and batched so that the prompts of a batch have similar
+    lengths: each batch holds at most conf.LOCAL_LLM_MAX_BATCH_SIZE prompts and
+    conf.LOCAL_LLM_MAX_BATCH_TOKENS padded prompt tokens, which bounds the computation
+    wasted on padding.
+
+    Args:
+        model_name (str): name of the model on the Hugging Face hub or local path
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        if conf.LOCAL_LLM_NUM_THREADS is not None:
+            torch.set_num_threads(conf.LOCAL_LLM_NUM_THREADS)
+        # prompts are padded on the left so that generation continues all of them
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        self.model.eval()
+        # batches run one at a time, each using all the threads of torch
+        self._lock = threading.Lock()
+
+    def generate(self, prompts: List[str], role: str="user") -> List[Tuple[str, dict]]:
+        """Generates the responses of prompts, batched by length
+
+        Args:
+            prompts (list): prompts to be used
+            role (str, optional): user role used in prompting. Defaults to "user".
+
+        Returns:
+            list: response and usage (prompt and completion tokens, finish reason) of each prompt
+        """
+        input_ids = [self.tokenizer.apply_chat_template([{"role": role, "content": prompt}],
+                                                        add_generation_prompt=True)
+                     for prompt in prompts]
+        order = sorted(range(len(prompts)), key=lambda i: len(input_ids[i]))
+        responses = [None] * len(prompts)
+        for batch in self._get_batches([input_ids[i] for i in order]):
+            batch_indexes = [order[i] for i in batch]
+            for i, response in zip(batch_indexes, self._generate_batch([input_ids[i] for i in batch_indexes])):
+                responses[i] = response
+        return responses
+
+    @staticmethod
+    def _get_batches(sorted_input_ids: list) -> List[list]:
+        """Positions of the prompts of each batch, prompts being sorted by length"""
+        batches, batch = [], []
+        for i, ids in enumerate(sorted_input_ids):
+            # the longest prompt of a batch is the last one, its length sets the padding
+            if batch and (len(batch) >= conf.LOCAL_LLM_MAX_BATCH_SIZE
+                          or len(ids) * (len(batch) + 1) > conf.LOCAL_LLM_MAX_BATCH_TOKENS):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _generate_batch(self, input_ids: List[list]) -> List[Tuple[str, dict]]:
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt")
+        with self._lock, torch.inference_mode():
+            outputs = self.model.generate(**inputs,
+                                          **get_generation_params(conf.LLM_SAMPLING_PARAMS),
+                                          pad_token_id=self.tokenizer.pad_token_id)
+
+        responses = []
+        n_prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        for new_ids, prompt_tokens in zip(outputs[:, inputs["input_ids"].shape[1]:].tolist(), n_prompt_tokens):
+            # generation of a sequence ends at its first end of sequence token
+            is_stopped = self.tokenizer.eos_token_id in new_ids
+            if is_stopped:
+                new_ids = new_ids[:new_ids.index(self.tokenizer.eos_token_id)]
+            responses.append((self.tokenizer.decode(new_ids, skip_special_tokens=True),
+                              {"prompt_tokens": int(prompt_tokens),
+                               "completion_tokens": len(new_ids),
+                               "finish_reason": "stop" if is_stopped else "length"}))
+        return responses
+
+
+def get_generation_params(sampling_params: dict) -> dict:
+    """Parameters of transformers generation from the sampling parameters sent to the providers"""
+    temperature = sampling_params.get("temperature", 1.0)
+    generation_params = {"max_new_tokens": sampling_params.get("max_tokens", conf.LOCAL_LLM_MAX_NEW_TOKENS),
+                         "do_sample": temperature > 0}
+    if temperature > 0:
+        generation_params["temperature"] = temperature
+        generation_params["top_p"] = sampling_params.get("top_p", 1.0)
+    return generation_params
+
+
+def get_local_llm(model: str) -> LocalLLM:
+    """Get the local model of an alias of conf.LOCAL_LLM_MODELS, loading it on first use"""
+    with _LOCAL_MODELS_LOCK:
+        if model not in _LOCAL_MODELS:
+            logging.info(f"Loading local model {conf.LOCAL_LLM_MODELS[model]}")
+            start_time = time.monotonic()
+            _LOCAL_MODELS[model] = LocalLLM(conf.LOCAL_LLM_MODELS[model])
+            logging.info(f"Local model loaded in {time.monotonic() - start_time:.1f}s")
+        return _LOCAL_MODELS[model]
+
+
+class LocalBatcher:
+    """Gathers the prompts of the concurrent queries of an event loop into batches.
+    A batch is generated once conf.LOCAL_LLM_MAX_BATCH_SIZE prompts are waiting, or
+    conf.LOCAL_LLM_BATCH_WAIT seconds after its first prompt, in a thread so that the
+    event loop keeps running.
+
+    Args:
+        model (str): alias of the local model (see conf.LOCAL_LLM_MODELS)
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self._queue = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def submit(self, prompt: str, role: str="user") -> Tuple[str, dict]:
+        """Queues a prompt and waits for its response and usage"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((prompt, role, future))
+        if len(self._queue) >= conf.LOCAL_LLM_MAX_BATCH_SIZE:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(conf.LOCAL_LLM_BATCH_WAIT, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        queue, self._queue = self._queue, []
+        # cancelled queries are not generated
+        queue = [(prompt, role, future) for prompt, role, future in queue if not future.done()]
+        if queue:
+            task = asyncio.ensure_future(self._generate(queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _generate(self, queue: list):
+        llm = await asyncio.to_thread(get_local_llm, self.model)
+        # prompts are generated by role, the role being part of the chat template
+        by_role = dict()
+        for prompt, role, future in queue:
+            by_role.setdefault(role, []).append((prompt, future))
+        for role, items in by_role.items():
+            try:
+                responses = await asyncio.to_thread(llm.generate, [prompt for prompt, _ in items], role)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), response in zip(items, responses):
+                if not future.done():
+                    future.set_result(response)
+
+
+def get_local_batcher(model: str) -> LocalBatcher:
+    """Get the batcher of a local model bound to the running event loop"""
+    batchers = _BATCHERS.setdefault(asyncio.get_running_loop(), dict())
+    if model not in batchers:
+        batchers[model] = LocalBatcher(model)
+    return batchers[model]
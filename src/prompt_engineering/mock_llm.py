@@ -0,0 +1,280 @@
+""" Mock of the LLM providers, to measure the generation offline"""
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import httpx
+from typing import Optional
+
+import config as conf
+from src.prompt_engineering.scheduler import estimate_n_tokens
+from src.prompt_engineering.utils_prompt import format_row_example
+
+
+class MockLLM:
+    """Stand-in of the openai and mistral chat completion APIs, answering with tables sampled
+    from the row schema (see table_schema.get_row_schema): categories are drawn among the
+    categories of the referential, numeric values between its bounds or around the values
+    of the row example.
+    Latency is the time to first token plus the time of the completion tokens, with a
+    lognormal noise. As the prompt caching of the providers, prompt prefixes already seen
+    are cached by blocks of tokens and shorten the time to first token. Faults are drawn
+    for each response: rate limit errors (429), truncated responses and malformed JSON.
+    Draws only depend on the seed and on the requests, so that a run is reproducible
+    whatever the completion order of its requests.
+
+    Args:
+        row_schema (dict): JSON schema of a row of the tables
+        row_example (dict, optional): row example of the values of the columns
+        output_format (str, optional): format of the tables (see TEXT2TAB_PROMPT_DICT).
+            Defaults to json.
+        params (dict, optional): latency and fault rates, defaults to conf.LLM_MOCK_PARAMS
+    """
+
+    def __init__(self,
+                 row_schema: dict,
+                 row_example: Optional[dict]=None,
+                 output_format: str="json",
+                 params: Optional[dict]=None):
+        self.row_schema = row_schema
+        self.row_example = row_example or dict()
+        self.output_format = output_format
+        self.params = {**conf.LLM_MOCK_PARAMS, **(params or dict())}
+        self._n_seen = dict()
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        self.stats = {"n_requests": 0, "n_rate_limited": 0, "n_truncated": 0, "n_malformed": 0, "n_cached_prompt_tokens": 0}
+
+    def respond(self, body: dict) -> dict:
+        """Draws the response to a chat completion request
+
+        Args:
+            body (dict): body of the request
+
+        Returns:
+            dict: status code, latency (s), text, finish reason and usage of the response
+        """
+        rng = self._get_rng(body)
+        self.stats["n_requests"] += 1
+        prompt = body["messages"][-1]["content"]
+        usage = {"prompt_tokens": estimate_n_tokens(prompt)}
+        if rng.random() < self.params["rate_limit_rate"]:
+            self.stats["n_rate_limited"] += 1
+            return {"status_code": 429, "latency": self.params["time_to_first_token"], **usage}
+
+        text = self._sample_response(body, prompt, rng)
+        finish_reason = "stop"
+        if rng.random() < self.params["truncation_rate"]:
+            self.stats["n_truncated"] += 1
+            text = text[:int(len(text) * rng.uniform(0.2, 0.9))]
+            finish_reason = "length"
+        elif rng.random() < self.params["malformed_rate"]:
+            self.stats["n_malformed"] += 1
+            # a quote, comma or bracket of the response is dropped
+            positions = [i for i, char in enumerate(text) if char in '",}']
+            if positions:
+                i = rng.choice(positions)
+                text = text[:i] + text[i + 1:]
+        usage["completion_tokens"] = estimate_n_tokens(text)
+        usage["cached_prompt_tokens"] = self._cache_prompt(prompt)
+        self.stats["n_cached_prompt_tokens"] += usage["cached_prompt_tokens"]
+        time_to_first_token = self.params["time_to_first_token"] * (
+            1 - self.params["prompt_cache_speedup"] * usage["cached_prompt_tokens"] / usage["prompt_tokens"])
+        latency = (time_to_first_token
+                   + usage["completion_tokens"] * self.params["seconds_per_token"]) * rng.lognormvariate(0, self.params["latency_sigma"])
+        return {"status_code": 200,
+                "latency": latency,
+                "text": text,
+                "finish_reason": finish_reason,
+                **usage}
+
+    def _get_rng(self, body: dict) -> random.Random:
+        """Generator of a request: identical requests draw different responses in sequence"""
+        key = hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+        with self._lock:
+            n_seen = self._n_seen.get(key, 0)
+            self._n_seen[key] = n_seen + 1
+        return random.Random(f"{self.params['seed']}_{key}_{n_seen}")
+
+    def _cache_prompt(self, prompt: str) -> int:
+        """Caches the prefixes of a prompt, returning its number of tokens already cached"""
+        # a token is about 4 characters
+        block = 4 * self.params["prompt_cache_block_tokens"]
+        n_cached, is_cached = 0, True
+        with self._lock:
+            for end in range(4 * self.params["prompt_cache_min_tokens"], len(prompt) + 1, block):
+                prefix = hashlib.sha256(prompt[:end].encode()).digest()
+                is_cached = is_cached and prefix in self._prefixes
+                if is_cached:
+                    n_cached = end
+                self._prefixes.add(prefix)
+        return n_cached // 4
+
+    def _sample_response(self, body: dict, prompt: str, rng: random.Random) -> str:
+        # structured outputs: the table schema sets the number of rows and the row schema
+        schema = (body.get("response_format") or dict()).get("json_schema", dict()).get("schema")
+        if schema is not None:
+            rows = {key: self._sample_row(schema["$defs"]["row"], rng) for key in schema["required"]}
+            return json.dumps(rows)
+
+        # repair prompts: the missing values of the rows are filled
+        if prompt.startswith(conf.REPAIR_PROMPT.split("{")[0]):
+            match = re.search(r"Rows:\n(\{.*\})\n", prompt, re.DOTALL)
+            rows = json.loads(match.group(1)) if match else dict()
+            sampled = {key: self._sample_row(self.row_schema, rng) for key in rows}
+            return json.dumps({key: {col: sampled[key][col] for col, value in row.items() if value is None and col in sampled[key]}
+                               for key, row in rows.items()})
+
+        # number of rows in the template, or appended to the prompt (see conf.PROMPT_PREFIX_LAYOUT)
+        match = re.search(r"(\d+)\s+rows", prompt) or re.search(r"N = (\d+)", prompt)
+        n_rows = int(match.group(1)) if match else conf.N_ROWS
+        rows = {str(i): self._sample_row(self.row_schema, rng) for i in range(n_rows)}
+        if self.output_format == "json":
+            return json.dumps(rows)
+        return format_row_example(rows, output_format=self.output_format)
+
+    def _sample_row(self, row_schema: dict, rng: random.Random) -> dict:
+        row = dict()
+        for col, column_schema in row_schema["properties"].items():
+            json_type = column_schema.get("type")
+            example = self.row_example.get(col)
+            if "enum" in column_schema:
+                row[col] = rng.choice(column_schema["enum"])
+            elif json_type in ("integer", "number"):
+                if "minimum" in column_schema and "maximum" in column_schema:
+                    value = rng.uniform(column_schema["minimum"], column_schema["maximum"])
+                elif isinstance(example, (int, float)):
+                    value = example * rng.uniform(0.7, 1.3)
+                else:
+                    value = rng.uniform(0, 100)
+                row[col] = int(round(value)) if json_type == "integer" else round(value, 1)
+            elif isinstance(example, (int, float)):
+                row[col] = round(example * rng.uniform(0.7, 1.3), 1)
+            else:
+                row[col] = f"{rng.randint(0, 999):03d}_S_{rng.randint(0, 9999):04d}"
+        return row
+
+
+class MockLLMTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """httpx transport serving the chat completion requests of the openai and mistral
+    clients with a MockLLM, streamed responses included (server-sent events)
+
+    Args:
+        mock (MockLLM): mock of the provider
+    """
+
+    # number of characters of each streamed chunk
+    CHUNK_SIZE = 16
+
+    def __init__(self, mock: MockLLM):
+        self.mock = mock
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        response = self.mock.respond(body)
+        if body.get("stream"):
+            return self._get_stream_response(body, response, stream=_SyncChunkStream(self._get_events(body, response)))
+        time.sleep(response["latency"])
+        return self._get_response(body, response)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(await request.aread())
+        response = self.mock.respond(body)
+        if body.get("stream"):
+            return self._get_stream_response(body, response, stream=_AsyncChunkStream(self._get_events(body, response)))
+        await asyncio.sleep(response["latency"])
+        return self._get_response(body, response)
+
+    def _get_response(self, body: dict, response: dict) -> httpx.Response:
+        if response["status_code"] == 429:
+            return self._get_rate_limit_response()
+        return httpx.Response(200, json={"id": "mock",
+                                         "object": "chat.completion",
+                                         "created": int(time.time()),
+                                         "model": body["model"],
+                                         "choices": [{"index": 0,
+                                                      "message": {"role": "assistant", "content": response["text"]},
+                                                      "finish_reason": response["finish_reason"]}],
+                                         "usage": _get_usage(response)})
+
+    def _get_stream_response(self, body: dict, response: dict, stream) -> httpx.Response:
+        if response["status_code"] == 429:
+            return self._get_rate_limit_response()
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stream)
+
+    def _get_rate_limit_response(self) -> httpx.Response:
+        return httpx.Response(429,
+                              headers={"retry-after": str(self.mock.params["retry_after"])},
+                              json={"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}})
+
+    def _get_events(self, body: dict, response: dict) -> list:
+        """Server-sent events of a streamed response, with the delay before each of them"""
+        if response["status_code"] != 200:
+            return []
+        text = response["text"]
+        chunks = [text[i:i + self.CHUNK_SIZE] for i in range(0, len(text), self.CHUNK_SIZE)]
+        time_to_first_token = min(self.mock.params["time_to_first_token"], response["latency"])
+        delay = (response["latency"] - time_to_first_token) / max(len(chunks), 1)
+
+        def event(choices: list, **kwargs) -> bytes:
+            data = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": body["model"], "choices": choices, **kwargs}
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        events = [(time_to_first_token if i == 0 else delay,
+                   event([{"index": 0, "delta": {"role": "assistant", "content": chunk}, "finish_reason": None}]))
+                  for i, chunk in enumerate(chunks)]
+        events.append((0, event([{"index": 0, "delta": {"content": ""}, "finish_reason": response["finish_reason"]}])))
+        if (body.get("stream_options") or dict()).get("include_usage") or "mistral" in body["model"]:
+            events.append((0, event([], usage=_get_usage(response))))
+        events.append((0, b"data: [DONE]\n\n"))
+        return events
+
+
+def _get_usage(response: dict) -> dict:
+    return {"prompt_tokens": response["prompt_tokens"],
+            "completion_tokens": response["completion_tokens"],
+            "total_tokens": response["prompt_tokens"] + response["completion_tokens"],
+            "prompt_tokens_details": {"cached_tokens": response["cached_prompt_tokens"]}}
+
+
+class _SyncChunkStream(httpx.SyncByteStream):
+    def __init__(self, events: list):
+        self.events = events
+
+    def __iter__(self):
+        for delay, data in self.events:
+            time.sleep(delay)
+            yield data
+
+
+class _AsyncChunkStream(httpx.AsyncByteStream):
+    def __init__(self, events: list):
+        self.events = events
+
+    async def __aiter__(self):
+        for delay, data in self.events:
+            await asyncio.sleep(delay)
+            yield data
+
+
+# mock serving the requests to the providers, None when requests are sent to the providers
+_MOCK_LLM = None
+
+
+def set_mock_llm(mock: Optional[MockLLM]):
+    """Set the mock serving the requests to the providers (None to send them to the providers).
+    Clients created afterwards send their requests to the mock."""
+    global _MOCK_LLM
+    _MOCK_LLM = mock
+    if mock is not None:
+        logging.info(f"LLM requests served by a mock: {mock.params}")
+
+
+def get_mock_llm() -> Optional[MockLLM]:
+    """Get the mock serving the requests to the providers, None if requests are sent to the providers"""
+    return _MOCK_LLM
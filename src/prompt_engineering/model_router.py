@@ -0,0 +1,162 @@
+""" Routing of the generation queries across a pool of models"""
+import random
+import logging
+from typing import Optional, Union
+import pandas as pd
+
+import config as conf
+from src.prompt_engineering.telemetry import get_query_cost
+
+
+class ModelRouter:
+    """Distributes the queries of a generation across a weighted pool of models, so that
+    the rate limits of several providers are used at once.
+    Each model is first tried min_requests times (queries in flight included), then models
+    are drawn at random with a weight updated after each query:
+    prior weight x valid rows per second x (1 - rejection rate) / (1 + cost_weight x cost per valid row)
+    where the rows rejected are the parsed rows not accepted (schema, process_chunk,
+    duplicates) and the rows per second are per second of query, scheduler waits included,
+    so that a throttled model loses weight. Failed queries count as queries of no valid row
+    costing their full prompt and requested rows. Statistics are decayed at each query of a model
+    so that weights follow its current latency and quality. Each model keeps at least a
+    share min_share of the queries to keep its statistics up to date.
+
+    Args:
+        models (dict or list): prior weight of each model, or models of equal prior weight
+        cost_weight (float, optional): penalty of the cost ($) per valid row.
+            Defaults to conf.ROUTER_COST_WEIGHT.
+        min_share (float, optional): minimum share of the queries of each model.
+            Defaults to conf.ROUTER_MIN_SHARE.
+        min_requests (int, optional): number of queries tried with each model before
+            weighting them. Defaults to conf.ROUTER_MIN_REQUESTS.
+        decay (float, optional): factor applied to the statistics of a model at each of its
+            queries. Defaults to conf.ROUTER_DECAY.
+        seed (int or str, optional): seed of the draws. Defaults to None.
+    """
+
+    def __init__(self,
+                 models: Union[dict, list],
+                 cost_weight: Optional[float]=None,
+                 min_share: Optional[float]=None,
+                 min_requests: Optional[int]=None,
+                 decay: Optional[float]=None,
+                 seed: Optional[Union[int, str]]=None):
+        self.priors = dict(models) if isinstance(models, dict) else {model: 1.0 for model in models}
+        self.models = list(self.priors)
+        self.cost_weight = cost_weight if cost_weight is not None else conf.ROUTER_COST_WEIGHT
+        self.min_share = min_share if min_share is not None else conf.ROUTER_MIN_SHARE
+        self.min_requests = min_requests if min_requests is not None else conf.ROUTER_MIN_REQUESTS
+        self.decay = decay if decay is not None else conf.ROUTER_DECAY
+        # own generator so that routing does not change the shuffling of the prompts
+        self._random = random.Random(seed)
+        self.stats = {model: {"n_requests": 0,
+                              "n_valid_rows": 0.0,
+                              "n_parsed_rows": 0.0,
+                              "latency": 0.0,
+                              "cost": 0.0} for model in self.models}
+        # queries chosen and not yet released, counted in the warm-up of their model
+        self.n_pending = {model: 0 for model in self.models}
+        self.counts = {model: {"n_requests": 0, "n_valid_rows": 0, "cost": 0.0} for model in self.models}
+
+    def choose(self) -> str:
+        """Model of the next query, counted as in flight until the query is released"""
+        model = self._choose()
+        self.n_pending[model] += 1
+        return model
+
+    def release(self, model: str):
+        """Releases a query chosen by choose once completed, whether it succeeded or failed"""
+        if model in self.n_pending:
+            self.n_pending[model] = max(0, self.n_pending[model] - 1)
+
+    def get_weights(self) -> dict:
+        """Share of the queries of each model"""
+        scores = {model: self.priors[model] * self._get_score(model) for model in self.models}
+        total = sum(scores.values())
+        if total <= 0:
+            return {model: 1 / len(self.models) for model in self.models}
+        # each model keeps a minimum share of the queries
+        n_models = len(self.models)
+        min_share = min(self.min_share, 1 / n_models)
+        return {model: min_share + (1 - n_models * min_share) * score / total for model, score in scores.items()}
+
+    def record(self,
+               model: str,
+               latency: float,
+               n_parsed_rows: int,
+               n_valid_rows: int,
+               prompt_tokens: int=0,
+               completion_tokens: int=0):
+        """Records the outcome of a query
+
+        Args:
+            model (str): LLM model queried
+            latency (float): duration of the query (seconds)
+            n_parsed_rows (int): number of rows parsed from the response
+            n_valid_rows (int): number of rows accepted
+            prompt_tokens (int, optional): number of prompt tokens of the query
+            completion_tokens (int, optional): number of completion tokens of the query
+        """
+        if model not in self.stats:
+            return
+        cost = get_query_cost(model=model, prompt_tokens=prompt_tokens or 0, completion_tokens=completion_tokens or 0)
+        stats = self.stats[model]
+        for key in ["n_valid_rows", "n_parsed_rows", "latency", "cost"]:
+            stats[key] *= self.decay
+        stats["n_requests"] += 1
+        stats["n_valid_rows"] += n_valid_rows
+        stats["n_parsed_rows"] += n_parsed_rows
+        stats["latency"] += latency
+        stats["cost"] += cost
+        counts = self.counts[model]
+        counts["n_requests"] += 1
+        counts["n_valid_rows"] += n_valid_rows
+        counts["cost"] += cost
+
+    def get_report(self) -> pd.DataFrame:
+        """Queries, valid rows, cost and current statistics and weight of each model"""
+        weights = self.get_weights()
+        report = []
+        for model in self.models:
+            counts = self.counts[model]
+            report.append({"model": model,
+                           "n_requests": counts["n_requests"],
+                           "n_valid_rows": counts["n_valid_rows"],
+                           "cost": counts["cost"],
+                           "valid_rows_per_second": self._get_throughput(model),
+                           "rejection_rate": self._get_rejection_rate(model),
+                           "cost_per_valid_row": self._get_cost_per_valid_row(model),
+                           "weight": weights[model]})
+        return pd.DataFrame(report)
+
+    def log_report(self):
+        """Logs the statistics of the models of the pool"""
+        logging.info(f"Models statistics:\n{self.get_report().to_string(index=False)}")
+
+    def _choose(self) -> str:
+        for model in self.models:
+            if self.stats[model]["n_requests"] + self.n_pending[model] < self.min_requests:
+                return model
+        weights = self.get_weights()
+        return self._random.choices(self.models, weights=[weights[model] for model in self.models])[0]
+
+    def _get_score(self, model: str) -> float:
+        if self.stats[model]["n_requests"] == 0:
+            return 0.0
+        return (self._get_throughput(model)
+                * (1 - self._get_rejection_rate(model))
+                / (1 + self.cost_weight * self._get_cost_per_valid_row(model)))
+
+    def _get_throughput(self, model: str) -> float:
+        stats = self.stats[model]
+        return stats["n_valid_rows"] / max(stats["latency"], 1e-9)
+
+    def _get_rejection_rate(self, model: str) -> float:
+        stats = self.stats[model]
+        if stats["n_parsed_rows"] <= 0:
+            return 1.0 if stats["n_requests"] else 0.0
+        return max(0.0, 1 - stats["n_valid_rows"] / stats["n_parsed_rows"])
+
+    def _get_cost_per_valid_row(self, model: str) -> float:
+        stats = self.stats[model]
+        return stats["cost"] / max(stats["n_valid_rows"], 1e-9) if stats["cost"] else 0.0
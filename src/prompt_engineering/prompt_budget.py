@@ -0,0 +1,197 @@
+""" Token budget of text to tabular prompts"""
+import re
+import json
+import logging
+import pandas as pd
+from functools import lru_cache
+from typing import Optional
+from transformers import AutoTokenizer
+
+import config as conf
+from src.utils import utils_referential
+from src.prompt_engineering.prompt_llm import get_provider
+from src.prompt_engineering.utils_prompt import CompiledPrompt, parse_prompt_item
+from src.prompt_engineering.utils_prompt import get_prompt_desc_var, format_row_example
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str):
+    """Tokenizer approximating the tokenizer of the model (see conf.PROMPT_BUDGET_TOKENIZERS),
+    the tokenizer of the model itself for local models"""
+    if get_provider(model) == "local":
+        return AutoTokenizer.from_pretrained(conf.LOCAL_LLM_MODELS[model])
+    tokenizer_name = conf.PROMPT_BUDGET_TOKENIZERS.get(get_provider(model))
+    if tokenizer_name is None:
+        raise ValueError(f"No tokenizer set for model {model}")
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def count_tokens(text: str, tokenizer) -> int:
+    """Number of tokens of a text"""
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def get_prompt_sections(compiled_prompt: CompiledPrompt,
+                        prompt_dict: dict,
+                        prompt_example: dict,
+                        n_rows: int) -> dict:
+    """Splits a rendered prompt into its sections
+
+    Args:
+        compiled_prompt (CompiledPrompt): compiled prompt
+        prompt_dict (dict): template dictionary prompt
+        prompt_example (dict): row examples of output
+        n_rows (int): number of rows requested
+
+    Returns:
+        dict: text of the instructions, of the variables description and of the row example
+    """
+    prompt = compiled_prompt.render(n_rows=n_rows)
+    variables_description = "\n".join(compiled_prompt.variable_lines)
+    row_example = ""
+    for item in prompt_dict.get("template_items") or []:
+        if item.startswith("row_example"):
+            row_example = str(parse_prompt_item(item=item,
+                                                prompt_example=prompt_example,
+                                                var_desc_prompt_dict=None,
+                                                ref_key=None))
+    instructions = prompt.replace(variables_description, "").replace(row_example, "")
+    return {"instructions": instructions,
+            "variables_description": variables_description,
+            "row_example": row_example}
+
+
+def get_prompt_budget(compiled_prompt: CompiledPrompt,
+                      prompt_dict: dict,
+                      prompt_example: dict,
+                      n_rows: int,
+                      tokenizer) -> pd.DataFrame:
+    """Number of tokens of each section of a prompt and of its expected output
+
+    Args:
+        compiled_prompt (CompiledPrompt): compiled prompt
+        prompt_dict (dict): template dictionary prompt
+        prompt_example (dict): row examples of output
+        n_rows (int): number of rows requested
+        tokenizer: tokenizer of the model (see get_tokenizer)
+
+    Returns:
+        pd.DataFrame: number of tokens and number of tokens per row requested of the
+            sections of the prompt, of the whole prompt and of the expected output
+    """
+    sections = get_prompt_sections(compiled_prompt=compiled_prompt,
+                                   prompt_dict=prompt_dict,
+                                   prompt_example=prompt_example,
+                                   n_rows=n_rows)
+    sections["prompt"] = compiled_prompt.render(n_rows=n_rows)
+
+    # expected output: table of n_rows rows like the row example
+    row = next(iter(prompt_example.values()))
+    table = {str(i): row for i in range(n_rows)}
+    output_format = prompt_dict.get("output_format", "json")
+    if output_format == "json":
+        sections["expected_output"] = json.dumps(table)
+    else:
+        sections["expected_output"] = format_row_example(table, output_format=output_format)
+
+    budget = []
+    for section, text in sections.items():
+        n_tokens = count_tokens(text, tokenizer)
+        budget.append({"section": section,
+                       "n_tokens": n_tokens,
+                       "n_tokens_per_row": n_tokens / n_rows})
+    return pd.DataFrame(budget)
+
+
+def get_compact_var_dicts(var_dict: dict) -> list:
+    """Variants of the referential of a variable, from the most to the least verbose:
+    full, compact mapping and first sentence of the description, first words of the
+    description, no description
+
+    Args:
+        var_dict (dict): referential of the variable
+
+    Returns:
+        list: referentials of the variable
+    """
+    description = var_dict.get(conf.REFERENTIAL_VAR_DESC)
+    mapping = var_dict.get(conf.REFERENTIAL_VAR_CAT_MAPPING)
+    variants = [dict(var_dict)]
+
+    compact = dict(var_dict)
+    if isinstance(mapping, str):
+        compact[conf.REFERENTIAL_VAR_CAT_MAPPING] = re.sub(r"\s*([:,])\s*", r"\1", mapping)
+    if isinstance(description, str):
+        compact[conf.REFERENTIAL_VAR_DESC] = re.split(r"(?<=[.;])\s", description.strip())[0]
+    variants.append(compact)
+
+    if isinstance(description, str):
+        variants.append({**compact,
+                         conf.REFERENTIAL_VAR_DESC: " ".join(compact[conf.REFERENTIAL_VAR_DESC].split()[:conf.PROMPT_BUDGET_DESC_WORDS])})
+        variants.append({**compact, conf.REFERENTIAL_VAR_DESC: ""})
+    return variants
+
+
+def compile_prompt_under_budget(prompt_dict: dict,
+                                prompt_example: dict,
+                                var_desc_prompt_dict: dict,
+                                ref_key: str,
+                                n_rows: int,
+                                token_budget: int,
+                                tokenizer,
+                                layout: str="inline",
+                                n_permutations: Optional[int]=None) -> CompiledPrompt:
+    """Compiles a prompt whose variable descriptions are shortened until the prompt holds
+    in token_budget tokens. Descriptions are shortened one level at a time (see
+    get_compact_var_dicts), the longest first.
+
+    Args:
+        prompt_dict (dict): template dictionary prompt
+        prompt_example (dict): row examples of output
+        var_desc_prompt_dict (dict): dictionary containing data specifications dictionary
+        ref_key (str): key to use in reference dictionary
+        n_rows (int): number of rows requested
+        token_budget (int): maximum number of tokens of the prompt
+        tokenizer: tokenizer of the model (see get_tokenizer)
+        layout (str, optional): layout of the prompt (see CompiledPrompt). Defaults to "inline".
+        n_permutations (int, optional): size of the pool of permutations of the shuffled
+            variables (see CompiledPrompt). Defaults to None.
+
+    Returns:
+        CompiledPrompt: compiled prompt with compacted variable descriptions
+    """
+    compiled_prompt = CompiledPrompt(prompt_dict=prompt_dict,
+                                     prompt_example=prompt_example,
+                                     var_desc_prompt_dict=var_desc_prompt_dict,
+                                     ref_key=ref_key,
+                                     layout=layout,
+                                     n_permutations=n_permutations)
+    if not compiled_prompt.variable_lines:
+        return compiled_prompt
+
+    # description lines of each variable, from the most to the least verbose
+    variants = []
+    for var_name, var_dict in utils_referential.get_ref_variables_to_keep().items():
+        variants.append([get_prompt_desc_var(var_name=var_name,
+                                             var_dict=var_dict_compact,
+                                             var_desc_prompt_template=var_desc_prompt_dict["template"],
+                                             var_desc_prompt_template_mapping=var_desc_prompt_dict["mapping"],
+                                             ref_key=ref_key)
+                         for var_dict_compact in get_compact_var_dicts(var_dict)])
+    levels = [0] * len(variants)
+
+    n_tokens = count_tokens(compiled_prompt.render(n_rows=n_rows), tokenizer)
+    n_tokens_start = n_tokens
+    while n_tokens > token_budget:
+        # shorten the longest of the least shortened lines, so that all descriptions are
+        # shortened evenly
+        candidates = [i for i in range(len(variants)) if levels[i] + 1 < len(variants[i])]
+        if not candidates:
+            logging.info(f"Prompt of {n_tokens} tokens cannot be compacted under {token_budget} tokens")
+            break
+        i = max(candidates, key=lambda i: (-levels[i], count_tokens(variants[i][levels[i]], tokenizer)))
+        levels[i] += 1
+        compiled_prompt.variable_lines[i] = variants[i][levels[i]]
+        n_tokens = count_tokens(compiled_prompt.render(n_rows=n_rows), tokenizer)
+    logging.info(f"Prompt compacted from {n_tokens_start} to {n_tokens} tokens (budget: {token_budget})")
+    return compiled_prompt
@@ -1,60 +1,277 @@
 import os
+import re
+import io
 import json
 import logging
+import asyncio
+import threading
+import weakref
+from typing import Callable, Optional
 
-from openai import OpenAI
+import httpx
+import openai
+import pandas as pd
+from openai import OpenAI, AsyncOpenAI
 from mistralai.client import MistralClient
+from mistralai.async_client import MistralAsyncClient
+from mistralai.exceptions import MistralException, MistralAPIException
 from mistralai.models.chat_completion import ChatMessage
 
+import config as conf
+from src.prompt_engineering.scheduler import RateLimitError, TransientError
+from src.prompt_engineering.scheduler import parse_retry_after
+from src.prompt_engineering.scheduler import RequestScheduler
+from src.prompt_engineering.llm_cache import get_response_cache, get_cache_key
+from src.prompt_engineering.llm_cache import CacheMissError
+from src.prompt_engineering.mock_llm import MockLLMTransport, get_mock_llm
+
+# environment variable holding the API key of each provider
+# add in .zschrc file "export OPENAI_API_KEY='%yourkey'" / "export MISTRAL_API_KEY='%yourkey'"
+API_KEY_ENV_VARS = {"openai": "OPENAI_API_KEY",
+                    "mistral": "MISTRAL_API_KEY"}
+
+# errors of a query to a provider, once the retries of the scheduler are exhausted
+# (RateLimitError, TransientError) or not worth retrying (e.g. 4xx errors of the API)
+PROVIDER_ERRORS = (RateLimitError, TransientError, openai.APIError, MistralException, httpx.HTTPError)
+
+# clients are created once per (provider, api key) and shared by all calls of the process.
+# httpx clients are thread safe but async clients are bound to the event loop they
+# are used in, hence one registry of async clients per event loop
+_CLIENTS = dict()
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_provider(model: str):
+    """Get the provider of a LLM model from its name
+
+    Args:
+        model (str): LLM model
+
+    Returns:
+        provider (str): 'local' (see conf.LOCAL_LLM_MODELS), 'openai' or 'mistral',
+            None if the model is not recognized
+    """
+    if model in conf.LOCAL_LLM_MODELS:
+        return "local"
+    elif 'gpt' in model:
+        return "openai"
+    elif 'mistral' in model:
+        return "mistral"
+    return None
+
+
+def supports_structured_output(model: str) -> bool:
+    """Whether the responses of a LLM model can be constrained to a JSON schema
+    (see conf.LLM_STRUCTURED_OUTPUT_MODELS)"""
+    return get_provider(model) == "openai" and model in conf.LLM_STRUCTURED_OUTPUT_MODELS
+
+
+def get_api_key(provider: str):
+    """Get the API key of a provider from the environment
+
+    Args:
+        provider (str): 'openai' or 'mistral'
+
+    Returns:
+        api_key (str): API key, None if not found
+    """
+    if get_mock_llm() is not None:
+        return "mock"
+    env_var = API_KEY_ENV_VARS[provider]
+    api_key = os.environ.get(env_var)
+    if api_key is None:
+        logging.info(f"{env_var} not found")
+    return api_key
+
+
+def get_llm_client(provider: str,
+                   api_key: str,
+                   asynchronous: bool=False):
+    """Get the long-lived client of a provider, creating it on first use.
+    Clients keep their HTTP connections alive so that successive calls reuse them.
+
+    Args:
+        provider (str): 'openai' or 'mistral'
+        api_key (str): API key of the provider
+        asynchronous (bool, optional): whether to get an async client bound to the
+            running event loop. Defaults to False.
+
+    Returns:
+        client: OpenAI, AsyncOpenAI, MistralClient or MistralAsyncClient
+    """
+    key = (provider, api_key)
+    with _CLIENTS_LOCK:
+        if asynchronous:
+            clients = _ASYNC_CLIENTS.setdefault(asyncio.get_running_loop(), dict())
+        else:
+            clients = _CLIENTS
+        if key not in clients:
+            logging.info(f"Creating {'async ' if asynchronous else ''}{provider} client")
+            clients[key] = _create_llm_client(provider=provider,
+                                              api_key=api_key,
+                                              asynchronous=asynchronous)
+        return clients[key]
+
+
+async def aclose_llm_clients():
+    """Close the async clients bound to the running event loop"""
+    with _CLIENTS_LOCK:
+        clients = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), dict())
+    for client in clients.values():
+        # AsyncOpenAI and MistralAsyncClient close their http client
+        await client.close()
+
+
+def _create_llm_client(provider: str,
+                       api_key: str,
+                       asynchronous: bool=False):
+    """Create a client with a keep-alive connection pool of conf.LLM_CLIENT_POOL_SIZE
+    connections and conf.LLM_CLIENT_TIMEOUT / conf.LLM_CLIENT_CONNECT_TIMEOUT timeouts (s)
+    """
+    limits = httpx.Limits(max_connections=conf.LLM_CLIENT_POOL_SIZE,
+                          max_keepalive_connections=conf.LLM_CLIENT_POOL_SIZE,
+                          keepalive_expiry=conf.LLM_CLIENT_KEEPALIVE_EXPIRY)
+    timeout = httpx.Timeout(conf.LLM_CLIENT_TIMEOUT, connect=conf.LLM_CLIENT_CONNECT_TIMEOUT)
+    # requests are served in process by the mock of the providers if one is set
+    mock = get_mock_llm()
+    if mock is not None:
+        transport = MockLLMTransport(mock)
+    elif asynchronous:
+        transport = httpx.AsyncHTTPTransport(retries=conf.LLM_CLIENT_MAX_RETRIES, limits=limits)
+    else:
+        transport = httpx.HTTPTransport(retries=conf.LLM_CLIENT_MAX_RETRIES, limits=limits)
+
+    if provider == "openai":
+        if asynchronous:
+            return AsyncOpenAI(api_key=api_key,
+                               timeout=timeout,
+                               max_retries=conf.LLM_CLIENT_MAX_RETRIES,
+                               http_client=httpx.AsyncClient(timeout=timeout, transport=transport))
+        return OpenAI(api_key=api_key,
+                      timeout=timeout,
+                      max_retries=conf.LLM_CLIENT_MAX_RETRIES,
+                      http_client=httpx.Client(timeout=timeout, transport=transport))
+
+    elif provider == "mistral":
+        # mistral clients do not expose their connection pool: the http client they create
+        # is replaced by one whose transport holds the pool limits (held in _client by
+        # mistralai 0.4, which close() closes)
+        if asynchronous:
+            client = MistralAsyncClient(api_key=api_key,
+                                        max_retries=conf.LLM_CLIENT_MAX_RETRIES,
+                                        timeout=conf.LLM_CLIENT_TIMEOUT)
+            client._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=timeout,
+                transport=transport,
+            )
+        else:
+            client = MistralClient(api_key=api_key,
+                                   max_retries=conf.LLM_CLIENT_MAX_RETRIES,
+                                   timeout=conf.LLM_CLIENT_TIMEOUT)
+            client._client.close()
+            client._client = httpx.Client(
+                follow_redirects=True,
+                timeout=timeout,
+                transport=transport,
+            )
+        return client
+
+    else:
+        raise ValueError(f"Provider {provider} not implemented")
+
+
 def prompt_model(model: str,
                 prompt: str,
-                role: str="user"):
-    """Prompt the LLM model with the given prompt
+                role: str="user",
+                request_index: int=None,
+                seed=None,
+                usage: dict=None,
+                response_schema: dict=None):
+    """Prompt the LLM model with the given prompt.
+    If a response cache is set (see llm_cache.set_response_cache), responses are served
+    from and stored in the cache. In replay mode, they are only served from the cache.
+    If a response schema is given, the output of the models supporting structured outputs
+    (see supports_structured_output) is constrained to the schema, the schema is ignored
+    for other models.
 
     Args:
-        model (str): LLM model. Either 'gpt' or 'mistral'.
+        model (str): LLM model. Either 'gpt', 'mistral' or a local model.
         prompt (str): Prompt to be used.
         role (str, optional): user role used in prompting. Defaults to "user".
+        request_index (int, optional): index of the request in the run, part of the cache key.
+        seed (int or str, optional): seed identifying the run, part of the cache key.
+        usage (dict, optional): dictionary filled with the usage of the query (see _init_usage)
+        response_schema (dict, optional): JSON schema of the response (see table_schema)
 
     Returns:
         message (str): Response from the model
     """
-    if 'gpt' in model:
+    usage = _init_usage(usage, provider=get_provider(model))
+    if not supports_structured_output(model):
+        response_schema = None
+    cache = get_response_cache()
+    if cache is not None:
+        key = get_cache_key(model=model, role=role, prompt=prompt,
+                            sampling_params=_get_request_params(response_schema),
+                            request_index=request_index, seed=seed)
+        msg = _get_cached_response(cache=cache, key=key)
+        if msg is not None:
+            usage["cached"] = True
+            return msg
+
+    provider = get_provider(model)
+    usage["n_attempts"] = 1
+    if provider == "openai":
         msg = prompt_openai_model(model=model,
                         prompt=prompt,
-                        role=role)
-    elif 'mistral' in model:
+                        role=role,
+                        usage=usage,
+                        response_schema=response_schema)
+    elif provider == "mistral":
+        # JSON mode only: responses are validated against the schema after parsing
         msg = prompt_mistral_model(model=model,
                          role=role,
-                         prompt=prompt)
+                         prompt=prompt,
+                         usage=usage)
+    elif provider == "local":
+        msg = prompt_local_model(model=model,
+                                 role=role,
+                                 prompt=prompt,
+                                 usage=usage)
     else:
         logging.info("Model not recognized")
         msg = None
+
+    # truncated or interrupted responses (e.g. a broken stream) are not cached as complete ones
+    if cache is not None and msg is not None and usage["finish_reason"] == "stop":
+        cache.put(key=key, model=model, response=msg)
     return msg
 
 
 def prompt_openai_model(model: str,
                         prompt: str,
-                        role: str="user"):
+                        role: str="user",
+                        usage: dict=None,
+                        response_schema: dict=None):
     """Prompt the OpenAI model with the given prompt
 
     Args:
-        model (str): OpenAI model. Either 'gpt' 
+        model (str): OpenAI model. Either 'gpt'
         prompt (str): Prompt to be used.
         role (str, optional): user role used in prompting. Defaults to "user".
+        usage (dict, optional): dictionary filled with the usage of the query
+        response_schema (dict, optional): JSON schema constraining the response
 
     Returns:
         message (str): Response from the model
     """
-    # add in .zschrc file "export MISTRAL_API_KEY='%yourkey'"
-    # run in terminal: source ~/.zshrc	
-    try:
-        api_key = os.environ["OPENAI_API_KEY"]
-    except KeyError:
-        logging.info("OPENAI_API_KEY not found")
+    api_key = get_api_key("openai")
+    if api_key is None:
         return None
-    # connect to openai API via client
-    client = OpenAI(api_key=api_key)
+    # connect to openai API via shared client
+    client = get_llm_client(provider="openai", api_key=api_key)
 
     # prompt the model
     res = client.chat.completions.create(
@@ -62,8 +279,11 @@ def prompt_openai_model(model: str,
                    "content": prompt,
                    }],
         model=model,
+        **get_openai_response_format(response_schema),
+        **conf.LLM_SAMPLING_PARAMS,
     )
-    
+    _fill_usage(usage, res)
+
     # extract message from response
     msg = res.choices[0].message.content
     return msg
@@ -71,38 +291,538 @@ def prompt_openai_model(model: str,
 
 def prompt_mistral_model(model: str,
                          role: str,
-                         prompt: str):
+                         prompt: str,
+                         usage: dict=None):
     """Prompt the MISTRAL model with the given prompt
 
     Args:
         model (str): mistral model
         role (str): user role used in prompting. Defaults to "user".
         prompt (str): Prompt to be used.
+        usage (dict, optional): dictionary filled with the usage of the query
 
     Returns:
         message (str): Response from the model
     """
-    # add in .zschrc file "export MISTRAL_API_KEY='%yourkey'"
-    try:
-        api_key = os.environ["MISTRAL_API_KEY"]
-    except KeyError:
-        logging.info("MISTRAL_API_KEY not found")
+    api_key = get_api_key("mistral")
+    if api_key is None:
         return None
-    # connect to mistral  API via client
-    client = MistralClient(api_key=api_key)
-    
+    # connect to mistral API via shared client
+    client = get_llm_client(provider="mistral", api_key=api_key)
+
     # prompt the model
     res = client.chat(
         model=model,
         response_format={"type": "json_object"},
         messages=[ChatMessage(role=role,
                               content=prompt)],
+        **conf.LLM_SAMPLING_PARAMS,
     )
-    
+    _fill_usage(usage, res)
+
     # extract message from response
     msg = res.choices[0].message.content
     return msg
 
+def prompt_local_model(model: str,
+                       role: str,
+                       prompt: str,
+                       usage: dict=None):
+    """Prompt the local model with the given prompt
+
+    Args:
+        model (str): alias of the local model (see conf.LOCAL_LLM_MODELS)
+        role (str): user role used in prompting.
+        prompt (str): Prompt to be used.
+        usage (dict, optional): dictionary filled with the usage of the query
+
+    Returns:
+        message (str): Response from the model
+    """
+    # torch is only loaded for local models
+    from src.prompt_engineering.local_llm import get_local_llm
+    [(msg, local_usage)] = get_local_llm(model).generate([prompt], role=role)
+    if usage is not None:
+        usage.update(local_usage)
+    return msg
+
+
+async def aprompt_model(model: str,
+                        prompt: str,
+                        role: str="user",
+                        request_index: int=None,
+                        seed=None,
+                        scheduler: RequestScheduler=None,
+                        n_tokens: int=0,
+                        on_text: Callable[[str], None]=None,
+                        usage: dict=None,
+                        response_schema: dict=None):
+    """Asynchronously prompt the LLM model with the given prompt.
+    Responses are cached as in prompt_model; requests not served from the cache
+    are sent through the scheduler if any. The response schema is sent as in prompt_model.
+    If on_text is given, the response is streamed and on_text is called with each
+    fragment of text as it is received.
+
+    Args:
+        model (str): LLM model. Either 'gpt', 'mistral' or a local model.
+        prompt (str): Prompt to be used.
+        role (str, optional): user role used in prompting. Defaults to "user".
+        request_index (int, optional): index of the request in the run, part of the cache key.
+        seed (int or str, optional): seed identifying the run, part of the cache key.
+        scheduler (RequestScheduler, optional): scheduler enforcing rate limits of the provider.
+        n_tokens (int, optional): estimated number of tokens of the request for the scheduler.
+        on_text (callable, optional): function called with each fragment of the streamed response.
+        usage (dict, optional): dictionary filled with the usage of the query (see _init_usage)
+        response_schema (dict, optional): JSON schema of the response (see table_schema)
+
+    Returns:
+        message (str): Response from the model
+    """
+    usage = _init_usage(usage, provider=get_provider(model))
+    if not supports_structured_output(model):
+        response_schema = None
+    cache = get_response_cache()
+    if cache is not None:
+        key = get_cache_key(model=model, role=role, prompt=prompt,
+                            sampling_params=_get_request_params(response_schema),
+                            request_index=request_index, seed=seed)
+        msg = _get_cached_response(cache=cache, key=key)
+        if msg is not None:
+            usage["cached"] = True
+            if on_text is not None:
+                on_text(msg)
+            return msg
+
+    provider = get_provider(model)
+    if provider == "openai":
+        provider_call = lambda: aprompt_openai_model(model=model,
+                                                     prompt=prompt,
+                                                     role=role,
+                                                     on_text=on_text,
+                                                     usage=usage,
+                                                     response_schema=response_schema)
+    elif provider == "mistral":
+        # JSON mode only: responses are validated against the schema after parsing
+        provider_call = lambda: aprompt_mistral_model(model=model,
+                                                      role=role,
+                                                      prompt=prompt,
+                                                      on_text=on_text,
+                                                      usage=usage)
+    elif provider == "local":
+        provider_call = lambda: aprompt_local_model(model=model,
+                                                    role=role,
+                                                    prompt=prompt,
+                                                    on_text=on_text,
+                                                    usage=usage)
+    else:
+        logging.info("Model not recognized")
+        return None
+
+    def call():
+        # attempts include the retries of the scheduler
+        usage["n_attempts"] += 1
+        return provider_call()
+
+    if scheduler is not None:
+        msg = await scheduler.submit(call, n_tokens=n_tokens)
+    else:
+        msg = await call()
+
+    # truncated or interrupted responses (e.g. a broken stream) are not cached as complete ones
+    if cache is not None and msg is not None and usage["finish_reason"] == "stop":
+        cache.put(key=key, model=model, response=msg)
+    return msg
+
+
+def _init_usage(usage: dict=None, provider: str=None) -> dict:
+    """Initialises the usage of a query: provider, number of prompt and completion tokens
+    and of prompt tokens served from the prompt cache of the provider (None if not reported),
+    finish reason, number of attempts and whether the response was served from the cache"""
+    if usage is None:
+        usage = dict()
+    usage.update({"provider": provider,
+                  "prompt_tokens": None,
+                  "completion_tokens": None,
+                  "cached_prompt_tokens": None,
+                  "finish_reason": None,
+                  "n_attempts": 0,
+                  "cached": False})
+    return usage
+
+
+def _fill_usage(usage: dict, res):
+    """Fills the usage of a query from a response (or the last chunk of a stream)"""
+    if usage is None:
+        return
+    if getattr(res, "usage", None) is not None:
+        usage["prompt_tokens"] = res.usage.prompt_tokens
+        usage["completion_tokens"] = res.usage.completion_tokens
+        prompt_tokens_details = getattr(res.usage, "prompt_tokens_details", None)
+        if prompt_tokens_details is not None:
+            usage["cached_prompt_tokens"] = getattr(prompt_tokens_details, "cached_tokens", None)
+    if res.choices and res.choices[0].finish_reason is not None:
+        finish_reason = res.choices[0].finish_reason
+        usage["finish_reason"] = getattr(finish_reason, "value", finish_reason)
+
+
+def _get_request_params(response_schema: dict=None) -> dict:
+    """Parameters of a request other than its prompt, part of its cache key"""
+    if response_schema is None:
+        return conf.LLM_SAMPLING_PARAMS
+    return {**conf.LLM_SAMPLING_PARAMS, "response_schema": response_schema}
+
+
+def get_openai_response_format(response_schema: dict=None) -> dict:
+    """Structured output parameter of an OpenAI request constraining the response to the
+    schema (strict mode: all properties required, no additional properties)
+
+    Args:
+        response_schema (dict, optional): JSON schema of the response
+
+    Returns:
+        dict: keyword argument of the request, empty if no schema
+    """
+    if response_schema is None:
+        return dict()
+    return {"response_format": {"type": "json_schema",
+                                "json_schema": {"name": "synthetic_table",
+                                                "schema": response_schema,
+                                                "strict": True}}}
+
+
+def _is_retryable_status(status_code: int) -> bool:
+    """Whether a request failed with this HTTP status is worth retrying (timeout, server error)"""
+    return status_code == 408 or status_code >= 500
+
+
+def _get_cached_response(cache, key: str):
+    """Get a response from the cache, raising CacheMissError in replay mode if not cached"""
+    msg = cache.get(key)
+    if msg is None and cache.replay:
+        raise CacheMissError(f"Request {key} not found in cache {cache.path}")
+    return msg
+
+
+async def aprompt_openai_model(model: str,
+                               prompt: str,
+                               role: str="user",
+                               on_text: Callable[[str], None]=None,
+                               usage: dict=None,
+                               response_schema: dict=None):
+    """Asynchronously prompt the OpenAI model with the given prompt
+
+    Args:
+        model (str): OpenAI model. Either 'gpt'
+        prompt (str): Prompt to be used.
+        role (str, optional): user role used in prompting. Defaults to "user".
+        on_text (callable, optional): if given, the response is streamed and on_text
+            is called with each fragment of text received.
+        usage (dict, optional): dictionary filled with the usage of the query
+        response_schema (dict, optional): JSON schema constraining the response
+
+    Returns:
+        message (str): Response from the model
+    """
+    api_key = get_api_key("openai")
+    if api_key is None:
+        return None
+    # connect to openai API via shared async client
+    client = get_llm_client(provider="openai", api_key=api_key, asynchronous=True)
+
+    # prompt the model
+    # usage of a streamed response is sent in its last chunk
+    stream_options = {"stream_options": {"include_usage": True}} if on_text is not None else dict()
+    try:
+        res = await client.chat.completions.create(
+            messages=[{"role": role,
+                       "content": prompt,
+                       }],
+            model=model,
+            stream=on_text is not None,
+            **stream_options,
+            **get_openai_response_format(response_schema),
+            **conf.LLM_SAMPLING_PARAMS,
+        )
+    except openai.RateLimitError as e:
+        raise RateLimitError(str(e), retry_after=parse_retry_after(e.response.headers)) from e
+    except openai.APIConnectionError as e:
+        # connection errors and timeouts (APITimeoutError)
+        raise TransientError(str(e)) from e
+    except openai.APIStatusError as e:
+        # server errors and request timeouts are retried, other client errors are not
+        if _is_retryable_status(e.status_code):
+            raise TransientError(str(e)) from e
+        raise
+
+    if on_text is not None:
+        return await _aconsume_stream(stream=res, on_text=on_text, usage=usage)
+    _fill_usage(usage, res)
+
+    # extract message from response
+    msg = res.choices[0].message.content
+    return msg
+
+
+async def aprompt_mistral_model(model: str,
+                                role: str,
+                                prompt: str,
+                                on_text: Callable[[str], None]=None,
+                                usage: dict=None):
+    """Asynchronously prompt the MISTRAL model with the given prompt
+
+    Args:
+        model (str): mistral model
+        role (str): user role used in prompting. Defaults to "user".
+        prompt (str): Prompt to be used.
+        on_text (callable, optional): if given, the response is streamed and on_text
+            is called with each fragment of text received.
+        usage (dict, optional): dictionary filled with the usage of the query
+
+    Returns:
+        message (str): Response from the model
+    """
+    api_key = get_api_key("mistral")
+    if api_key is None:
+        return None
+    # connect to mistral API via shared async client
+    client = get_llm_client(provider="mistral", api_key=api_key, asynchronous=True)
+
+    # prompt the model
+    try:
+        if on_text is not None:
+            # the request is sent when the stream is first read
+            stream = client.chat_stream(
+                model=model,
+                response_format={"type": "json_object"},
+                messages=[ChatMessage(role=role,
+                                      content=prompt)],
+                **conf.LLM_SAMPLING_PARAMS,
+            )
+            return await _aconsume_stream(stream=stream, on_text=on_text, usage=usage)
+
+        res = await client.chat(
+            model=model,
+            response_format={"type": "json_object"},
+            messages=[ChatMessage(role=role,
+                                  content=prompt)],
+            **conf.LLM_SAMPLING_PARAMS,
+        )
+    except MistralAPIException as e:
+        if e.http_status == 429:
+            raise RateLimitError(str(e), retry_after=parse_retry_after(e.headers)) from e
+        # server errors are retried, other client errors are not
+        if e.http_status is not None and not _is_retryable_status(e.http_status):
+            raise
+        raise TransientError(str(e)) from e
+    except MistralException as e:
+        # connection errors, read timeouts and server errors not retried by the client
+        raise TransientError(str(e)) from e
+    _fill_usage(usage, res)
+
+    # extract message from response
+    msg = res.choices[0].message.content
+    return msg
+
+async def aprompt_local_model(model: str,
+                              role: str,
+                              prompt: str,
+                              on_text: Callable[[str], None]=None,
+                              usage: dict=None):
+    """Asynchronously prompt the local model with the given prompt, batched with the prompts
+    of the concurrent queries (see local_llm.LocalBatcher)
+
+    Args:
+        model (str): alias of the local model (see conf.LOCAL_LLM_MODELS)
+        role (str): user role used in prompting.
+        prompt (str): Prompt to be used.
+        on_text (callable, optional): if given, called with the whole response, local
+            responses not being streamed.
+        usage (dict, optional): dictionary filled with the usage of the query
+
+    Returns:
+        message (str): Response from the model
+    """
+    # torch is only loaded for local models
+    from src.prompt_engineering.local_llm import get_local_batcher
+    msg, local_usage = await get_local_batcher(model).submit(prompt, role=role)
+    if usage is not None:
+        usage.update(local_usage)
+    if on_text is not None:
+        on_text(msg)
+    return msg
+
+
+async def _aconsume_stream(stream, on_text: Callable[[str], None], usage: dict=None) -> str:
+    """Reads a stream of chat completion chunks, calling on_text with each fragment of text.
+    If the stream breaks after some text was received, the partial response is returned
+    so that its complete rows can be salvaged.
+
+    Returns:
+        message (str): Response from the model
+    """
+    fragments = []
+    try:
+        async for chunk in stream:
+            _fill_usage(usage, chunk)
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                fragments.append(text)
+                on_text(text)
+    except (RateLimitError, TransientError, MistralAPIException):
+        # raised by the stream before any text is received when the request fails
+        raise
+    except (openai.APIError, httpx.HTTPError, MistralException) as e:
+        if not fragments:
+            raise TransientError(str(e)) from e
+        logging.info(f"Stream interrupted, partial response kept: {e}")
+    return "".join(fragments)
+
+
+class TableStreamParser:
+    """Incremental parser of a table returned as JSON, either a dictionary of rows keyed
+    by index ({"0": {...}, "1": {...}}) or a list of rows ([{...}, {...}]).
+    Text is fed as it is received and each row is returned as soon as its object closes,
+    so that complete rows are kept from truncated or malformed responses.
+    Text before the table (e.g. a markdown code fence) and after it is ignored.
+    """
+
+    def __init__(self):
+        self.rows = dict()
+        self.n_malformed = 0
+        self.n_chars = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._is_list = False
+        self._finished = False
+        self._key = None
+        self._key_chars = []
+        self._row_chars = None
+
+    def feed(self, text: str) -> list:
+        """Parses a fragment of text
+
+        Args:
+            text (str): fragment of the response
+
+        Returns:
+            list: (key, row) of the rows completed by the fragment
+        """
+        completed_rows = []
+        self.n_chars += len(text)
+        for char in text:
+            if self._finished:
+                break
+            if self._row_chars is not None:
+                self._row_chars.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._row_chars is None:
+                        self._key = "".join(self._key_chars)
+                elif self._depth == 1 and self._row_chars is None:
+                    self._key_chars.append(char)
+
+            elif char == '"':
+                self._in_string = True
+                self._key_chars = []
+
+            elif char in "{[":
+                if self._depth == 0:
+                    self._is_list = char == "["
+                elif self._depth == 1 and char == "{":
+                    self._row_chars = [char]
+                self._depth += 1
+
+            elif char in "}]" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 1 and self._row_chars is not None:
+                    row = self._close_row()
+                    if row is not None:
+                        completed_rows.append(row)
+                elif self._depth == 0:
+                    self._finished = True
+        return completed_rows
+
+    def _close_row(self):
+        text = "".join(self._row_chars)
+        self._row_chars = None
+        key = str(len(self.rows) + self.n_malformed) if self._is_list else self._key
+        try:
+            row = json.loads(text)
+        except json.JSONDecodeError:
+            self.n_malformed += 1
+            logging.info(f"Malformed row skipped: {text}")
+            return None
+        self.rows[key] = row
+        return key, row
+
+
+def extract_rows_as_dict(json_file: str) -> dict:
+    """Extract the complete rows of a JSON table, even truncated or malformed
+
+    Args:
+        json_file (str): JSON file
+
+    Returns:
+        dict: dictionary of rows, None if no row could be extracted
+    """
+    if not json_file:
+        return None
+    parser = TableStreamParser()
+    parser.feed(json_file)
+    if parser.rows:
+        logging.info(f"{len(parser.rows)} rows salvaged ({parser.n_malformed} malformed)")
+    return parser.rows or None
+
+
+async def astream_model_rows(model: str,
+                             prompt: str,
+                             role: str="user",
+                             on_row: Callable[[str, dict], None]=None,
+                             parser: Optional[TableStreamParser]=None,
+                             **kwargs) -> dict:
+    """Streams the response of the model and parses its rows as they are received.
+    Complete rows are kept if the response is truncated or partly malformed.
+
+    Args:
+        model (str): LLM model. Either 'gpt', 'mistral' or a local model.
+        prompt (str): Prompt to be used.
+        role (str, optional): user role used in prompting. Defaults to "user".
+        on_row (callable, optional): function called with (key, row) of each row as soon as
+            it is complete.
+        parser (TableStreamParser, optional): parser of the response, to inspect it after
+            the query. Defaults to a new parser.
+        **kwargs: other arguments of aprompt_model (request_index, seed, scheduler, n_tokens)
+
+    Returns:
+        dict: dictionary of rows, None if no row could be extracted
+    """
+    if parser is None:
+        parser = TableStreamParser()
+
+    def on_text(text: str):
+        for key, row in parser.feed(text):
+            if on_row is not None:
+                on_row(key, row)
+
+    await aprompt_model(model=model,
+                        prompt=prompt,
+                        role=role,
+                        on_text=on_text,
+                        **kwargs)
+    if parser.n_malformed:
+        logging.info(f"{parser.n_malformed} malformed rows skipped")
+    return parser.rows or None
+
+
 def extract_json_as_dict(json_file: str) -> dict:
     """Extract JSON file as dictionary
 
@@ -115,8 +835,65 @@ def extract_json_as_dict(json_file: str) -> dict:
     try:
         dictionary = json.loads(json_file)
         return dictionary
-    except(ValueError, json.JSONDecodeError):
+    except(ValueError, TypeError, json.JSONDecodeError):
         logging.info("JSON decode error")
         logging.info(json_file)
         return None
-    
\ No newline at end of file
+
+
+def extract_columnar_as_df(text: str) -> Optional[pd.DataFrame]:
+    """Extract a table returned in columnar JSON format ({"columns": [...], "rows": [[...], ...]})
+    as a dataframe. Complete rows are kept if the response is truncated or partly malformed.
+
+    Args:
+        text (str): response of the model
+
+    Returns:
+        pd.DataFrame: table with typed columns, None if no row could be extracted
+    """
+    if not text:
+        return None
+    table = extract_json_as_dict(text[text.find("{"):text.rfind("}") + 1])
+    if isinstance(table, dict) and isinstance(table.get("columns"), list) and isinstance(table.get("rows"), list):
+        columns, rows = table["columns"], table["rows"]
+    else:
+        # salvage the header and each complete row (rows hold scalar values only)
+        match_columns = re.search(r'"columns"\s*:\s*(\[[^\[\]]*\])', text)
+        start_rows = text.find('"rows"')
+        if match_columns is None or start_rows < 0:
+            return None
+        columns = extract_json_as_dict(match_columns.group(1))
+        rows = [extract_json_as_dict(row) for row in re.findall(r"\[[^\[\]]*\]", text[start_rows:])]
+        if not isinstance(columns, list):
+            return None
+    rows = [row for row in rows if isinstance(row, list) and len(row) == len(columns)]
+    if not rows:
+        return None
+    return pd.DataFrame(rows, columns=columns)
+
+
+def extract_csv_as_df(text: str) -> Optional[pd.DataFrame]:
+    """Extract a table returned in CSV format as a dataframe. Lines which do not have as many
+    values as the header (e.g. the last line of a truncated response) are skipped.
+
+    Args:
+        text (str): response of the model
+
+    Returns:
+        pd.DataFrame: table with typed columns, None if no row could be extracted
+    """
+    if not text:
+        return None
+    # remove markdown code fences
+    lines = [line for line in text.strip().splitlines() if line.strip() and not line.startswith("```")]
+    if len(lines) < 2:
+        return None
+    n_values = lines[0].count(",") + 1
+    lines = [lines[0]] + [line for line in lines[1:] if line.count(",") + 1 == n_values]
+    try:
+        df = pd.read_csv(io.StringIO("\n".join(lines)), skipinitialspace=True)
+    except (ValueError, pd.errors.ParserError):
+        logging.info("CSV decode error")
+        return None
+    return df if not df.empty else None
+
@@ -1,59 +1,694 @@
+import time
+import asyncio
+import functools
+import concurrent.futures
 import logging
 import pandas as pd
 from tqdm import tqdm
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple, Union
 
-from src.prompt_engineering.prompt_llm import prompt_model
+from src.prompt_engineering.prompt_llm import aprompt_model
+from src.prompt_engineering.prompt_llm import aclose_llm_clients
 from src.prompt_engineering.prompt_llm import extract_json_as_dict
-   
-def prompt_synth_tab(prompt: str,
+from src.prompt_engineering.prompt_llm import extract_rows_as_dict, astream_model_rows
+from src.prompt_engineering.prompt_llm import TableStreamParser
+from src.prompt_engineering.prompt_llm import PROVIDER_ERRORS
+from src.prompt_engineering.prompt_llm import extract_columnar_as_df, extract_csv_as_df
+from src.prompt_engineering.llm_cache import CacheMissError, get_response_cache
+from src.prompt_engineering.checkpoint import GenerationCheckpoint
+from src.prompt_engineering.scheduler import RequestScheduler
+from src.prompt_engineering.scheduler import get_scheduler, estimate_n_tokens
+from src.prompt_engineering.batch_size_controller import BatchSizeController
+from src.prompt_engineering.duplicate_index import DuplicateRowIndex
+from src.prompt_engineering.telemetry import TelemetryCollector, get_telemetry_collector
+from src.prompt_engineering.table_schema import get_table_schema
+from src.prompt_engineering.table_validator import TableValidator
+from src.prompt_engineering.repair import RowRepairer
+from src.prompt_engineering.quota import GenerationQuota
+from src.prompt_engineering.hedging import RequestHedger
+from src.prompt_engineering.model_router import ModelRouter
+from src.prompt_engineering.steering import DistributionSteerer
+import config as conf
+
+
+@dataclass
+class GenerationOptions:
+    """Optional collaborators of a text to tabular generation (see aprompt_synth_tab),
+    each disabled when None.
+
+    Args:
+        checkpoint (GenerationCheckpoint, optional): checkpoint where accepted chunks are
+            written instead of being kept in memory. Generation resumes from the rows
+            already checkpointed.
+        controller (BatchSizeController, optional): controller choosing the number of rows
+            of each query instead of n_rows. Requires a callable prompt.
+        duplicate_index (DuplicateRowIndex, optional): index removing the rows duplicating
+            rows already accepted, which are not counted in n_sample
+        repairer (RowRepairer, optional): repair of the rows with missing values, completed
+            by a follow-up query instead of being dropped
+        hedger (RequestHedger, optional): hedging of the slow queries to a secondary model,
+            the first table returned winning
+        router (ModelRouter, optional): router choosing the model of each query among a
+            pool of models instead of model. Rows are tagged with the model which generated
+            them in the column conf.COL_SOURCE_MODEL.
+        steerer (DistributionSteerer, optional): steering conditioning the prompts of the
+            queries on the under-filled strata of the accepted rows
+        telemetry (TelemetryCollector, optional): collector recording an event per query.
+            Defaults to the collector set with telemetry.set_telemetry_collector.
+    """
+    checkpoint: Optional[GenerationCheckpoint] = None
+    controller: Optional[BatchSizeController] = None
+    duplicate_index: Optional[DuplicateRowIndex] = None
+    repairer: Optional[RowRepairer] = None
+    hedger: Optional[RequestHedger] = None
+    router: Optional[ModelRouter] = None
+    steerer: Optional[DistributionSteerer] = None
+    telemetry: Optional[TelemetryCollector] = None
+
+
+def prompt_synth_tab(prompt: Union[str, Callable[[int], str]],
                      model: str,
                      n_rows: int,
                      n_sample: int,
                      role: str="user",
-                     show_progress: bool=True) -> str:
+                     show_progress: bool=True,
+                     max_concurrency: int=1,
+                     process_chunk: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None,
+                     scheduler: Optional[RequestScheduler]=None,
+                     seed: Optional[Union[int, str]]=None,
+                     stream: bool=False,
+                     output_format: str="json",
+                     row_schema: Optional[dict]=None,
+                     options: Optional[GenerationOptions]=None) -> pd.DataFrame:
     """
     Generates a synthetic tabular dataframe from a text describin the
     dataset to generate.
     The prompt must include the list of columns and their respective type to include.
     If ambiguous, columns shuold be described or units provided.
+    Queries are sent concurrently, see aprompt_synth_tab, the coroutine to await from a
+    running event loop (e.g. a notebook), where this function runs the generation in a thread.
+    Args:
+        prompt (str or callable): text to generate the synthetic dataset, or function
+            returning a new prompt of n_rows rows for each query (e.g. shuffled prompts)
+        model (str): LLM model to use
+        n_rows (int): number of rows to generate for each request to the API
+        n_sample (int): number of samples to generate
+        role (str): role of the user
+        show_progress (bool): whether to display a progress bar
+        max_concurrency (int): maximum number of queries in flight at the same time
+        process_chunk (callable, optional): function applied to each parsed chunk,
+            returning the cleaned chunk or None if the chunk is rejected
+        scheduler (RequestScheduler, optional): scheduler enforcing rate limits of the provider.
+            Defaults to a scheduler with the rate limits of the model set in config.
+        seed (int or str, optional): seed identifying the run, used with the index of each
+            query as cache key of the responses (see llm_cache)
+        stream (bool): whether to stream responses and parse their rows as they are received
+        output_format (str): format of the tables returned by the model: json, json_columnar
+            or csv (see TEXT2TAB_PROMPT_DICT). Only json responses are parsed while streamed.
+        row_schema (dict, optional): JSON schema of a row (see table_schema.get_row_schema).
+            Json responses of the models supporting structured outputs are constrained
+            to it, and the rows of all responses not matching it are dropped (see TableValidator).
+        options (GenerationOptions, optional): optional collaborators of the generation
+            (checkpoint, controller, duplicate index, repairer, hedger, router, steerer,
+            telemetry). Defaults to none of them.
+    """
+    async def run():
+        try:
+            return await aprompt_synth_tab(prompt=prompt,
+                                           model=model,
+                                           n_rows=n_rows,
+                                           n_sample=n_sample,
+                                           role=role,
+                                           show_progress=show_progress,
+                                           max_concurrency=max_concurrency,
+                                           process_chunk=process_chunk,
+                                           scheduler=scheduler,
+                                           seed=seed,
+                                           stream=stream,
+                                           output_format=output_format,
+                                           row_schema=row_schema,
+                                           options=options)
+        finally:
+            # async clients are bound to the event loop which is closed at the end of the run
+            await aclose_llm_clients()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run())
+    # called from a running event loop (e.g. a notebook): the generation runs in its own
+    # event loop in a thread, await aprompt_synth_tab to run it in the running loop instead
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, run()).result()
+
+
+async def aprompt_synth_tab(prompt: Union[str, Callable[[int], str]],
+                            model: str,
+                            n_rows: int,
+                            n_sample: int,
+                            role: str="user",
+                            show_progress: bool=True,
+                            max_concurrency: int=1,
+                            process_chunk: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None,
+                            scheduler: Optional[RequestScheduler]=None,
+                            seed: Optional[Union[int, str]]=None,
+                            stream: bool=False,
+                            output_format: str="json",
+                            row_schema: Optional[dict]=None,
+                            options: Optional[GenerationOptions]=None) -> pd.DataFrame:
+    """
+    Asynchronous version of prompt_synth_tab.
+    Keeps up to max_concurrency queries in flight and assembles the chunks as they
+    complete, until exactly n_sample rows have been accepted (see GenerationQuota): with
+    a callable prompt, the last queries only request the rows remaining, and the queries
+    still in flight once the sample is complete are cancelled. Queries that do not return
+    a valid table (or are rejected by process_chunk) are replaced by new ones, as are
+    queries failing with a provider error, until conf.MAX_CONSECUTIVE_FAILURES successive
+    queries fail. Rows with a few missing values are completed by repair queries, kept in
+    flight with the others.
+    Queries go through the scheduler which enforces the rate limits of the provider,
+    retries throttled queries and adapts the number of queries actually sent at once.
+    If a telemetry collector is set (see telemetry.set_telemetry_collector), an event
+    is recorded for each query.
+    If responses are cached (see llm_cache.set_response_cache), the plan of each query
+    (model, number of rows, prompt, repaired rows) is recorded under its index. In replay
+    mode, the recorded queries are sent again one at a time in the order they were
+    processed, so that the chunks are accepted as in the recorded run whatever the
+    collaborators or the completion order. Queries whose response was not complete
+    (e.g. truncated) are not cached and are skipped in replay.
     Args:
-        api_key (str): OpenAI API key
-        prompt (str): text to generate the synthetic dataset
-        model (strà): OpenAI model to use
+        prompt (str or callable): text to generate the synthetic dataset, or function
+            returning a new prompt of n_rows rows for each query (e.g. shuffled prompts)
+        model (str): LLM model to use
         n_rows (int): number of rows to generate for each request to the API
         n_sample (int): number of samples to generate
         role (str): role of the user
+        show_progress (bool): whether to display a progress bar
+        max_concurrency (int): maximum number of queries in flight at the same time
+        process_chunk (callable, optional): function applied to each parsed chunk,
+            returning the cleaned chunk or None if the chunk is rejected
+        scheduler (RequestScheduler, optional): scheduler enforcing rate limits of the provider.
+            Defaults to a scheduler with the rate limits of the model set in config.
+        seed (int or str, optional): seed identifying the run, used with the index of each
+            query as cache key of the responses (see llm_cache)
+        stream (bool): whether to stream responses and parse their rows as they are received
+        output_format (str): format of the tables returned by the model: json, json_columnar
+            or csv (see TEXT2TAB_PROMPT_DICT). Only json responses are parsed while streamed.
+        row_schema (dict, optional): JSON schema of a row (see table_schema.get_row_schema).
+            Json responses of the models supporting structured outputs are constrained
+            to it, and the rows of all responses not matching it are dropped (see TableValidator).
+        options (GenerationOptions, optional): optional collaborators of the generation
+            (checkpoint, controller, duplicate index, repairer, hedger, router, steerer,
+            telemetry). Defaults to none of them.
+
+    Returns:
+        pd.DataFrame: synthetic dataframe
     """
+    options = options or GenerationOptions()
+    checkpoint, controller, duplicate_index = options.checkpoint, options.controller, options.duplicate_index
+    repairer, hedger, router, steerer = options.repairer, options.hedger, options.router, options.steerer
+    telemetry = options.telemetry if options.telemetry is not None else get_telemetry_collector()
     synth_data = []
-    n_iter = n_sample // n_rows
-    
-    if show_progress:
-        pbar = tqdm(total=n_sample, desc="Synth data queries")
+    if controller is not None and not callable(prompt):
+        raise ValueError("The number of rows per query can only be adapted with a callable prompt")
+    if scheduler is None:
+        scheduler = get_scheduler(model=model, max_concurrency=max_concurrency)
+    # one scheduler per model queried, each enforcing the rate limits of its model
+    schedulers = {model: scheduler}
+
+    # number of queries sent, of successive queries not found in cache in replay mode
+    # and of successive queries failed
     k = 0
-    
-    while k < n_iter:
-        
-        logging.info(f"Synth data query n°{k}")
-        msg = prompt_model(model=model,
-                            prompt=prompt,
-                            role=role)
-        dictionary = extract_json_as_dict(msg)
-        
-        if dictionary:
-            df = pd.DataFrame.from_dict(dictionary, orient='index')
-            synth_data.append(df)
-            if show_progress:
-                pbar.update(len(df))
-            k += 1
-        else:
-            logging.info("No dictionary")
-            
+    n_cache_misses = 0
+    n_failures = 0
+    validator = TableValidator(row_schema) if row_schema is not None else None
+    n_synth_start = 0
+    if checkpoint is not None:
+        # resume from the rows and requests already checkpointed
+        n_synth_start = checkpoint.n_rows
+        k = checkpoint.next_request_index
+        logging.info(f"Resuming generation from checkpoint: {n_synth_start} rows, {k} queries")
+        if duplicate_index is not None and n_synth_start:
+            duplicate_index.add(checkpoint.load())
+    # rows accepted and requested by the queries in flight
+    quota = GenerationQuota(n_sample=n_sample, n_accepted=n_synth_start)
+
     if show_progress:
-        pbar.close()
-        
+        pbar = tqdm(total=n_sample, initial=quota.n_accepted, desc="Synth data queries")
+
+    pending, done = set(), set()
+    # chunks are assembled in the order of the queries, whatever their completion order
+    request_indexes = dict()
+    # model of each query in flight, number of rows chosen by the controller, queries
+    # routed by the router and start time of each query
+    query_models = dict()
+    query_sizes = dict()
+    routed_tasks = set()
+    query_starts = dict()
+    # repair queries in flight
+    repair_tasks = set()
+    # plans of the queries in flight recorded in the cache, plans of the recorded run read
+    # back in replay mode (see LLMResponseCache.put_plan)
+    cache = get_response_cache() if seed is not None else None
+    plans, replay_plans, replay_order, replay_repairs = dict(), None, None, dict()
+    n_processed = 0
+    max_in_flight = max_concurrency
+    if cache is not None and cache.replay:
+        replay_plans = cache.get_plans(run=str(seed))
+        replay_order = sorted((index for index, plan in replay_plans.items()
+                               if plan["status"] == "done" and index >= k),
+                              key=lambda index: replay_plans[index]["sequence"])
+        max_in_flight = 1
+        logging.info(f"Replaying {len(replay_order)} recorded queries")
+    elif cache is not None:
+        n_processed = 1 + max((plan["sequence"] for plan in cache.get_plans(run=str(seed)).values()), default=-1)
+
+    def send_query(request_index: int, model_k: str, n_rows_k: int, prompt_k: str, hedged: bool) -> asyncio.Task:
+        if model_k not in schedulers:
+            schedulers[model_k] = get_scheduler(model=model_k, max_concurrency=max_concurrency)
+        logging.info(f"Synth data query n°{request_index} ({n_rows_k} rows, {model_k})")
+        query = functools.partial(_aquery_chunk,
+                                  prompt=prompt_k,
+                                  n_rows=n_rows_k,
+                                  role=role,
+                                  request_index=request_index,
+                                  seed=seed,
+                                  stream=stream,
+                                  output_format=output_format,
+                                  row_schema=row_schema)
+        if hedged:
+            task = asyncio.create_task(hedger.run(query=query,
+                                                  model=model_k,
+                                                  scheduler=schedulers[model_k],
+                                                  n_prompt_tokens=estimate_n_tokens(prompt_k)))
+        else:
+            task = asyncio.create_task(query(model=model_k, scheduler=schedulers[model_k]))
+        request_indexes[task] = request_index
+        query_models[task] = model_k
+        query_starts[task] = time.monotonic()
+        quota.reserve(task, n_rows_k)
+        pending.add(task)
+        plans[task] = {"kind": "query", "model": model_k, "n_rows": n_rows_k, "prompt": prompt_k}
+        return task
+
+    def send_repair(request_index: int, df_incomplete: pd.DataFrame, model_k: str, prompt_k: str, parent: int):
+        # incomplete rows still needed are completed by a repair query, counted as a
+        # query of the run
+        logging.info(f"Synth data query n°{request_index} (repair of {len(df_incomplete)} rows)")
+        task = asyncio.create_task(_arepair_chunk(df_incomplete=df_incomplete,
+                                                  repairer=repairer,
+                                                  model=model_k,
+                                                  scheduler=schedulers.get(model_k, scheduler),
+                                                  role=role,
+                                                  request_index=request_index,
+                                                  seed=seed,
+                                                  prompt=prompt_k))
+        request_indexes[task] = request_index
+        query_models[task] = model_k
+        quota.reserve(task, len(df_incomplete))
+        repair_tasks.add(task)
+        pending.add(task)
+        plans[task] = {"kind": "repair", "model": model_k, "n_rows": len(df_incomplete),
+                       "prompt": prompt_k, "parent": parent}
+
+    def record_plan(task: asyncio.Task, **outcome):
+        # plan of a processed query, numbered in the order the queries are processed
+        nonlocal n_processed
+        plan = plans.pop(task)
+        if cache is not None and replay_plans is None:
+            cache.put_plan(run=str(seed),
+                           request_index=request_indexes[task],
+                           plan={**plan, **outcome, "sequence": n_processed})
+            n_processed += 1
+
+    start_time = time.monotonic()
+    try:
+        while not quota.is_met:
+
+            # fill the pool of in-flight queries without requesting more rows than needed
+            while len(pending) < max_in_flight and quota.n_remaining > quota.n_in_flight:
+                if replay_order is not None:
+                    # the recorded queries are sent again as recorded, in the order they
+                    # were processed, the queries failed or cancelled being skipped
+                    if not replay_order:
+                        break
+                    k_replay = replay_order.pop(0)
+                    plan_k = replay_plans[k_replay]
+                    if plan_k["kind"] == "repair":
+                        if k_replay in replay_repairs:
+                            send_repair(request_index=k_replay,
+                                        df_incomplete=replay_repairs.pop(k_replay).iloc[:plan_k["n_rows"]],
+                                        model_k=plan_k["model"],
+                                        prompt_k=plan_k["prompt"],
+                                        parent=plan_k["parent"])
+                    else:
+                        send_query(request_index=k_replay,
+                                   model_k=plan_k["model"],
+                                   n_rows_k=plan_k["n_rows"],
+                                   prompt_k=plan_k["prompt"],
+                                   hedged=False)
+                    k = max(k, k_replay + 1)
+                    continue
+                model_k = router.choose() if router is not None else model
+                n_rows_k = n_rows_chosen = controller.choose(model_k) if controller is not None else n_rows
+                if callable(prompt):
+                    # the last queries request the rows remaining only
+                    n_rows_k = quota.get_size(n_rows_k)
+                prompt_k = prompt(n_rows_k) if callable(prompt) else prompt
+                if steerer is not None:
+                    prompt_k += steerer.get_conditioning()
+                task = send_query(request_index=k,
+                                  model_k=model_k,
+                                  n_rows_k=n_rows_k,
+                                  prompt_k=prompt_k,
+                                  hedged=hedger is not None)
+                if controller is not None:
+                    query_sizes[task] = n_rows_chosen
+                if router is not None:
+                    routed_tasks.add(task)
+                k += 1
+
+            if not pending:
+                logging.info("Replay: no recorded query left")
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                n_rows_k = quota.release(task)
+                n_rows_chosen = query_sizes.pop(task, None)
+                if n_rows_chosen is not None:
+                    controller.release(model=query_models[task], n_rows=n_rows_chosen)
+                query_start = query_starts.pop(task, None)
+                if task in routed_tasks:
+                    router.release(model=query_models[task])
+                    routed_tasks.discard(task)
+                is_repair = task in repair_tasks
+                repair_tasks.discard(task)
+                try:
+                    df, query_info = task.result()
+                    n_cache_misses = 0
+                except CacheMissError:
+                    # in replay mode, queries cancelled in the recorded run are not cached:
+                    # the replay fails only when more than a full pool of queries is missing
+                    n_cache_misses += 1
+                    if n_cache_misses > max_concurrency:
+                        raise
+                    logging.info("Query not found in cache")
+                    plans.pop(task, None)
+                    continue
+                except PROVIDER_ERRORS as e:
+                    # a failed query is replaced as a rejected chunk, the rows in flight
+                    # and accepted being kept unless the provider keeps failing
+                    n_failures += 1
+                    logging.info(f"Synth data query n°{request_indexes[task]} failed "
+                                 f"({n_failures} successive failures): {e!r}")
+                    if telemetry is not None:
+                        telemetry.record(request_index=request_indexes[task],
+                                         model=query_models[task],
+                                         n_rows=n_rows_k,
+                                         n_parsed_rows=0,
+                                         n_valid_rows=0,
+                                         repair=is_repair,
+                                         latency=None,
+                                         n_output_tokens=0,
+                                         parsed=False,
+                                         prompt_tokens=None,
+                                         completion_tokens=None,
+                                         n_attempts=None,
+                                         cached=False,
+                                         error=type(e).__name__)
+                    if router is not None and not is_repair:
+                        # a failed query yields no row for the full price of its request
+                        router.record(model=query_models[task],
+                                      latency=time.monotonic() - query_start,
+                                      n_parsed_rows=0,
+                                      n_valid_rows=0,
+                                      prompt_tokens=estimate_n_tokens(plans[task]["prompt"]),
+                                      completion_tokens=n_rows_k * conf.LLM_COMPLETION_TOKENS_PER_ROW)
+                    record_plan(task, status="failed")
+                    if n_failures >= conf.MAX_CONSECUTIVE_FAILURES:
+                        raise
+                    continue
+                n_failures = 0
+                # model which answered the query, the secondary model if a hedge won
+                model_k = query_info.pop("model", query_models[task])
+                n_parsed_rows = 0 if df is None else len(df)
+                df_incomplete = None
+                if df is not None and repairer is not None and not is_repair:
+                    df, df_incomplete = repairer.split(df)
+                if df is not None and validator is not None:
+                    df, _ = validator.validate(df)
+                    query_info["n_schema_rejected_rows"] = n_parsed_rows - (0 if df is None else len(df))
+                if df is not None and process_chunk is not None:
+                    df = process_chunk(df)
+                if df is not None and duplicate_index is not None:
+                    df = duplicate_index.filter(df, model=model_k)
+                n_valid_rows = 0 if df is None else len(df)
+                # queries sized to the rows remaining are not representative of their size
+                if controller is not None and not is_repair and n_rows_k == n_rows_chosen:
+                    controller.record(model=model_k,
+                                      n_rows=n_rows_k,
+                                      latency=query_info["latency"],
+                                      n_valid_rows=n_valid_rows,
+                                      n_output_tokens=query_info["n_output_tokens"],
+                                      parsed=query_info["parsed"])
+                if router is not None and not is_repair:
+                    router.record(model=model_k,
+                                  latency=query_info["latency"],
+                                  n_parsed_rows=n_parsed_rows,
+                                  n_valid_rows=n_valid_rows,
+                                  prompt_tokens=query_info.get("prompt_tokens"),
+                                  completion_tokens=query_info.get("completion_tokens"))
+                if telemetry is not None:
+                    telemetry.record(request_index=request_indexes[task],
+                                     model=model_k,
+                                     n_rows=n_rows_k,
+                                     n_parsed_rows=n_parsed_rows,
+                                     n_valid_rows=n_valid_rows,
+                                     repair=is_repair,
+                                     **query_info)
+                df = quota.accept(df)
+                if df is not None and steerer is not None:
+                    steerer.record(df)
+
+                repair_index = None
+                if replay_plans is not None:
+                    # the recorded repair is sent in its turn, with the rows of this chunk
+                    repair_index = replay_plans[request_indexes[task]].get("repair_index")
+                    if repair_index is not None and df_incomplete is not None:
+                        replay_repairs[repair_index] = df_incomplete
+                else:
+                    n_rows_repair = quota.get_size(0 if df_incomplete is None else len(df_incomplete))
+                    if n_rows_repair:
+                        repair_index = k
+                        send_repair(request_index=k,
+                                    df_incomplete=df_incomplete.iloc[:n_rows_repair],
+                                    model_k=model_k,
+                                    prompt_k=repairer.render(df_incomplete.iloc[:n_rows_repair]),
+                                    parent=request_indexes[task])
+                        k += 1
+                # responses not complete are not cached, their queries are skipped in replay
+                complete = query_info.get("cached") or query_info.get("finish_reason") == "stop"
+                record_plan(task, status="done" if complete else "partial", model=model_k, repair_index=repair_index)
+
+                if df is None:
+                    logging.info("No dictionary")
+                    continue
+                if router is not None:
+                    df = df.assign(**{conf.COL_SOURCE_MODEL: model_k})
+                if checkpoint is not None:
+                    await asyncio.to_thread(checkpoint.add_chunk, request_indexes[task], df)
+                else:
+                    synth_data.append((request_indexes[task], df))
+                if show_progress:
+                    pbar.update(len(df))
+    finally:
+        # queries still in flight once the sample is complete are not needed
+        quota.cancel_all()
+        for model_s, scheduler_s in schedulers.items():
+            logging.info(f"Scheduler stats ({model_s}): {scheduler_s.stats}")
+        logging.info(f"Quota: {quota.get_report()}")
+        elapsed = time.monotonic() - start_time
+        logging.info(f"Throughput: {(quota.n_accepted - n_synth_start) / max(elapsed, 1e-9):.2f} rows/s")
+        if validator is not None:
+            logging.info(f"Rows rejected by validation:\n{validator.get_report().to_string(index=False)}")
+        if controller is not None:
+            controller.log_report()
+        if repairer is not None:
+            logging.info(f"Repair queries: {repairer.get_report()}")
+        if hedger is not None:
+            logging.info(f"Hedged queries: {hedger.get_report()}")
+        if router is not None:
+            router.log_report()
+        if steerer is not None:
+            steerer.log_report()
+        if duplicate_index is not None:
+            logging.info(f"Duplicated rows:\n{duplicate_index.get_report().to_string(index=False)}")
+        if telemetry is not None:
+            logging.info(f"LLM queries summary: {telemetry.get_summary(elapsed=elapsed)}")
+        for task in pending:
+            task.cancel()
+        # retrieve outcome of cancelled or unprocessed queries
+        await asyncio.gather(*pending, *done, return_exceptions=True)
+        if show_progress:
+            pbar.close()
+
     # formatting synthetic data into a dataframe
-    df_synth = pd.concat(synth_data, axis=0)
+    if checkpoint is not None:
+        df_synth = checkpoint.load()
+    else:
+        df_synth = pd.concat([df for _, df in sorted(synth_data, key=lambda x: x[0])], axis=0) if synth_data else pd.DataFrame()
     logging.info(f"Shape of synthetic dataframe: {df_synth.shape}")
-    
+
     return df_synth
-            
\ No newline at end of file
+
+
+async def _aquery_chunk(prompt: str,
+                        model: str,
+                        n_rows: int,
+                        scheduler: RequestScheduler,
+                        role: str="user",
+                        request_index: Optional[int]=None,
+                        seed: Optional[Union[int, str]]=None,
+                        stream: bool=False,
+                        output_format: str="json",
+                        row_schema: Optional[dict]=None) -> Tuple[Optional[pd.DataFrame], dict]:
+    """Sends one query to the model through the scheduler and parses the response as a dataframe
+
+    Args:
+        prompt (str): prompt to be used
+        model (str): LLM model to use
+        n_rows (int): number of rows requested, used to estimate the tokens of the query
+        scheduler (RequestScheduler): scheduler of the queries to the provider
+        role (str): role of the user
+        request_index (int, optional): index of the query in the run
+        seed (int or str, optional): seed identifying the run
+        stream (bool): whether to stream the response and parse its rows as they are received
+        output_format (str): format of the table in the response (see parse_table_response)
+        row_schema (dict, optional): JSON schema of a row, constraining json responses to
+            a table of n_rows such rows
+
+    Returns:
+        pd.DataFrame: parsed chunk, None if the response is not a valid table
+        dict: latency (seconds), number of output tokens, whether the response was parsed
+            as a table and usage of the query (see prompt_llm._init_usage)
+    """
+    n_tokens = estimate_n_tokens(prompt) + n_rows * conf.LLM_COMPLETION_TOKENS_PER_ROW
+    usage = dict()
+    response_schema = None
+    if row_schema is not None and output_format == "json":
+        response_schema = get_table_schema(row_schema, n_rows=n_rows)
+    start_time = time.monotonic()
+    if stream and output_format == "json":
+        parser = TableStreamParser()
+        dictionary = await astream_model_rows(model=model,
+                                              prompt=prompt,
+                                              role=role,
+                                              parser=parser,
+                                              usage=usage,
+                                              response_schema=response_schema,
+                                              request_index=request_index,
+                                              seed=seed,
+                                              scheduler=scheduler,
+                                              n_tokens=n_tokens)
+        # a token is about 4 characters
+        n_output_tokens = parser.n_chars // 4
+        df = pd.DataFrame.from_dict(dictionary, orient='index') if dictionary else None
+    else:
+        msg = await aprompt_model(model=model,
+                                  prompt=prompt,
+                                  role=role,
+                                  request_index=request_index,
+                                  seed=seed,
+                                  scheduler=scheduler,
+                                  n_tokens=n_tokens,
+                                  usage=usage,
+                                  response_schema=response_schema)
+        n_output_tokens = estimate_n_tokens(msg or "")
+        df = parse_table_response(msg, output_format=output_format)
+    if usage.get("completion_tokens") is not None:
+        n_output_tokens = usage["completion_tokens"]
+    query_info = {"latency": time.monotonic() - start_time,
+                  "n_output_tokens": n_output_tokens,
+                  "parsed": df is not None,
+                  **usage}
+    return df, query_info
+
+
+def parse_table_response(msg: str, output_format: str="json") -> Optional[pd.DataFrame]:
+    """Parses the response of a model as a dataframe
+
+    Args:
+        msg (str): response of the model
+        output_format (str): format of the table in the response: json, json_columnar
+            or csv (see TEXT2TAB_PROMPT_DICT). Defaults to json.
+
+    Returns:
+        pd.DataFrame: parsed table, None if no row could be extracted
+    """
+    if output_format == "json":
+        dictionary = extract_json_as_dict(msg)
+        if not isinstance(dictionary, dict):
+            # keep the complete rows of truncated or malformed responses
+            dictionary = extract_rows_as_dict(msg)
+        if not dictionary:
+            return None
+        return pd.DataFrame.from_dict(dictionary, orient='index')
+    elif output_format == "json_columnar":
+        return extract_columnar_as_df(msg)
+    elif output_format == "csv":
+        return extract_csv_as_df(msg)
+    else:
+        raise ValueError(f"Output format {output_format} not implemented")
+
+
+async def _arepair_chunk(df_incomplete: pd.DataFrame,
+                         repairer: RowRepairer,
+                         model: str,
+                         scheduler: RequestScheduler,
+                         role: str="user",
+                         request_index: Optional[int]=None,
+                         seed: Optional[Union[int, str]]=None,
+                         prompt: Optional[str]=None) -> Tuple[Optional[pd.DataFrame], dict]:
+    """Sends the repair query of incomplete rows through the scheduler and merges its response
+
+    Args:
+        df_incomplete (pd.DataFrame): rows to repair (see RowRepairer.split)
+        repairer (RowRepairer): repair of the rows
+        model (str): LLM model to use
+        scheduler (RequestScheduler): scheduler of the queries to the provider
+        role (str): role of the user
+        request_index (int, optional): index of the query in the run
+        seed (int or str, optional): seed identifying the run
+        prompt (str, optional): repair prompt (e.g. recorded in the plan of the run).
+            Defaults to the prompt rendered by the repairer.
+
+    Returns:
+        pd.DataFrame: rows repaired
+        dict: latency (seconds), number of output tokens, whether the response was parsed
+            and usage of the query, as _aquery_chunk
+    """
+    if prompt is None:
+        prompt = repairer.render(df_incomplete)
+    n_fields = int(df_incomplete.isna().to_numpy().sum())
+    n_tokens = estimate_n_tokens(prompt) + n_fields * conf.LLM_COMPLETION_TOKENS_PER_ROW // max(len(df_incomplete.columns), 1)
+    usage = dict()
+    start_time = time.monotonic()
+    msg = await aprompt_model(model=model,
+                              prompt=prompt,
+                              role=role,
+                              request_index=request_index,
+                              seed=seed,
+                              scheduler=scheduler,
+                              n_tokens=n_tokens,
+                              usage=usage)
+    df = repairer.merge(df_incomplete, msg)
+    n_output_tokens = estimate_n_tokens(msg or "")
+    if usage.get("completion_tokens") is not None:
+        n_output_tokens = usage["completion_tokens"]
+    query_info = {"latency": time.monotonic() - start_time,
+                  "n_output_tokens": n_output_tokens,
+                  "parsed": msg is not None,
+                  **usage}
+    return df, query_info
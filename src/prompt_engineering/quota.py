@@ -0,0 +1,90 @@
+""" Exact accounting of the rows of a generation"""
+import logging
+import pandas as pd
+from typing import Hashable, Optional
+
+
+class GenerationQuota:
+    """Quota of rows of a generation, shared by the queries in flight.
+    Each query reserves the rows it requests, sized to the rows not yet accepted nor
+    requested by the queries in flight, so that the last queries request exactly what
+    remains. Accepted chunks are truncated to the rows remaining, so that the generation
+    returns exactly n_sample rows, and the queries still in flight once the quota is met
+    are counted as cancelled.
+
+    Args:
+        n_sample (int): number of rows to generate
+        n_accepted (int, optional): number of rows already accepted (e.g. loaded from a
+            checkpoint). Defaults to 0.
+    """
+
+    def __init__(self, n_sample: int, n_accepted: int=0):
+        self.n_sample = n_sample
+        self.n_accepted = min(n_accepted, n_sample)
+        self.reserved = dict()
+        self.stats = {"n_requested_rows": 0,
+                      "n_truncated_rows": 0,
+                      "n_cancelled_queries": 0,
+                      "n_cancelled_rows": 0}
+
+    @property
+    def n_remaining(self) -> int:
+        """Number of rows not yet accepted"""
+        return self.n_sample - self.n_accepted
+
+    @property
+    def n_in_flight(self) -> int:
+        """Number of rows requested by the queries in flight"""
+        return sum(self.reserved.values())
+
+    @property
+    def is_met(self) -> bool:
+        """Whether all the rows have been accepted"""
+        return self.n_accepted >= self.n_sample
+
+    def get_size(self, n_rows: int) -> int:
+        """Number of rows of a new query: n_rows, or the rows neither accepted nor in flight
+        if fewer (0 if none)"""
+        return max(0, min(n_rows, self.n_remaining - self.n_in_flight))
+
+    def reserve(self, query: Hashable, n_rows: int):
+        """Reserves the rows requested by a query in flight"""
+        self.reserved[query] = n_rows
+        self.stats["n_requested_rows"] += n_rows
+
+    def release(self, query: Hashable) -> int:
+        """Releases the rows reserved by a completed query, returning their number"""
+        return self.reserved.pop(query, 0)
+
+    def accept(self, df: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        """Accepts the valid rows of a chunk, truncated to the rows remaining
+
+        Args:
+            df (pd.DataFrame): valid rows of a chunk
+
+        Returns:
+            pd.DataFrame: rows accepted, None if none
+        """
+        if df is None or not len(df) or self.is_met:
+            if df is not None:
+                self.stats["n_truncated_rows"] += len(df)
+            return None
+        if len(df) > self.n_remaining:
+            self.stats["n_truncated_rows"] += len(df) - self.n_remaining
+            df = df.iloc[:self.n_remaining]
+        self.n_accepted += len(df)
+        return df
+
+    def cancel_all(self):
+        """Counts the queries still in flight as cancelled and releases their rows"""
+        if self.reserved:
+            logging.info(f"Quota met: {len(self.reserved)} queries in flight cancelled ({self.n_in_flight} rows)")
+        self.stats["n_cancelled_queries"] += len(self.reserved)
+        self.stats["n_cancelled_rows"] += self.n_in_flight
+        self.reserved.clear()
+
+    def get_report(self) -> dict:
+        """Rows accepted, requested, truncated from accepted chunks and cancelled in flight"""
+        return {"n_sample": self.n_sample,
+                "n_accepted": self.n_accepted,
+                **self.stats}
@@ -0,0 +1,110 @@
+""" Repair of the rows generated with missing values by a follow-up prompt"""
+import logging
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+import config as conf
+from src.prompt_engineering.prompt_llm import extract_json_as_dict, extract_rows_as_dict
+
+
+class RowRepairer:
+    """Repair of the incomplete rows of the generated chunks.
+    Instead of dropping a row with a few missing values (null or missing column), a much
+    smaller follow-up prompt sends the incomplete rows and the description of their missing
+    variables only, and asks for the missing values, which are merged back into the rows.
+
+    Args:
+        columns (list): columns of the synthetic table
+        variable_lines (dict, optional): description line of each variable, by variable name
+            (see CompiledPrompt.variable_lines). Variables without line are described by name.
+        max_missing_fields (int, optional): rows with more missing values are not repaired.
+            Defaults to conf.REPAIR_MAX_MISSING_FIELDS.
+        template (str, optional): template of the repair prompt, with variables_description
+            and rows items. Defaults to conf.REPAIR_PROMPT.
+    """
+
+    def __init__(self,
+                 columns: list,
+                 variable_lines: Optional[dict]=None,
+                 max_missing_fields: Optional[int]=None,
+                 template: Optional[str]=None):
+        self.columns = list(columns)
+        self.variable_lines = variable_lines or dict()
+        self.max_missing_fields = max_missing_fields if max_missing_fields is not None else conf.REPAIR_MAX_MISSING_FIELDS
+        self.template = template or conf.REPAIR_PROMPT
+        self.stats = {"n_queries": 0, "n_rows": 0, "n_fields": 0, "n_rows_repaired": 0}
+
+    def split(self, df: pd.DataFrame) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+        """Splits a chunk into its complete rows and its rows to repair. Rows with more
+        than max_missing_fields missing values are kept with the complete rows, to be
+        rejected by validation.
+
+        Args:
+            df (pd.DataFrame): parsed chunk
+
+        Returns:
+            pd.DataFrame: complete rows, None if none
+            pd.DataFrame: rows to repair with all the columns, None if none
+        """
+        df = df.reindex(columns=list(df.columns) + [col for col in self.columns if col not in df.columns])
+        n_missing = df[self.columns].isna().to_numpy().sum(axis=1)
+        to_repair = (n_missing > 0) & (n_missing <= self.max_missing_fields)
+        df_complete = df[~to_repair] if (~to_repair).any() else None
+        df_incomplete = df.loc[to_repair, self.columns] if to_repair.any() else None
+        return df_complete, df_incomplete
+
+    def render(self, df_incomplete: pd.DataFrame) -> str:
+        """Repair prompt of incomplete rows, keyed by their position
+
+        Args:
+            df_incomplete (pd.DataFrame): rows to repair (see split)
+
+        Returns:
+            str: repair prompt
+        """
+        missing_columns = [col for col in self.columns if df_incomplete[col].isna().any()]
+        variables_description = "\n".join(self.variable_lines.get(col, col) for col in missing_columns)
+        rows = df_incomplete.reset_index(drop=True).to_json(orient="index")
+        return self.template.format(variables_description=variables_description, rows=rows)
+
+    def merge(self, df_incomplete: pd.DataFrame, msg: Optional[str]) -> pd.DataFrame:
+        """Fills the missing values of the incomplete rows with the values of the repair
+        response. Other values of the rows are left unchanged.
+
+        Args:
+            df_incomplete (pd.DataFrame): rows to repair (see split)
+            msg (str): response to the repair prompt
+
+        Returns:
+            pd.DataFrame: rows repaired, with the values still missing if any
+        """
+        is_missing = df_incomplete.isna().to_numpy()
+        self.stats["n_queries"] += 1
+        self.stats["n_rows"] += len(df_incomplete)
+        self.stats["n_fields"] += int(is_missing.sum())
+
+        dictionary = extract_json_as_dict(msg) if msg else None
+        if not isinstance(dictionary, dict):
+            dictionary = extract_rows_as_dict(msg) or dict()
+        df_filled = pd.DataFrame.from_dict({key: row for key, row in dictionary.items() if isinstance(row, dict)},
+                                           orient="index")
+        if df_filled.empty:
+            return df_incomplete
+        # keys of the response are the positions of the rows in the repair prompt
+        df_filled.index = pd.to_numeric(df_filled.index, errors="coerce")
+        df_filled = df_filled[df_filled.index.notna()]
+        df_filled = df_filled.reindex(index=range(len(df_incomplete)), columns=df_incomplete.columns)
+        df_filled.index = df_incomplete.index
+        df_repaired = df_incomplete.astype(object).mask(is_missing, df_filled.astype(object))
+
+        n_rows_repaired = int((~df_repaired.isna().to_numpy().any(axis=1)).sum())
+        self.stats["n_rows_repaired"] += n_rows_repaired
+        logging.info(f"{n_rows_repaired} rows repaired out of {len(df_incomplete)}")
+        return df_repaired.infer_objects()
+
+    def get_report(self) -> dict:
+        """Number of repair queries, of rows and missing values sent and of rows repaired"""
+        return {**self.stats,
+                "repair_rate": self.stats["n_rows_repaired"] / self.stats["n_rows"] if self.stats["n_rows"] else np.nan}
+
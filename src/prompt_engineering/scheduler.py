@@ -0,0 +1,267 @@
+""" Rate-limit-aware scheduling of LLM requests"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional
+
+import config as conf
+
+
+class RateLimitError(Exception):
+    """Raised when a request is throttled by the provider (HTTP 429)"""
+
+    def __init__(self, message: str=None, retry_after: Optional[float]=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    """Raised when a request fails for a reason worth retrying (server or connection error)"""
+
+
+def parse_retry_after(headers: dict) -> Optional[float]:
+    """Get the delay (s) requested by the provider before retrying from response headers
+
+    Args:
+        headers (dict): response headers
+
+    Returns:
+        float: delay in seconds, None if not provided
+    """
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # retry-after can also be an HTTP date
+    try:
+        date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def estimate_n_tokens(text: str) -> int:
+    """Rough estimate of the number of tokens of a text (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute and holding at most capacity tokens.
+    Tokens are reserved ahead: a reservation larger than the available tokens puts the
+    bucket in debt and the caller waits until the debt is refilled.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float]=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Reserves amount tokens and returns the delay (s) to wait before using them"""
+        self._refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self, amount: float):
+        """Gives back tokens reserved but not used"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    async def acquire(self, amount: float):
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RequestScheduler:
+    """Schedules requests to a LLM provider within requests-per-minute and tokens-per-minute
+    budgets (token buckets). Throttled requests (RateLimitError) are retried after the
+    Retry-After delay plus an exponential backoff with jitter, and the number of requests
+    in flight is adapted with AIMD: +1 per round of successful requests, multiplied by
+    decrease_factor when the provider throttles.
+
+    Args:
+        max_concurrency (int): maximum number of requests in flight
+        min_concurrency (int): minimum number of requests in flight
+        requests_per_minute (float, optional): requests budget. Defaults to None (no limit).
+        tokens_per_minute (float, optional): tokens budget. Defaults to None (no limit).
+        max_retries (int): maximum number of retries of a request
+        backoff_base (float): base delay (s) of the exponential backoff
+        backoff_max (float): maximum delay (s) of the exponential backoff
+        decrease_factor (float): multiplicative decrease of concurrency on throttling
+    """
+
+    def __init__(self,
+                 max_concurrency: int=8,
+                 min_concurrency: int=1,
+                 requests_per_minute: Optional[float]=None,
+                 tokens_per_minute: Optional[float]=None,
+                 max_retries: int=10,
+                 backoff_base: float=1.0,
+                 backoff_max: float=60.0,
+                 decrease_factor: float=0.5):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.concurrency = float(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters = deque()
+        # own generator so that the jitter of the retries does not change the shuffling of the prompts
+        self._random = random.Random()
+        self.stats = {"n_requests": 0,
+                      "n_throttled": 0,
+                      "n_transient_errors": 0,
+                      "n_retries": 0,
+                      "min_concurrency_reached": self.max_concurrency}
+
+    async def submit(self,
+                     call: Callable[[], Awaitable[Any]],
+                     n_tokens: int=0) -> Any:
+        """Sends a request once budgets and concurrency allow it, retrying it if throttled
+
+        Args:
+            call (callable): function returning the awaitable request
+            n_tokens (int, optional): estimated number of tokens of the request. Defaults to 0.
+
+        Returns:
+            result of the request
+        """
+        attempt = 0
+        while True:
+            await self._acquire_slot()
+            try:
+                await self._wait_budget(n_tokens=n_tokens)
+                started_at = time.monotonic()
+                self.stats["n_requests"] += 1
+                try:
+                    return self._on_success(await call())
+                except RateLimitError as e:
+                    self._on_throttled(started_at=started_at, retry_after=e.retry_after)
+                    error, retry_after = e, e.retry_after
+                except TransientError as e:
+                    self.stats["n_transient_errors"] += 1
+                    error, retry_after = e, None
+            finally:
+                self._release_slot()
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logging.info(f"Request failed after {self.max_retries} retries")
+                raise error
+            self.stats["n_retries"] += 1
+            delay = self._get_backoff(attempt=attempt, retry_after=retry_after)
+            logging.info(f"Request throttled or failed, retry n°{attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _wait_budget(self, n_tokens: int):
+        # wait for the end of a pause requested by the provider
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.request_bucket:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket and n_tokens:
+            await self.token_bucket.acquire(n_tokens)
+
+    async def _acquire_slot(self):
+        while self.in_flight >= int(self.concurrency):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # a cancelled waiter that had been woken up passes the free slot on
+                if not waiter.cancelled():
+                    self._wake_waiters()
+                raise
+        self.in_flight += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        n_free = int(self.concurrency) - self.in_flight
+        while n_free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                n_free -= 1
+
+    def _on_success(self, result: Any) -> Any:
+        # additive increase: +1 request in flight per round of successful requests
+        if self.concurrency < self.max_concurrency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._wake_waiters()
+        return result
+
+    def _on_throttled(self, started_at: float, retry_after: Optional[float]):
+        self.stats["n_throttled"] += 1
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+        # multiplicative decrease, once per throttling episode: requests sent before the
+        # last decrease were sent at the former concurrency
+        if started_at >= self._last_decrease:
+            self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease_factor)
+            self._last_decrease = now
+            self.stats["min_concurrency_reached"] = min(self.stats["min_concurrency_reached"],
+                                                        int(self.concurrency))
+            logging.info(f"Throttled by provider, concurrency decreased to {int(self.concurrency)}")
+
+    def _get_backoff(self, attempt: int, retry_after: Optional[float]=None) -> float:
+        # exponential backoff with full jitter, on top of the delay requested by the provider
+        delay = self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            delay += retry_after
+        return delay
+
+
+def get_scheduler(model: str,
+                  max_concurrency: int) -> RequestScheduler:
+    """Creates a request scheduler with the rate limits of the model set in conf.LLM_RATE_LIMITS
+
+    Args:
+        model (str): LLM model
+        max_concurrency (int): maximum number of requests in flight
+
+    Returns:
+        RequestScheduler: request scheduler
+    """
+    rate_limits = conf.LLM_RATE_LIMITS.get(model, dict())
+    return RequestScheduler(max_concurrency=max_concurrency,
+                            requests_per_minute=rate_limits.get("requests_per_minute"),
+                            tokens_per_minute=rate_limits.get("tokens_per_minute"),
+                            max_retries=conf.LLM_MAX_RETRIES,
+                            backoff_base=conf.LLM_BACKOFF_BASE,
+                            backoff_max=conf.LLM_BACKOFF_MAX)
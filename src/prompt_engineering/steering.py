@@ -0,0 +1,176 @@
+""" Steering of the generation towards target marginal distributions"""
+import math
+import random
+import logging
+import numpy as np
+import pandas as pd
+from typing import Optional, Union
+
+import config as conf
+from src.prompt_engineering.table_schema import parse_category_map
+
+
+def get_steering_targets(targets: dict, ref_var: Optional[dict]=None) -> dict:
+    """Target marginal distributions of the columns, discretized into strata.
+    The target of a column is given (see conf.STEERING_TARGETS) either by:
+    - the weights of its categories: {"weights": {category: weight}}
+    - the weights of bins of values: {"bins": [edges], "weights": [weight of each bin]}
+    - its mean and standard deviation: {"mean": m, "std": s}, normal distribution over
+      n_bins bins between the bounds of the referential (mean +/- 3 std if none)
+    - {"uniform": True}: uniform over the categories of the referential, or over n_bins
+      bins between its bounds
+
+    Args:
+        targets (dict): target of each column
+        ref_var (dict, optional): referential of the variables, by variable name
+
+    Returns:
+        dict: strata of each column: categories or bin edges, and target share of each stratum
+    """
+    ref_var = ref_var or dict()
+    steering_targets = dict()
+    for col, target in targets.items():
+        var_dict = ref_var.get(col, dict())
+        categories = parse_category_map(var_dict.get(conf.REFERENTIAL_VAR_CAT_MAPPING))
+        n_bins = target.get("n_bins", conf.STEERING_N_BINS)
+        if isinstance(target.get("weights"), dict):
+            strata = {"categories": list(target["weights"]), "weights": list(target["weights"].values())}
+        elif "bins" in target:
+            strata = {"bins": list(target["bins"]), "weights": list(target["weights"])}
+        elif target.get("uniform") and categories:
+            strata = {"categories": categories, "weights": [1] * len(categories)}
+        else:
+            low, high = var_dict.get(conf.REFERENTIAL_VAR_MIN), var_dict.get(conf.REFERENTIAL_VAR_MAX)
+            if "mean" in target:
+                low = low if pd.notna(low) else target["mean"] - 3 * target["std"]
+                high = high if pd.notna(high) else target["mean"] + 3 * target["std"]
+            elif not target.get("uniform") or pd.isna(low) or pd.isna(high):
+                logging.info(f"No target distribution for column {col}")
+                continue
+            bins = np.linspace(low, high, n_bins + 1).tolist()
+            if "mean" in target:
+                # normal distribution, the values out of the bounds counted in the outer bins
+                cdf = [0.5 * (1 + math.erf((edge - target["mean"]) / (target["std"] * math.sqrt(2)))) for edge in bins]
+                cdf[0], cdf[-1] = 0.0, 1.0
+                weights = np.diff(cdf).tolist()
+            else:
+                weights = [1] * n_bins
+            strata = {"bins": bins, "weights": weights}
+        weights = np.asarray(strata.pop("weights"), dtype=float)
+        steering_targets[col] = {**strata, "shares": weights / weights.sum()}
+    return steering_targets
+
+
+class DistributionSteerer:
+    """Steering of the generation towards target marginal distributions.
+    Running histograms of the accepted rows are compared with the targets (see
+    get_steering_targets) by their total variation distance. A share rate of the queries
+    is conditioned on the most under-filled strata of the max_conditions most distant
+    columns (e.g. "Generate only patients with PTGENDER=2 and AGE between 80 and 90."),
+    each stratum being drawn with a probability proportional to its deficit, so that
+    concurrent queries are not all conditioned on the same stratum.
+
+    Args:
+        targets (dict): strata and target shares of each column (see get_steering_targets)
+        rate (float, optional): share of the queries conditioned. Defaults to conf.STEERING_RATE.
+        min_rows (int, optional): number of rows accepted before steering.
+            Defaults to conf.STEERING_MIN_ROWS.
+        max_conditions (int, optional): maximum number of columns conditioned per query.
+            Defaults to conf.STEERING_MAX_CONDITIONS.
+        min_distance (float, optional): total variation distance below which a column is
+            not conditioned. Defaults to conf.STEERING_MIN_DISTANCE.
+        template (str, optional): text appended to the prompt, with a conditions item.
+            Defaults to conf.STEERING_PROMPT.
+        seed (int or str, optional): seed of the draws. Defaults to None.
+    """
+
+    def __init__(self,
+                 targets: dict,
+                 rate: Optional[float]=None,
+                 min_rows: Optional[int]=None,
+                 max_conditions: Optional[int]=None,
+                 min_distance: Optional[float]=None,
+                 template: Optional[str]=None,
+                 seed: Optional[Union[int, str]]=None):
+        self.targets = targets
+        self.rate = rate if rate is not None else conf.STEERING_RATE
+        self.min_rows = min_rows if min_rows is not None else conf.STEERING_MIN_ROWS
+        self.max_conditions = max_conditions if max_conditions is not None else conf.STEERING_MAX_CONDITIONS
+        self.min_distance = min_distance if min_distance is not None else conf.STEERING_MIN_DISTANCE
+        self.template = template or conf.STEERING_PROMPT
+        # own generator so that steering does not change the shuffling of the prompts
+        self._random = random.Random(seed)
+        self.counts = {col: np.zeros(len(target["shares"])) for col, target in targets.items()}
+        self.n_conditioned = {col: np.zeros(len(target["shares"]), dtype=int) for col, target in targets.items()}
+        self.stats = {"n_queries": 0, "n_steered_queries": 0, "n_rows": 0}
+
+    def get_conditioning(self) -> str:
+        """Conditioning of the next query, appended to its prompt (empty if not steered)"""
+        self.stats["n_queries"] += 1
+        if self.stats["n_rows"] < self.min_rows or self._random.random() >= self.rate:
+            return ""
+        distances = self.get_distances()
+        columns = sorted((col for col in distances if distances[col] > self.min_distance),
+                         key=lambda col: -distances[col])[:self.max_conditions]
+        conditions = []
+        for col in columns:
+            deficits = np.clip(self.targets[col]["shares"] - self._get_shares(col), 0, None)
+            i = self._random.choices(range(len(deficits)), weights=deficits)[0]
+            self.n_conditioned[col][i] += 1
+            conditions.append(self._get_label(col, i))
+        if not conditions:
+            return ""
+        self.stats["n_steered_queries"] += 1
+        return self.template.format(conditions=" and ".join(conditions))
+
+    def record(self, df: pd.DataFrame):
+        """Adds the accepted rows of a chunk to the histograms"""
+        self.stats["n_rows"] += len(df)
+        for col, target in self.targets.items():
+            if col not in df.columns:
+                continue
+            if "categories" in target:
+                values = df[col].to_numpy()
+                self.counts[col] += np.array([(values == category).sum() for category in target["categories"]])
+            else:
+                values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float)
+                values = values[~np.isnan(values)]
+                # values out of the bins are counted in the outer bins
+                i = np.clip(np.searchsorted(target["bins"], values, side="right") - 1, 0, len(target["shares"]) - 1)
+                self.counts[col] += np.bincount(i, minlength=len(target["shares"]))
+
+    def get_distances(self) -> dict:
+        """Total variation distance between the accepted rows and the target of each column"""
+        return {col: 0.5 * float(np.abs(self._get_shares(col) - target["shares"]).sum())
+                for col, target in self.targets.items()}
+
+    def get_report(self) -> pd.DataFrame:
+        """Target and observed share of each stratum, and number of queries conditioned on it"""
+        report = []
+        for col, target in self.targets.items():
+            shares = self._get_shares(col)
+            for i in range(len(target["shares"])):
+                report.append({"column": col,
+                               "stratum": self._get_label(col, i),
+                               "target_share": target["shares"][i],
+                               "observed_share": shares[i],
+                               "n_conditioned_queries": int(self.n_conditioned[col][i])})
+        return pd.DataFrame(report)
+
+    def log_report(self):
+        """Logs the statistics of the steering and the distance of each column to its target"""
+        logging.info(f"Steering: {self.stats}, total variation distances: "
+                     f"{ {col: round(distance, 3) for col, distance in self.get_distances().items()} }")
+        logging.info(f"Steering strata:\n{self.get_report().to_string(index=False)}")
+
+    def _get_shares(self, col: str) -> np.ndarray:
+        total = self.counts[col].sum()
+        if total == 0:
+            return np.zeros(len(self.counts[col]))
+        return self.counts[col] / total
+
+    def _get_label(self, col: str, i: int) -> str:
+        target = self.targets[col]
+        if "categories" in target:
+            return f"{col}={target['categories'][i]}"
+        return f"{col} between {target['bins'][i]:g} and {target['bins'][i + 1]:g}"
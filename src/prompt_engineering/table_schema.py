@@ -0,0 +1,110 @@
+""" JSON schema of the tables requested to the LLM, derived from the referential"""
+import re
+import pandas as pd
+from typing import Optional
+
+import config as conf
+
+# JSON schema type of the variable types of the referential and of the SDV sdtypes
+# (see utils_sdv.get_mapping_type)
+REFERENTIAL_TYPE_TO_JSON = {"int": "integer",
+                            "float": "number"}
+SDTYPE_TO_JSON = {"categorical": "integer",
+                  "boolean": "integer",
+                  "numerical": "number"}
+# type of the variables without type in the referential, e.g. identifiers
+UNTYPED_JSON = ["string", "number"]
+
+
+def parse_category_map(mapping: str) -> list:
+    """Categories of a category map of the referential, e.g. [0, 1] for '{0: male, 1: female}'
+
+    Args:
+        mapping (str): category map of the referential
+
+    Returns:
+        list: categories, as integers if numeric. Empty if the map cannot be parsed.
+    """
+    if not isinstance(mapping, str):
+        return []
+    categories = re.findall(r"[{,]\s*([^:{},]+?)\s*:", mapping)
+    return [int(c) if re.fullmatch(r"-?\d+", c) else c.strip("'\"") for c in categories]
+
+
+def get_column_schema(var_dict: Optional[dict]=None, sdtype: Optional[str]=None) -> dict:
+    """JSON schema of a column from its referential, or else from its SDV sdtype.
+    Plausible minimum and maximum values of the referential, if any, bound numeric columns.
+
+    Args:
+        var_dict (dict, optional): referential of the variable
+        sdtype (str, optional): sdtype of the column in the SDV metadata
+
+    Returns:
+        dict: JSON schema of the values of the column
+    """
+    json_type = None
+    categories = []
+    bounds = dict()
+    if var_dict is not None:
+        json_type = REFERENTIAL_TYPE_TO_JSON.get(str(var_dict.get(conf.REFERENTIAL_VAR_TYPE)).strip())
+        categories = parse_category_map(var_dict.get(conf.REFERENTIAL_VAR_CAT_MAPPING))
+        bounds = {"minimum": var_dict.get(conf.REFERENTIAL_VAR_MIN),
+                  "maximum": var_dict.get(conf.REFERENTIAL_VAR_MAX)}
+    if json_type is None and sdtype is not None:
+        json_type = SDTYPE_TO_JSON.get(sdtype)
+
+    column_schema = {"type": json_type or UNTYPED_JSON}
+    if categories:
+        column_schema["enum"] = categories
+    if json_type is not None:
+        for bound, value in bounds.items():
+            if isinstance(value, (int, float)) and pd.notna(value):
+                column_schema[bound] = value
+    return column_schema
+
+
+def get_row_schema(list_cols: list,
+                   ref_var: Optional[dict]=None,
+                   metadata: Optional[dict]=None) -> dict:
+    """JSON schema of a row of the synthetic table: an object holding all the columns,
+    typed from the referential (variable_type, variable_category_map, plausible minimum and
+    maximum) and, for the columns without type in the referential, from the SDV metadata
+
+    Args:
+        list_cols (list): columns of the synthetic table
+        ref_var (dict, optional): variable referential (see loading.load_variables_referential_dict)
+        metadata (dict, optional): SDV metadata in dictionary format
+
+    Returns:
+        dict: JSON schema of a row
+    """
+    ref_var = ref_var or dict()
+    metadata_columns = (metadata or dict()).get("columns", dict())
+    properties = {col: get_column_schema(var_dict=ref_var.get(col),
+                                         sdtype=metadata_columns.get(col, dict()).get("sdtype"))
+                  for col in list_cols}
+    return {"type": "object",
+            "properties": properties,
+            "required": list(list_cols),
+            "additionalProperties": False}
+
+
+def get_table_schema(row_schema: dict, n_rows: int) -> dict:
+    """JSON schema of a table of n_rows rows keyed by index ({"0": {...}, "1": {...}}),
+    the format of the json output format. The row schema is defined once and referenced
+    by each row.
+
+    Args:
+        row_schema (dict): JSON schema of a row (see get_row_schema)
+        n_rows (int): number of rows of the table
+
+    Returns:
+        dict: JSON schema of the table
+    """
+    keys = [str(i) for i in range(n_rows)]
+    return {"type": "object",
+            "properties": {key: {"$ref": "#/$defs/row"} for key in keys},
+            "required": keys,
+            "additionalProperties": False,
+            "$defs": {"row": row_schema}}
+
@@ -0,0 +1,130 @@
+""" Vectorized validation of the generated tables"""
+import logging
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+# rules checked on each column: missing column, missing value, non numeric value of a
+# numeric column, non integer value of an integer column, value out of the categories,
+# below the minimum or above the maximum of the referential
+VALIDATION_RULES = ["missing_column", "null", "type", "integer", "enum", "minimum", "maximum"]
+
+
+class TableValidator:
+    """Validator of the generated tables compiled from the row schema (see
+    table_schema.get_row_schema): each column is checked against its type with
+    vectorized operations on its values, so that a chunk is validated in a few numpy
+    operations per column.
+    Rows failing a rule are dropped, the values and dtypes of the valid rows being kept
+    as parsed. Rejections are counted per column and rule over
+    all the chunks validated (a row failing several rules is counted for each).
+
+    Args:
+        row_schema (dict): JSON schema of a row
+    """
+
+    def __init__(self, row_schema: dict):
+        self.columns = list(row_schema["required"])
+        # compiled rules of each column: numeric or not, integer or not, sorted categories, bounds
+        self.column_rules = dict()
+        for col in self.columns:
+            column_schema = row_schema["properties"][col]
+            json_type = column_schema.get("type")
+            enum = column_schema.get("enum")
+            is_numeric = json_type in ("integer", "number")
+            self.column_rules[col] = {
+                "is_numeric": is_numeric,
+                "is_integer": json_type == "integer",
+                "enum": np.sort(np.array(enum, dtype=float if is_numeric else object)) if enum else None,
+                "minimum": column_schema.get("minimum"),
+                "maximum": column_schema.get("maximum")}
+        self.n_rows = 0
+        self.n_valid_rows = 0
+        self.n_rejected = {(col, rule): 0 for col in self.columns for rule in VALIDATION_RULES}
+
+    def validate(self, df: Optional[pd.DataFrame]) -> Tuple[Optional[pd.DataFrame], dict]:
+        """Validates a chunk: drops the rows whose values do not match the type of their column
+
+        Args:
+            df (pd.DataFrame): parsed chunk
+
+        Returns:
+            pd.DataFrame: valid rows with the columns of the schema, in order, as parsed.
+                None if no row is valid.
+            dict: number of rows of the chunk failing each rule, by (column, rule)
+        """
+        if df is None or not len(df):
+            return None, dict()
+        n_rows = len(df)
+        n_rejected = dict()
+        missing_columns = [col for col in self.columns if col not in df.columns]
+        if missing_columns:
+            n_rejected = {(col, "missing_column"): n_rows for col in missing_columns}
+            self._update(n_rows, 0, n_rejected)
+            return None, n_rejected
+
+        valid = np.ones(n_rows, dtype=bool)
+        for col in self.columns:
+            rules = self.column_rules[col]
+            checks = dict()
+            series = df[col]
+            if rules["is_numeric"]:
+                values = self._to_float(series)
+                is_nan = np.isnan(values)
+                if self._is_float_compatible(series):
+                    checks["null"] = is_nan
+                else:
+                    checks["null"] = series.isna().to_numpy()
+                    checks["type"] = is_nan & ~checks["null"]
+                with np.errstate(invalid="ignore"):
+                    if rules["is_integer"]:
+                        checks["integer"] = ~is_nan & (values != np.round(values))
+                    if rules["enum"] is not None:
+                        checks["enum"] = ~is_nan & ~np.isin(values, rules["enum"], assume_unique=True)
+                    if rules["minimum"] is not None:
+                        checks["minimum"] = values < rules["minimum"]
+                    if rules["maximum"] is not None:
+                        checks["maximum"] = values > rules["maximum"]
+            else:
+                values = series.array
+                checks["null"] = series.isna().to_numpy()
+                if rules["enum"] is not None:
+                    checks["enum"] = ~checks["null"] & ~np.isin(values, rules["enum"])
+            for rule, is_invalid in checks.items():
+                n_invalid = int(is_invalid.sum())
+                if n_invalid:
+                    n_rejected[(col, rule)] = n_invalid
+                    valid &= ~is_invalid
+
+        n_valid_rows = int(valid.sum())
+        self._update(n_rows, n_valid_rows, n_rejected)
+        if n_valid_rows < n_rows:
+            logging.info(f"{n_rows - n_valid_rows} invalid rows out of {n_rows}: {n_rejected}")
+        if not n_valid_rows:
+            return None, n_rejected
+        return df.loc[valid, self.columns], n_rejected
+
+    @staticmethod
+    def _is_float_compatible(series: pd.Series) -> bool:
+        """Whether a column is numeric (its missing values are its NaN values)"""
+        return pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+    @classmethod
+    def _to_float(cls, series: pd.Series) -> np.ndarray:
+        """Values of a column as floats, NaN if missing or not numeric"""
+        if cls._is_float_compatible(series):
+            return series.to_numpy(dtype=float, na_value=np.nan)
+        return pd.to_numeric(series, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+    def _update(self, n_rows: int, n_valid_rows: int, n_rejected: dict):
+        self.n_rows += n_rows
+        self.n_valid_rows += n_valid_rows
+        for key, n in n_rejected.items():
+            self.n_rejected[key] += n
+
+    def get_report(self) -> pd.DataFrame:
+        """Number of rows rejected by each rule of each column over the chunks validated"""
+        report = [{"column": col, "rule": rule, "n_rejected": n,
+                   "rejection_rate": n / self.n_rows if self.n_rows else 0.}
+                  for (col, rule), n in self.n_rejected.items() if n]
+        return pd.DataFrame(report, columns=["column", "rule", "n_rejected", "rejection_rate"])
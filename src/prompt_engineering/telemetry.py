@@ -0,0 +1,112 @@
+""" Telemetry of the LLM queries of a generation"""
+import os
+import time
+import logging
+import tempfile
+import threading
+import pandas as pd
+from typing import Optional
+
+import config as conf
+
+
+class TelemetryCollector:
+    """In-memory collector of one event per LLM query, safe to share across threads.
+    An event holds the provider and model queried, the number of prompt and completion
+    tokens, the latency, the finish reason, the number of attempts (retries included),
+    whether the response was served from the cache, parsed as a table, and the number
+    of valid rows it yielded.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, **event):
+        """Records the event of a query (time of the record added)"""
+        event["recorded_at"] = time.time()
+        with self._lock:
+            self.events.append(event)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Events recorded, one row per query"""
+        with self._lock:
+            return pd.DataFrame(self.events)
+
+    def flush(self, path: str):
+        """Writes the events recorded to a csv or parquet file (by extension of path)
+
+        Args:
+            path (str): path of the file, local or s3
+        """
+        df_events = self.to_dataframe()
+        if path.endswith(".parquet"):
+            df_events.to_parquet(path, index=False)
+        else:
+            df_events.to_csv(path, index=False)
+        logging.info(f"{len(df_events)} telemetry events written to {path}")
+
+    def get_summary(self, elapsed: Optional[float]=None) -> dict:
+        """Summary of the queries recorded
+
+        Args:
+            elapsed (float, optional): duration (seconds) of the generation, to compute its
+                throughput. Defaults to the time between the first and the last event.
+
+        Returns:
+            dict: number of queries, parse rate, tokens, share of the prompt tokens served
+                from the prompt cache of the providers, latency, valid rows per second and
+                tokens per valid row
+        """
+        df_events = self.to_dataframe()
+        if df_events.empty:
+            return dict()
+        if elapsed is None:
+            elapsed = (df_events["recorded_at"].max() - (df_events["recorded_at"] - df_events["latency"]).min())
+        n_valid_rows = int(df_events["n_valid_rows"].sum())
+        n_tokens = df_events["prompt_tokens"].sum() + df_events["completion_tokens"].sum()
+        return {"n_queries": len(df_events),
+                "n_cached": int(df_events["cached"].sum()),
+                "n_retries": int((df_events["n_attempts"] - 1).clip(lower=0).sum()),
+                "parse_rate": float(df_events["parsed"].mean()),
+                "n_valid_rows": n_valid_rows,
+                "prompt_tokens": int(df_events["prompt_tokens"].sum()),
+                "completion_tokens": int(df_events["completion_tokens"].sum()),
+                "cached_prompt_token_ratio": float(df_events.get("cached_prompt_tokens", pd.Series(dtype=float)).sum()
+                                                   / max(df_events["prompt_tokens"].sum(), 1)),
+                "mean_latency": float(df_events["latency"].mean()),
+                "rows_per_second": float(n_valid_rows / max(elapsed, 1e-9)),
+                "tokens_per_valid_row": float(n_tokens / max(n_valid_rows, 1))}
+
+    def log_mlflow(self, elapsed: Optional[float]=None):
+        """Logs the summary as metrics and the events as artifact of the active mlflow run"""
+        import mlflow
+        for name, value in self.get_summary(elapsed=elapsed).items():
+            mlflow.log_metric(f"llm_{name}", value)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "llm_telemetry.csv")
+            self.flush(path)
+            mlflow.log_artifact(path)
+
+
+def get_query_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Cost ($) of a query from the prices of the model set in conf.LLM_TOKEN_PRICES,
+    0 for the models without price (e.g. local models)"""
+    prices = conf.LLM_TOKEN_PRICES.get(model, dict())
+    return (prompt_tokens * prices.get("prompt", 0)
+            + completion_tokens * prices.get("completion", 0)) / 1e6
+
+
+# collector of the queries of prompt_synth_tab, None when queries are not recorded
+_TELEMETRY_COLLECTOR = None
+
+
+def set_telemetry_collector(collector: Optional[TelemetryCollector]):
+    """Set the collector recording the queries (None to disable telemetry)"""
+    global _TELEMETRY_COLLECTOR
+    _TELEMETRY_COLLECTOR = collector
+
+
+def get_telemetry_collector() -> Optional[TelemetryCollector]:
+    """Get the collector recording the queries, None if queries are not recorded"""
+    return _TELEMETRY_COLLECTOR
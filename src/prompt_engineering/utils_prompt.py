@@ -1,13 +1,23 @@
+import json
+import random
 import numpy as np
+from typing import Optional
+import config as conf
 from src.utils import utils_referential
 from src.utils.utils_df import shuffle_dict
 
+# layouts of the prompts (see conf.PROMPT_LAYOUT)
+PROMPT_LAYOUTS = ("inline", "prefix")
+
 
 def parse_prompt(prompt_dict: dict,
                  prompt_example: dict,
                  var_desc_prompt_dict: dict,
                  ref_key: str,
-                 shuffle: bool=False):
+                 shuffle: bool=False,
+                 n_rows: int=None,
+                 layout: str="inline",
+                 n_permutations: Optional[int]=None):
     """Parse prompt from prompt template dictionary
 
     Args:
@@ -16,6 +26,13 @@ def parse_prompt(prompt_dict: dict,
         var_desc_prompt_dict (dict): dictionary containing data specifications dictionary
         ref_key (str): key to use in reference dictionary
         shuffle (bool, optional): whether to shuffle or not the variables. Defaults to False.
+        n_rows (int, optional): number of rows requested, if the template has a n_rows item.
+        layout (str, optional): layout of the prompt, "inline" (items in place in the
+            template) or "prefix" (items changing between prompts moved to the end of the
+            prompt, see get_layout_template). Defaults to "inline".
+        n_permutations (int, optional): size of the pool of fixed permutations the order of
+            the shuffled variables is drawn from (see get_pool_permutation). Defaults to
+            None, a new permutation for each prompt.
 
     Returns:
         prompt in string format
@@ -27,6 +44,7 @@ def parse_prompt(prompt_dict: dict,
         
     # create prompt from template items and template prompt
     else:
+        prompt = get_layout_template(prompt_dict=prompt_dict, layout=layout)
         
         # prompt items dictionary
         prompt_items_dict = dict()
@@ -35,7 +53,9 @@ def parse_prompt(prompt_dict: dict,
                                                                prompt_example=prompt_example,
                                                                var_desc_prompt_dict=var_desc_prompt_dict,
                                                                ref_key=ref_key,
-                                                                shuffle=shuffle)
+                                                               shuffle=shuffle,
+                                                               n_rows=n_rows,
+                                                               n_permutations=n_permutations)
         output_prompt = prompt.format(**prompt_items_dict)
     
     return output_prompt
@@ -45,7 +65,9 @@ def parse_prompt_item(item: str,
                       prompt_example: dict,
                       var_desc_prompt_dict: dict,
                       ref_key: str,
-                      shuffle: bool=False):
+                      shuffle: bool=False,
+                      n_rows: int=None,
+                      n_permutations: Optional[int]=None):
     """Parse prompt item from prompt template dictionary
     
     Args:
@@ -54,6 +76,9 @@ def parse_prompt_item(item: str,
         var_desc_prompt_dict (dict): dictionary containing data specifications dictionary
         ref_key (str): key to use in reference dictionary
         shuffle (bool, optional): whether to shuffle or not the variables. Defaults to False.
+        n_rows (int, optional): number of rows requested, for the n_rows item.
+        n_permutations (int, optional): size of the pool of permutations of the shuffled
+            variables. Defaults to None, a new permutation.
         
     Returns:
         prompt item in string format
@@ -61,13 +86,28 @@ def parse_prompt_item(item: str,
     
     if item == "row_example":
          return prompt_example
+
+    elif item == "row_example_columnar":
+        return format_row_example(prompt_example, output_format="json_columnar")
+
+    elif item == "row_example_csv":
+        return format_row_example(prompt_example, output_format="csv")
+
+    elif item == "n_rows":
+        if n_rows is None:
+            raise ValueError("n_rows must be provided to parse a prompt requesting a number of rows")
+        return n_rows
     
     elif item == "variables_description":
         
         # Get variable description referential
         ref_variables = utils_referential.get_ref_variables_to_keep()
         
-        if shuffle:
+        if shuffle and n_permutations:
+            keys = list(ref_variables)
+            ref_variables = {keys[i]: ref_variables[keys[i]]
+                             for i in get_pool_permutation(len(keys), n_permutations=n_permutations, rng=random)}
+        elif shuffle:
             ref_variables = shuffle_dict(d=ref_variables)
         return get_prompt_desc_all_variables(
             ref=ref_variables,
@@ -79,6 +119,72 @@ def parse_prompt_item(item: str,
     else:
         raise ValueError(f"Request item {item} not implemented")
     
+def format_row_example(prompt_example: dict, output_format: str) -> str:
+    """Format row examples ({key: row}) in the output format of a prompt
+
+    Args:
+        prompt_example (dict): row examples of output
+        output_format (str): json_columnar or csv (see TEXT2TAB_PROMPT_DICT)
+
+    Returns:
+        row examples in string format
+    """
+    rows = list(prompt_example.values())
+    columns = list(rows[0].keys())
+    if output_format == "json_columnar":
+        return json.dumps({"columns": columns, "rows": [[row[col] for col in columns] for row in rows]})
+    elif output_format == "csv":
+        lines = [",".join(columns)] + [",".join(str(row[col]) for col in columns) for row in rows]
+        return "\n".join(lines)
+    else:
+        raise ValueError(f"Output format {output_format} not implemented")
+
+def get_layout_template(prompt_dict: dict, layout: str="inline") -> str:
+    """Template of a prompt in a layout.
+    In the "prefix" layout, the items changing between prompts (see CompiledPrompt.DYNAMIC_ITEMS)
+    are replaced in the template by a reference to the end of the prompt, where their values
+    are appended (see conf.PROMPT_PREFIX_LAYOUT). The invariant content (description of the
+    database, instructions, row example) is then a prefix shared by all the prompts, which
+    providers caching prompt prefixes serve faster and cheaper.
+
+    Args:
+        prompt_dict (dict): template dictionary prompt
+        layout (str, optional): "inline" or "prefix". Defaults to "inline".
+
+    Returns:
+        template of the prompt
+    """
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Prompt layout {layout} not implemented")
+    prompt = prompt_dict["prompt"]
+    if layout == "inline":
+        return prompt
+    moved_items = [item for item in conf.PROMPT_PREFIX_LAYOUT["suffix"] if item in prompt_dict["template_items"]]
+    for item in moved_items:
+        prompt = prompt.replace(f"{{{item}}}", conf.PROMPT_PREFIX_LAYOUT["references"][item])
+    # items moved to the end, in the order of conf.PROMPT_PREFIX_LAYOUT
+    return prompt + "".join(conf.PROMPT_PREFIX_LAYOUT["suffix"][item] for item in moved_items)
+
+
+def get_pool_permutation(n: int, n_permutations: int, rng=random) -> list:
+    """Permutation of n elements drawn from a pool of n_permutations fixed permutations.
+    Prompts reusing the same order of variables share their prefix up to the number of rows,
+    so that providers caching prompt prefixes can serve them.
+
+    Args:
+        n (int): number of elements
+        n_permutations (int): number of permutations of the pool
+        rng (random.Random, optional): generator of the draw. Defaults to the global generator.
+
+    Returns:
+        list: permuted positions
+    """
+    order = list(range(n))
+    # permutations of the pool only depend on their index
+    random.Random(f"permutation_{rng.randrange(n_permutations)}").shuffle(order)
+    return order
+
+
 def get_prompt_desc_all_variables(ref: list,
                                  var_desc_prompt_template: str,
                                  var_desc_prompt_template_mapping: dict,
@@ -128,5 +234,115 @@ def get_prompt_desc_var(var_name: str,
     return var_desc_prompt_template.format(**description_dict)
 
 
+class CompiledPrompt:
+    """Prompt template compiled once for many renders.
+    The description line of each variable is rendered once and the template is split into
+    static segments around the items changing between renders (number of rows and order of
+    the variables), so that a shuffled prompt is only a join of cached strings.
+    Renders are identical to parse_prompt for the same state of the random generator.
+
+    Args:
+        prompt_dict (dict): template dictionary prompt
+        prompt_example (dict): row examples of output
+        var_desc_prompt_dict (dict): dictionary containing data specifications dictionary
+        ref_key (str): key to use in reference dictionary
+        layout (str, optional): layout of the prompt, "inline" or "prefix" (see
+            get_layout_template). Defaults to "inline".
+        n_permutations (int, optional): size of the pool of permutations of the shuffled
+            variables (see get_pool_permutation). Defaults to None, a new permutation per render.
+    """
+
+    # items rendered at each call, other template items are rendered at compilation
+    DYNAMIC_ITEMS = ("n_rows", "variables_description")
+
+    def __init__(self,
+                 prompt_dict: dict,
+                 prompt_example: dict,
+                 var_desc_prompt_dict: dict,
+                 ref_key: str,
+                 layout: str="inline",
+                 n_permutations: Optional[int]=None):
+        self.variable_names = []
+        self.variable_lines = []
+        self.n_permutations = n_permutations
+        if not prompt_dict["is_template"] or prompt_dict["template_items"] is None:
+            self.segments = [prompt_dict["prompt"]]
+            self.slots = []
+            return
+
+        if "variables_description" in prompt_dict["template_items"]:
+            ref_variables = utils_referential.get_ref_variables_to_keep()
+            self.variable_names = list(ref_variables)
+            self.variable_lines = [get_prompt_desc_var(var_name=var_name,
+                                                       var_dict=var_dict,
+                                                       var_desc_prompt_template=var_desc_prompt_dict["template"],
+                                                       var_desc_prompt_template_mapping=var_desc_prompt_dict["mapping"],
+                                                       ref_key=ref_key)
+                                   for var_name, var_dict in ref_variables.items()]
+
+        # dynamic items are formatted as markers, then the prompt is split around them
+        markers = {item: f"\x00{item}\x00" for item in self.DYNAMIC_ITEMS}
+        prompt_items_dict = dict()
+        for prompt_item in prompt_dict["template_items"]:
+            if prompt_item in markers:
+                prompt_items_dict[prompt_item] = markers[prompt_item]
+            else:
+                prompt_items_dict[prompt_item] = parse_prompt_item(item=prompt_item,
+                                                                   prompt_example=prompt_example,
+                                                                   var_desc_prompt_dict=var_desc_prompt_dict,
+                                                                   ref_key=ref_key)
+        parts = get_layout_template(prompt_dict=prompt_dict, layout=layout).format(**prompt_items_dict).split("\x00")
+        # parts alternate static segments and names of dynamic items
+        self.segments = parts[0::2]
+        self.slots = parts[1::2]
+
+    def render(self,
+               n_rows: Optional[int]=None,
+               shuffle: bool=False,
+               rng: Optional[random.Random]=None) -> str:
+        """Renders a prompt
+
+        Args:
+            n_rows (int, optional): number of rows requested, if the template has a n_rows item.
+            shuffle (bool, optional): whether to shuffle or not the variables. Defaults to False.
+            rng (random.Random, optional): generator of the shuffling. Defaults to the global
+                generator, as parse_prompt.
+
+        Returns:
+            prompt in string format
+        """
+        if "n_rows" in self.slots and n_rows is None:
+            raise ValueError("n_rows must be provided to parse a prompt requesting a number of rows")
+        lines = self.variable_lines
+        if shuffle and "variables_description" in self.slots:
+            if self.n_permutations:
+                order = get_pool_permutation(len(lines), n_permutations=self.n_permutations, rng=rng or random)
+            else:
+                order = list(range(len(lines)))
+                (rng or random).shuffle(order)
+            lines = [lines[i] for i in order]
+        values = {"n_rows": str(n_rows), "variables_description": "\n".join(lines)}
+
+        output_prompt = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            output_prompt.append(values[slot])
+            output_prompt.append(segment)
+        return "".join(output_prompt)
+
+    def render_batch(self,
+                     n_prompts: int,
+                     n_rows: Optional[int]=None,
+                     shuffle: bool=False,
+                     rng: Optional[random.Random]=None) -> list:
+        """Renders n_prompts prompts at once, e.g. all the requests of a batch job
 
+        Args:
+            n_prompts (int): number of prompts
+            n_rows (int, optional): number of rows requested by each prompt
+            shuffle (bool, optional): whether to shuffle the variables of each prompt. Defaults to False.
+            rng (random.Random, optional): generator of the shuffling. Defaults to the global generator.
 
+        Returns:
+            list: prompts in string format
+        """
+        return [self.render(n_rows=n_rows, shuffle=shuffle, rng=rng) for _ in range(n_prompts)]
@@ -84,6 +84,8 @@ def custom_validate_data(df: pd.DataFrame,
     list_cols = metadata.get_column_names()
     all_cols_in_list_bool = all(col in df.columns for col in list_cols)
     assert all_cols_in_list_bool, f"Columns not found in metadata"
+    # columns not in metadata are not evaluated (e.g. tags of the generation of the rows)
+    df = df.drop(columns=[col for col in df.columns if col not in list_cols])
     
     # validate data with metadata
     # NB: this does not validate the types of the columns which is still problematic